@@ -0,0 +1,262 @@
+"""Client connections served by an asyncio.Protocol (--io-mode protocol)
+
+The streams path resumes a coroutine, copies through a StreamReader and
+awaits drain() for every read. Here data_received feeds the RESP parser
+directly and commands that can't block run right away, in the callback;
+their replies go out in writes of up to about 64KB, and a batch stops
+when the transport pauses writing, until the client reads. Commands that may
+block (XREAD BLOCK, WAIT, PSYNC, ...) still get a task, and the
+connection stops reading until it finishes, so replies keep their order.
+"""
+
+import asyncio
+import logging
+from collections import deque
+from typing import Optional
+from app.clients import MAXCLIENTS_ERROR, Client
+from app.protocol.resp_decoder import ProtocolError, QueryBufferLimitError
+
+logger = logging.getLogger(__name__)
+
+# Replies of a batch are written out once they add up to this many bytes,
+# so the output buffer limit is checked before the rest of the batch runs
+REPLY_CHUNK = 64 * 1024
+
+
+def run_inline(coroutine):
+    """Run a coroutine that never suspends to the end, synchronously"""
+    try:
+        coroutine.send(None)
+    except StopIteration as done:
+        return done.value
+    coroutine.close()
+    raise RuntimeError("Command suspended outside of a task")
+
+
+class TransportWriter:
+    """The StreamWriter interface commands and replication use, on a transport"""
+
+    __slots__ = ("transport", "protocol")
+
+    def __init__(self, transport: asyncio.Transport, protocol: "ClientProtocol"):
+        self.transport = transport
+        self.protocol = protocol
+
+    def write(self, data: bytes) -> None:
+        self.transport.write(data)
+
+    async def drain(self) -> None:
+        if self.protocol.drain_waiter is not None:
+            await asyncio.shield(self.protocol.drain_waiter)
+        if self.protocol.closed:
+            raise ConnectionResetError("Connection lost")
+
+    def is_closing(self) -> bool:
+        return self.transport.is_closing()
+
+    def close(self) -> None:
+        self.transport.close()
+
+    async def wait_closed(self) -> None:
+        protocol = self.protocol
+        if protocol.closed:
+            return
+        if protocol.close_waiter is None:
+            protocol.close_waiter = asyncio.get_running_loop().create_future()
+        await asyncio.shield(protocol.close_waiter)
+
+    def get_extra_info(self, name, default=None):
+        return self.transport.get_extra_info(name, default)
+
+
+class ClientProtocol(asyncio.Protocol):
+    # A connection that only sits idle costs this object, its transport and
+    # the Client record: what may wait is allocated when it has to
+    __slots__ = (
+        "server",
+        "client",
+        "decoder",
+        "transport",
+        "writer",
+        "address",
+        "pending",
+        "busy",
+        "drain_waiter",
+        "closed",
+        "close_waiter",
+    )
+
+    def __init__(self, server):
+        self.server = server
+        self.client: Optional[Client] = None
+        self.decoder = server.new_decoder()
+        self.transport: Optional[asyncio.Transport] = None
+        self.writer: Optional[TransportWriter] = None
+        self.address = None
+        # Parsed commands waiting for a blocking one before them to finish
+        self.pending: Optional[deque] = None
+        # The task running a blocking command, or waiting for the AOF
+        self.busy: Optional[asyncio.Task] = None
+        # Set while the transport's write buffer is over its high-water mark
+        self.drain_waiter: Optional[asyncio.Future] = None
+        self.closed = False
+        # Created by wait_closed() only
+        self.close_waiter: Optional[asyncio.Future] = None
+
+    def connection_made(self, transport: asyncio.Transport) -> None:
+        self.transport = transport
+        self.writer = TransportWriter(transport, self)
+        self.address = transport.get_extra_info("peername")
+        self.client = self.server.clients.add(self.writer)
+        if self.client is None:
+            logger.warning(f"Refusing {self.address}: maxclients reached")
+            transport.write(MAXCLIENTS_ERROR)
+            transport.close()
+            return
+        logger.info(f"New Connection from {self.address}")
+        self.server.tune_connection(transport.get_extra_info("socket"))
+
+    def connection_lost(self, exc: Optional[Exception]) -> None:
+        self.closed = True
+        if self.close_waiter is not None and not self.close_waiter.done():
+            self.close_waiter.set_result(None)
+        # Wake up writers waiting to drain: they find the connection closed
+        if self.drain_waiter is not None and not self.drain_waiter.done():
+            self.drain_waiter.set_result(None)
+        if self.client is None:
+            return
+        if self.busy is not None:
+            self.busy.cancel()
+        self.server.database.unwatch(self.client.state)
+        self.server.database.remove_replica(self.writer)
+        self.server.clients.remove(self.writer)
+        logger.info(f"Connection Closed from Peer: {self.address}")
+
+    def pause_writing(self) -> None:
+        # Stop taking commands until the client reads its replies
+        self.drain_waiter = asyncio.get_running_loop().create_future()
+        self.transport.pause_reading()
+
+    def resume_writing(self) -> None:
+        waiter, self.drain_waiter = self.drain_waiter, None
+        if waiter is not None and not waiter.done():
+            waiter.set_result(None)
+        self._process()
+
+    def data_received(self, data: bytes) -> None:
+        if self.client is None:
+            return
+        self.decoder.buffer += data
+        try:
+            commands = self.decoder.parse()
+        except QueryBufferLimitError as e:
+            self.server.query_limit_reached(self.address, e)
+            self.transport.abort()
+            return
+        except ProtocolError as e:
+            logger.error(f"Protocol error from {self.address}: {e}")
+            self.transport.write(self.server.encoder.encode_error(str(e)))
+            self.transport.close()
+            return
+        except Exception as e:
+            logger.error(f"Error decoding the stream: {e}")
+            self.transport.close()
+            return
+
+        if commands:
+            self.server.clients.touch(self.client)
+            if self.pending:
+                self.pending.extend(commands)
+            else:
+                self.pending = deque(commands)
+        self._process()
+
+    def _process(self) -> None:
+        """Run the pending commands until one has to wait"""
+        handler, state = self.server.command_handler, self.client.state
+        transport, aof = self.transport, self.server.database.aof
+        replies, size = [], 0
+        while (
+            self.pending
+            and self.busy is None
+            and self.drain_waiter is None
+            and not transport.is_closing()
+        ):
+            args = self.pending.popleft()
+            if handler.may_block(args, state):
+                self.busy = asyncio.ensure_future(self._run_blocking(args, replies))
+                replies = []
+                break
+            reply = self._run(args)
+            replies.append(reply)
+            size += len(reply)
+            if size >= REPLY_CHUNK:
+                if aof.flush_future is not None:
+                    # These wait for the AOF; the rest of the batch waits too
+                    break
+                # Stops the loop if it pauses writing or aborts the connection
+                self._write(b"".join(replies))
+                replies, size = [], 0
+        if not self.pending:
+            self.pending = None
+
+        if replies:
+            # The group commit holding our writes has to finish before replying
+            if aof.flush_future is not None:
+                self.busy = asyncio.ensure_future(self._reply_when_flushed(replies))
+            else:
+                self._write(b"".join(replies))
+
+        if transport.is_closing():
+            return
+        if self.busy is None and self.drain_waiter is None:
+            self.transport.resume_reading()
+        else:
+            self.transport.pause_reading()
+
+    def _write(self, data: bytes) -> None:
+        if data and not self.transport.is_closing():
+            self.transport.write(data)
+            self.server.output_over_limit(self.client)
+
+    def _run(self, args) -> bytes:
+        try:
+            response = run_inline(
+                self.server.command_handler.handle_command(
+                    args, self.client.state, self.writer
+                )
+            )
+        except Exception as e:
+            logger.error(f"Error handling command {args}: {e}")
+            response = self.server.encoder.encode_error(str(e))
+        return response or b""
+
+    async def _run_blocking(self, args, replies) -> None:
+        """Send the replies before args, then run it; reading waits meanwhile"""
+        database = self.server.database
+        self.client.busy = True
+        try:
+            await database.aof.wait_flushed()
+            self._write(b"".join(replies))
+            try:
+                response = await self.server.command_handler.handle_command(
+                    args, self.client.state, self.writer
+                )
+                await database.aof.wait_flushed()
+            except Exception as e:
+                logger.error(f"Error handling command {args}: {e}")
+                response = self.server.encoder.encode_error(str(e))
+            if response:
+                self._write(response)
+        finally:
+            self.busy = None
+            self.client.busy = False
+        self._process()
+
+    async def _reply_when_flushed(self, replies) -> None:
+        try:
+            await self.server.database.aof.wait_flushed()
+            self._write(b"".join(replies))
+        finally:
+            self.busy = None
+        self._process()
@@ -0,0 +1,124 @@
+"""The server's record of its client connections
+
+A client costs one small object here, so an instance can hold on to a
+large number of mostly idle connections. They are kept ordered by last
+activity, which makes finding the ones idle past `timeout` O(1) per
+connection found instead of a scan of every client.
+"""
+
+import asyncio
+import threading
+import time
+from collections import OrderedDict
+from typing import Iterator, List, Optional
+from app.commands.command_state import CommandState
+from app.utils.buffer_limits import OutputBufferGuard
+
+MAXCLIENTS_ERROR = b"-ERR max number of clients reached\r\n"
+
+
+class Client:
+    __slots__ = ("writer", "loop", "state", "output_guard", "last_interaction", "busy")
+
+    def __init__(self, writer, loop, state: CommandState, output_guard):
+        self.writer = writer
+        # The event loop serving the connection (one of several with --threads)
+        self.loop: asyncio.AbstractEventLoop = loop
+        self.state = state
+        # None when the normal class has no output buffer limit
+        self.output_guard: Optional[OutputBufferGuard] = output_guard
+        self.last_interaction = time.monotonic()
+        # Running a command: a blocked XREAD or WAIT isn't idle
+        self.busy = False
+
+    def close(self) -> None:
+        """Close the connection from any thread"""
+        if self.loop is asyncio.get_running_loop():
+            self.writer.close()
+        else:
+            self.loop.call_soon_threadsafe(self.writer.close)
+
+    def abort(self) -> None:
+        if self.loop is asyncio.get_running_loop():
+            self.writer.transport.abort()
+        else:
+            self.loop.call_soon_threadsafe(self.writer.transport.abort)
+
+
+class Clients:
+    """Open client connections by writer, least recently active first"""
+
+    def __init__(self, config, database):
+        self.config = config
+        self.database = database
+        self.connections: "OrderedDict[object, Client]" = OrderedDict()
+        # With --threads every event loop adds and touches its clients while
+        # the main loop's cron goes through them
+        self.lock = threading.Lock()
+        normal = database.output_buffer_limits["normal"]
+        self.normal_limit = normal if normal.hard or normal.soft else None
+
+    def __len__(self) -> int:
+        return len(self.connections)
+
+    def __iter__(self) -> Iterator[Client]:
+        with self.lock:
+            return iter(list(self.connections.values()))
+
+    def get(self, writer) -> Optional[Client]:
+        return self.connections.get(writer)
+
+    def add(self, writer, internal: bool = False) -> Optional[Client]:
+        """Register a connection; None if maxclients is reached"""
+        # Connections of the other workers are ours, so they have no limits
+        guard = None
+        if self.normal_limit is not None and not internal:
+            guard = OutputBufferGuard(self.normal_limit)
+        client = Client(
+            writer, asyncio.get_running_loop(), CommandState(internal=internal), guard
+        )
+        with self.lock:
+            if not internal and len(self.connections) >= self.config.maxclients:
+                return None
+            self.connections[writer] = client
+        return client
+
+    def remove(self, writer) -> None:
+        with self.lock:
+            self.connections.pop(writer, None)
+
+    def touch(self, client: Client) -> None:
+        """The client just sent a command"""
+        with self.lock:
+            self._touch(client)
+
+    def _touch(self, client: Client) -> None:
+        client.last_interaction = time.monotonic()
+        # A client closed meanwhile stays out
+        if client.writer in self.connections:
+            self.connections.move_to_end(client.writer)
+
+    def idle(self, timeout: float) -> List[Client]:
+        """Unregister and return the clients silent for more than timeout seconds
+
+        Replicas, clients running a command and connections of the other
+        workers never time out; they go back to the end of the line.
+        """
+        deadline = time.monotonic() - timeout
+        expired = []
+        with self.lock:
+            for _ in range(len(self.connections)):
+                writer, client = next(iter(self.connections.items()))
+                if client.last_interaction > deadline:
+                    break
+                if (
+                    client.busy
+                    or client.state.internal
+                    or writer in self.database.replicas
+                    or writer in self.database.syncing_replicas
+                ):
+                    self._touch(client)
+                    continue
+                del self.connections[writer]
+                expired.append(client)
+        return expired
@@ -0,0 +1,106 @@
+"""Connections MIGRATE uses to ship keys to another node"""
+
+import asyncio
+import logging
+import time
+from typing import Dict, List, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Idle connections to a MIGRATE target are closed after this many seconds
+MIGRATE_SOCKET_CACHE_TTL = 10
+# Pipelined RESTOREs are written in chunks of about this size
+MIGRATE_WRITE_CHUNK = 64 * 1024
+
+
+class MigrateConnection:
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.reader = reader
+        self.writer = writer
+        # One MIGRATE at a time, so replies can't get mixed up
+        self.lock = asyncio.Lock()
+        self.last_use = time.time()
+
+    @property
+    def usable(self) -> bool:
+        return not self.writer.is_closing() and not self.reader.at_eof()
+
+    async def pipeline(self, commands: List[bytes], timeout: float) -> List[bytes]:
+        """Send every command, then collect one single-line reply per command
+
+        Replies are read while we are still writing, so a large batch can't
+        stall with both sides waiting on full socket buffers.
+        """
+        replies = asyncio.create_task(self._read_replies(len(commands)))
+        try:
+            chunk = bytearray()
+            for command in commands:
+                chunk += command
+                if len(chunk) >= MIGRATE_WRITE_CHUNK:
+                    self.writer.write(bytes(chunk))
+                    chunk.clear()
+                    await asyncio.wait_for(self.writer.drain(), timeout)
+            self.writer.write(bytes(chunk))
+            await asyncio.wait_for(self.writer.drain(), timeout)
+            return await asyncio.wait_for(replies, timeout)
+        finally:
+            replies.cancel()
+
+    async def _read_replies(self, count: int) -> List[bytes]:
+        replies = []
+        for _ in range(count):
+            line = await self.reader.readline()
+            if not line.endswith(b"\r\n"):
+                raise ConnectionError("Connection closed by the target instance")
+            replies.append(line[:-2])
+        return replies
+
+
+class MigrateConnections:
+    """Connections to MIGRATE targets, kept open for the next batch of keys"""
+
+    def __init__(self):
+        self.connections: Dict[Tuple[str, int], MigrateConnection] = {}
+
+    async def _get(self, host: str, port: int, timeout: float) -> MigrateConnection:
+        connection = self.connections.get((host, port))
+        if connection is None or not connection.usable:
+            reader, writer = await asyncio.wait_for(
+                asyncio.open_connection(host, port), timeout
+            )
+            # Another MIGRATE may have connected while we were waiting
+            existing = self.connections.get((host, port))
+            if existing is not None and existing.usable:
+                writer.close()
+                return existing
+            connection = MigrateConnection(reader, writer)
+            self.connections[(host, port)] = connection
+        return connection
+
+    async def pipeline(
+        self, host: str, port: int, commands: List[bytes], timeout: float
+    ) -> List[bytes]:
+        """Run commands on host:port; the connection is dropped on any error"""
+        connection = await self._get(host, port, timeout)
+        async with connection.lock:
+            try:
+                return await connection.pipeline(commands, timeout)
+            except (OSError, asyncio.TimeoutError):
+                self.close(host, port)
+                raise
+            finally:
+                connection.last_use = time.time()
+
+    def close(self, host: str, port: int) -> None:
+        connection = self.connections.pop((host, port), None)
+        if connection is not None:
+            connection.writer.close()
+
+    def cron(self) -> None:
+        """Close the connections no MIGRATE used for a while"""
+        now = time.time()
+        for (host, port), connection in list(self.connections.items()):
+            idle = now - connection.last_use > MIGRATE_SOCKET_CACHE_TTL
+            if idle and not connection.lock.locked():
+                logger.info(f"Closing the idle MIGRATE connection to {host}:{port}")
+                self.close(host, port)
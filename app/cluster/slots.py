@@ -0,0 +1,32 @@
+"""Hash slots: how cluster mode spreads keys over the nodes"""
+
+import binascii
+
+CLUSTER_SLOTS = 16384
+
+
+def key_hash_slot(key: str) -> int:
+    """CRC16 (XMODEM) of the key modulo 16384, as Redis Cluster computes it
+
+    Only the part inside the first non-empty {hashtag} is hashed, so keys
+    sharing a tag land in the same slot and can be used together.
+    """
+    start = key.find("{")
+    if start != -1:
+        end = key.find("}", start + 1)
+        if end > start + 1:
+            key = key[start + 1 : end]
+    # crc_hqx is CRC-CCITT with the XMODEM parameters when seeded with 0
+    data = key.encode("utf-8", "surrogateescape")
+    return binascii.crc_hqx(data, 0) & (CLUSTER_SLOTS - 1)
+
+
+def slot_ranges(slots) -> list[tuple[int, int]]:
+    """Collapse slot numbers into sorted (start, end) ranges"""
+    ranges = []
+    for slot in sorted(slots):
+        if ranges and ranges[-1][1] == slot - 1:
+            ranges[-1] = (ranges[-1][0], slot)
+        else:
+            ranges.append((slot, slot))
+    return ranges
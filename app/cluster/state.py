@@ -0,0 +1,200 @@
+"""Cluster topology: which node serves which hash slot
+
+The topology is static and read from the cluster config file at startup,
+so several local instances started with the same file form one cluster.
+One node per line:
+
+    # <node-id> <host>:<port> <slot | start-end | [slot->-node-id] | [slot-<-node-id]> ...
+    node-a 127.0.0.1:7000 0-5460
+    node-b 127.0.0.1:7001 5461-10922 [5461-<-node-a]
+    node-c 127.0.0.1:7002 10923-16383
+
+As in Redis's nodes.conf, `[slot->-id]` marks a slot this node is
+migrating to node id and `[slot-<-id]` one it is importing from node id.
+The node whose port matches ours is this node. CLUSTER SETSLOT moves
+slots between nodes at run time, without rewriting the file.
+"""
+
+import logging
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Dict, List, Optional
+from app.cluster.slots import CLUSTER_SLOTS, key_hash_slot, slot_ranges
+
+logger = logging.getLogger(__name__)
+
+CROSSSLOT = b"-CROSSSLOT Keys in request don't hash to the same slot\r\n"
+
+
+@dataclass(eq=False)
+class ClusterNode:
+    id: str
+    host: str
+    port: int
+    slots: set = field(default_factory=set)
+
+
+class ClusterState:
+    def __init__(self, nodes: List[ClusterNode], myself: ClusterNode):
+        self.nodes = {node.id: node for node in nodes}
+        self.myself = myself
+        # Owner of every assigned slot
+        self.slots: List[Optional[ClusterNode]] = [None] * CLUSTER_SLOTS
+        for node in nodes:
+            for slot in node.slots:
+                self.slots[slot] = node
+        # Slots moving out of / into this node, with the node on the other end
+        self.migrating: Dict[int, ClusterNode] = {}
+        self.importing: Dict[int, ClusterNode] = {}
+
+    @classmethod
+    def load(cls, path: Path, host: str, port: int) -> "ClusterState":
+        """Read the topology from the cluster config file"""
+        nodes, transitions = [], []
+        for number, line in enumerate(path.read_text().splitlines(), 1):
+            fields = line.split()
+            if not fields or fields[0].startswith("#"):
+                continue
+            try:
+                node_host, node_port = fields[1].rsplit(":", 1)
+                node = ClusterNode(fields[0], node_host, int(node_port))
+                for spec in fields[2:]:
+                    if spec.startswith("["):
+                        transitions.append((node, spec))
+                    else:
+                        start, _, end = spec.partition("-")
+                        node.slots.update(range(int(start), int(end or start) + 1))
+            except (IndexError, ValueError):
+                raise ValueError(f"Invalid cluster config line {number}: {line!r}")
+            if any(not 0 <= slot < CLUSTER_SLOTS for slot in node.slots):
+                raise ValueError(f"Slot out of range on cluster config line {number}")
+            nodes.append(node)
+
+        candidates = [node for node in nodes if node.port == port]
+        if len(candidates) > 1:
+            candidates = [node for node in candidates if node.host == host]
+        if len(candidates) != 1:
+            raise ValueError(f"Port {port} is not a node of the cluster config {path}")
+
+        state = cls(nodes, candidates[0])
+        for node, spec in transitions:
+            if node is state.myself:
+                state._load_transition(spec)
+        logger.info(
+            f"Cluster mode: {len(nodes)} nodes, "
+            f"{len(state.myself.slots)} slots served by {state.myself.id}"
+        )
+        return state
+
+    def _load_transition(self, spec: str) -> None:
+        """Apply a [slot->-id] or [slot-<-id] entry of this node's line"""
+        body = spec.strip("[]")
+        for marker, table in (("->-", self.migrating), ("-<-", self.importing)):
+            if marker in body:
+                slot, node_id = body.split(marker)
+                if node_id not in self.nodes:
+                    raise ValueError(f"Unknown node {node_id} in {spec}")
+                table[int(slot)] = self.nodes[node_id]
+                return
+        raise ValueError(f"Invalid slot transition {spec}")
+
+    def _node(self, node_id: str) -> ClusterNode:
+        node = self.nodes.get(node_id)
+        if node is None:
+            raise ValueError(f"I don't know about node {node_id}")
+        return node
+
+    def set_migrating(self, slot: int, node_id: str) -> None:
+        """CLUSTER SETSLOT slot MIGRATING node-id"""
+        if self.slots[slot] is not self.myself:
+            raise ValueError(f"I'm not the owner of hash slot {slot}")
+        node = self._node(node_id)
+        if node is self.myself:
+            raise ValueError("Can't MIGRATE to myself")
+        self.migrating[slot] = node
+
+    def set_importing(self, slot: int, node_id: str) -> None:
+        """CLUSTER SETSLOT slot IMPORTING node-id"""
+        if self.slots[slot] is self.myself:
+            raise ValueError(f"I'm already the owner of hash slot {slot}")
+        node = self._node(node_id)
+        if node is self.myself:
+            raise ValueError("Can't IMPORT from myself")
+        self.importing[slot] = node
+
+    def set_stable(self, slot: int) -> None:
+        """CLUSTER SETSLOT slot STABLE: forget a migration in progress"""
+        self.migrating.pop(slot, None)
+        self.importing.pop(slot, None)
+
+    def assign(self, slot: int, node_id: str, keys_left: int) -> None:
+        """CLUSTER SETSLOT slot NODE node-id: the end of a migration"""
+        node = self._node(node_id)
+        if self.slots[slot] is self.myself and node is not self.myself and keys_left:
+            raise ValueError(
+                f"Can't assign hashslot {slot} to a different node "
+                "while I still hold keys for this hash slot."
+            )
+        if node is not self.myself:
+            self.migrating.pop(slot, None)
+        else:
+            self.importing.pop(slot, None)
+
+        owner = self.slots[slot]
+        if owner is not None:
+            owner.slots.discard(slot)
+        node.slots.add(slot)
+        self.slots[slot] = node
+        logger.info(f"Hash slot {slot} is now served by {node.id}")
+
+    def redirect(self, keys: List[str], asking: bool, exists) -> Optional[bytes]:
+        """The redirection error for a command on keys, or None to run it here
+
+        exists(key) tells whether a key is stored locally: during a migration
+        a missing key may already live on the target node.
+        """
+        if not keys:
+            return None
+
+        slot = key_hash_slot(keys[0])
+        if any(key_hash_slot(key) != slot for key in keys[1:]):
+            return CROSSSLOT
+
+        node = self.slots[slot]
+        if node is None:
+            return b"-CLUSTERDOWN Hash slot not served\r\n"
+
+        if node is self.myself:
+            target = self.migrating.get(slot)
+            if target is not None:
+                missing = sum(1 for key in keys if not exists(key))
+                if missing == len(keys):
+                    return f"-ASK {slot} {target.host}:{target.port}\r\n".encode()
+                if missing:
+                    return (
+                        b"-TRYAGAIN Multiple keys request during rehashing of slot\r\n"
+                    )
+            return None
+
+        # A client sent here by ASK may use a slot we are importing
+        if asking and slot in self.importing:
+            return None
+        return f"-MOVED {slot} {node.host}:{node.port}\r\n".encode()
+
+    def shards(self) -> List[tuple]:
+        """(node, slot ranges) for every node, in config order"""
+        return [(node, slot_ranges(node.slots)) for node in self.nodes.values()]
+
+    def info(self) -> str:
+        assigned = sum(1 for node in self.slots if node is not None)
+        return "\n".join(
+            [
+                "# Cluster",
+                "cluster_enabled:1",
+                f"cluster_state:{'ok' if assigned == CLUSTER_SLOTS else 'fail'}",
+                f"cluster_slots_assigned:{assigned}",
+                f"cluster_known_nodes:{len(self.nodes)}",
+                f"cluster_size:{sum(1 for node in self.nodes.values() if node.slots)}",
+                f"cluster_my_slots:{len(self.myself.slots)}",
+            ]
+        )
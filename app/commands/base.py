@@ -7,10 +7,84 @@ from app.protocol.resp_encoder import RESPEncoder
 
 
 class Command(ABC):
+    # Write commands change the dataset, so their effect is logged and replicated
+    write = False
+    # Commands a replica still serves while its data is stale
+    allow_stale = False
+    # May use a slot this cluster node is importing without a prior ASKING
+    asking = False
+    # Awaits other clients or the network: it can't hold its keys' locks, and
+    # the Protocol transport runs it in a task instead of inline
+    blocking = False
+    # CPU-heavy read that may run on the offload thread pool (see
+    # OffloadableCommand)
+    offload = False
+    # Where the key arguments are, as in Redis's command table: the first and
+    # last key position (negative counts from the end) and the step between keys
+    first_key = 0
+    last_key = 0
+    key_step = 1
+
     def __init__(self, args: List[str]):
         self.args = args
         self.encoder = RESPEncoder()
+        # Set by a write command once it changed the dataset
+        self.propagate_args: Optional[List[str]] = None
+
+    @classmethod
+    def get_keys(cls, args: List[str]) -> List[str]:
+        """The keys a call touches, for cluster slot checks"""
+        if not cls.first_key:
+            return []
+        last = cls.last_key if cls.last_key >= 0 else len(args) + cls.last_key
+        return args[cls.first_key : last + 1 : cls.key_step]
 
     @abstractmethod
     def execute(self) -> Optional[bytes]:
         pass
+
+    async def run(self) -> Optional[bytes]:
+        """Execute, then feed a successful write to the AOF and the replicas"""
+        response = await self.execute()
+        if self.write and self.propagate_args is not None:
+            self.db.propagate(self.propagate_args)
+        return response
+
+
+class OffloadableCommand(Command):
+    """A CPU-heavy read, split so the work can leave the event loop
+
+    snapshot() copies what the command reads, on the loop, so the writes
+    made meanwhile don't show; compute() builds the whole reply from that
+    copy, on the offload thread pool when it's worth a thread hop.
+    """
+
+    offload = True
+
+    def check(self) -> Optional[bytes]:
+        """The error reply for bad arguments, before any work is done"""
+        return None
+
+    @abstractmethod
+    def snapshot(self):
+        pass
+
+    @abstractmethod
+    def compute(self, snapshot) -> bytes:
+        pass
+
+    def worth_offloading(self, snapshot) -> bool:
+        """Small inputs take less time to handle than to hand to a thread"""
+        return True
+
+    async def execute(self) -> bytes:
+        return self.check() or self.compute(self.snapshot())
+
+    async def run_offloaded(self, offloader) -> bytes:
+        error = self.check()
+        if error:
+            return error
+        snapshot = self.snapshot()
+        if not self.worth_offloading(snapshot):
+            return self.compute(snapshot)
+        return await offloader.run(self.compute, snapshot)
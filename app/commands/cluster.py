@@ -0,0 +1,432 @@
+import asyncio
+import logging
+import time
+from .base import Command, OffloadableCommand
+from .command_state import CommandState
+from app.database import DataStore
+from app.cluster.slots import CLUSTER_SLOTS, key_hash_slot
+from app.protocol.RDBLoader import RDBLoader
+from app.protocol.RDBWriter import RDBWriter
+from app.streams.streamData import StreamData
+
+logger = logging.getLogger(__name__)
+
+
+class CLUSTERCommand(Command):
+    """CLUSTER <subcommand>: slot hashing, the topology and the keys of a slot"""
+
+    allow_stale = True
+
+    def __init__(self, args, db: DataStore, config):
+        super().__init__(args)
+        self.db = db
+        self.cluster = db.cluster
+
+    async def execute(self):
+        if len(self.args) < 2:
+            return self.encoder.encode_error(
+                "wrong number of arguments for 'cluster' command"
+            )
+
+        subcommand = self.args[1].upper()
+        # KEYSLOT is pure hashing, so it works outside cluster mode too
+        if subcommand == "KEYSLOT" and len(self.args) == 3:
+            return self.encoder.encode_integer(key_hash_slot(self.args[2]))
+
+        if self.cluster is None:
+            return self.encoder.encode_error(
+                "This instance has cluster support disabled"
+            )
+
+        if subcommand == "COUNTKEYSINSLOT" and len(self.args) == 3:
+            slot = self._slot(self.args[2])
+            if slot is None:
+                return self.encoder.encode_error("Invalid slot")
+            return self.encoder.encode_integer(self.db.count_keys_in_slot(slot))
+
+        if subcommand == "GETKEYSINSLOT" and len(self.args) == 4:
+            slot = self._slot(self.args[2])
+            try:
+                count = int(self.args[3])
+            except ValueError:
+                count = -1
+            if slot is None or count < 0:
+                return self.encoder.encode_error("Invalid slot or number of keys")
+            return self.encoder.encode_array(self.db.keys_in_slot(slot, count))
+
+        if subcommand == "SETSLOT" and len(self.args) in (4, 5):
+            return self._setslot()
+        if subcommand == "SLOTS" and len(self.args) == 2:
+            return self._slots()
+        if subcommand == "SHARDS" and len(self.args) == 2:
+            return self._shards()
+        if subcommand == "NODES" and len(self.args) == 2:
+            return self.encoder.encode_bulk_string(self._nodes())
+        if subcommand == "MYID" and len(self.args) == 2:
+            return self.encoder.encode_bulk_string(self.cluster.myself.id)
+        if subcommand == "INFO" and len(self.args) == 2:
+            return self.encoder.encode_bulk_string(self.cluster.info())
+
+        return self.encoder.encode_error(
+            f"Unknown subcommand or wrong number of arguments for '{self.args[1]}'"
+        )
+
+    @staticmethod
+    def _slot(value: str):
+        try:
+            slot = int(value)
+        except ValueError:
+            return None
+        return slot if 0 <= slot < CLUSTER_SLOTS else None
+
+    def _setslot(self) -> bytes:
+        """SETSLOT slot IMPORTING|MIGRATING|NODE node-id, or SETSLOT slot STABLE"""
+        slot = self._slot(self.args[2])
+        if slot is None:
+            return self.encoder.encode_error("Invalid or out of range slot")
+
+        action = self.args[3].upper()
+        try:
+            if action == "STABLE" and len(self.args) == 4:
+                self.cluster.set_stable(slot)
+            elif action == "MIGRATING" and len(self.args) == 5:
+                self.cluster.set_migrating(slot, self.args[4])
+            elif action == "IMPORTING" and len(self.args) == 5:
+                self.cluster.set_importing(slot, self.args[4])
+            elif action == "NODE" and len(self.args) == 5:
+                keys_left = self.db.count_keys_in_slot(slot)
+                self.cluster.assign(slot, self.args[4], keys_left)
+            else:
+                return self.encoder.encode_error(
+                    "Invalid CLUSTER SETSLOT action or number of arguments"
+                )
+        except ValueError as e:
+            return self.encoder.encode_error(str(e))
+        return self.encoder.encode_simple_string("OK")
+
+    def _slots(self) -> bytes:
+        """[start, end, [host, port, id]] for every slot range"""
+        integer = self.encoder.encode_integer
+        ranges = sorted(
+            (
+                (start, end, node)
+                for node, node_ranges in self.cluster.shards()
+                for start, end in node_ranges
+            ),
+            key=lambda entry: entry[0],
+        )
+        return self.encoder.encode_array(
+            [
+                [integer(start), integer(end), [node.host, integer(node.port), node.id]]
+                for start, end, node in ranges
+            ]
+        )
+
+    def _shards(self) -> bytes:
+        integer = self.encoder.encode_integer
+        shards = []
+        for node, ranges in self.cluster.shards():
+            slots = [integer(slot) for start, end in ranges for slot in (start, end)]
+            details = [
+                "id",
+                node.id,
+                "port",
+                integer(node.port),
+                "ip",
+                node.host,
+                "endpoint",
+                node.host,
+                "role",
+                "master",
+                "replication-offset",
+                integer(self._offset(node)),
+                "health",
+                "online",
+            ]
+            shards.append(["slots", slots, "nodes", [details]])
+        return self.encoder.encode_array(shards)
+
+    def _offset(self, node) -> int:
+        # We only know our own replication offset
+        if node is not self.cluster.myself:
+            return 0
+        return self.db._replication_data["master_repl_offset"]
+
+    def _nodes(self) -> str:
+        """One CLUSTER NODES line per node"""
+        lines = []
+        for node, ranges in self.cluster.shards():
+            flags = "myself,master" if node is self.cluster.myself else "master"
+            slots = [
+                str(start) if start == end else f"{start}-{end}"
+                for start, end in ranges
+            ]
+            if node is self.cluster.myself:
+                slots += [
+                    f"[{slot}->-{target.id}]"
+                    for slot, target in self.cluster.migrating.items()
+                ]
+                slots += [
+                    f"[{slot}-<-{source.id}]"
+                    for slot, source in self.cluster.importing.items()
+                ]
+            lines.append(
+                f"{node.id} {node.host}:{node.port}@{node.port + 10000} {flags} - "
+                f"0 0 0 connected {' '.join(slots)}".rstrip()
+            )
+        return "\n".join(lines) + "\n"
+
+
+class ASKINGCommand(Command):
+    """Let the next command use a slot this node is importing, after an ASK"""
+
+    allow_stale = True
+
+    def __init__(self, args, db, config, command_state):
+        super().__init__(args)
+        self.db = db
+        self.command_state = command_state
+
+    async def execute(self):
+        if self.db.cluster is None:
+            return self.encoder.encode_error(
+                "This instance has cluster support disabled"
+            )
+        self.command_state.asking = True
+        return self.encoder.encode_simple_string("OK")
+
+
+class DUMPCommand(OffloadableCommand):
+    """DUMP key: the value serialized in the RDB format"""
+
+    first_key = 1
+    last_key = 1
+    # Strings shorter than this (bytes), and streams with fewer entries,
+    # are serialized on the event loop
+    offload_min_size = 64 * 1024
+    offload_min_entries = 1000
+
+    def __init__(self, args, db: DataStore, config):
+        super().__init__(args)
+        self.db = db
+        self.config = config
+
+    def check(self):
+        if len(self.args) != 2:
+            return self.encoder.encode_error(
+                "wrong number of arguments for 'dump' command"
+            )
+        return None
+
+    def snapshot(self):
+        entry = self.db.get_entry(self.args[1])
+        if entry is None:
+            return None
+        # XADD appends to a stream in place
+        value = entry[0]
+        return value.copy() if isinstance(value, StreamData) else value
+
+    def worth_offloading(self, value) -> bool:
+        if isinstance(value, StreamData):
+            return len(value.entries) >= self.offload_min_entries
+        return isinstance(value, (str, bytes)) and len(value) >= self.offload_min_size
+
+    def compute(self, value) -> bytes:
+        if value is None:
+            return self.encoder.encode_bulk_string(None)
+        payload = RDBWriter.dump_value(value, self.config)
+        return b"$%d\r\n%s\r\n" % (len(payload), payload)
+
+
+class RESTORECommand(Command):
+    """RESTORE key ttl payload [REPLACE] [ABSTTL]: create a key from a DUMP"""
+
+    write = True
+    first_key = 1
+    last_key = 1
+
+    def __init__(self, args, db: DataStore, config):
+        super().__init__(args)
+        self.db = db
+
+    async def execute(self):
+        if len(self.args) < 4:
+            return self.encoder.encode_error(
+                "wrong number of arguments for 'restore' command"
+            )
+
+        key, ttl, payload = self.args[1:4]
+        options = {option.upper() for option in self.args[4:]}
+        if not options <= {"REPLACE", "ABSTTL"}:
+            return self.encoder.encode_error("syntax error")
+        try:
+            ttl = int(ttl)
+        except ValueError:
+            return self.encoder.encode_error("value is not an integer or out of range")
+        if ttl < 0:
+            return self.encoder.encode_error("Invalid TTL value, must be >= 0")
+
+        exists = self.db.get(key) is not None
+        if exists and "REPLACE" not in options:
+            return b"-BUSYKEY Target key name already exists.\r\n"
+
+        try:
+            value = RDBLoader.restore_value(payload.encode("utf-8", "surrogateescape"))
+        except ValueError as e:
+            return self.encoder.encode_error(str(e))
+
+        now = int(time.time() * 1000)
+        expiry = None
+        if ttl:
+            expiry = ttl if "ABSTTL" in options else now + ttl
+
+        if expiry is not None and expiry <= now:
+            # Already expired: all that's left to do is drop the old key
+            if exists and self.db.delete(key):
+                self.propagate_args = ["DEL", key]
+            return self.encoder.encode_simple_string("OK")
+
+        self.db.set(key, value, expiry)
+        # An absolute expiry keeps replays from extending the key's life
+        self.propagate_args = ["RESTORE", key, str(expiry or 0), payload, "REPLACE"]
+        if expiry is not None:
+            self.propagate_args.append("ABSTTL")
+        return self.encoder.encode_simple_string("OK")
+
+
+class RESTOREASKINGCommand(RESTORECommand):
+    """RESTORE sent by MIGRATE, accepted for a slot this node is importing"""
+
+    asking = True
+
+
+class MIGRATECommand(Command):
+    """MIGRATE host port key|"" destination-db timeout [COPY] [REPLACE] [KEYS key ...]
+
+    The keys are sent to the target as one pipeline of RESTORE commands
+    over a connection kept open for the next call, then deleted here.
+    """
+
+    write = True
+    blocking = True
+
+    def __init__(self, args, db: DataStore, config):
+        super().__init__(args)
+        self.db = db
+        self.config = config
+
+    @classmethod
+    def get_keys(cls, args):
+        if len(args) < 6:
+            return []
+        if args[3]:
+            return [args[3]]
+        options = [arg.upper() for arg in args[6:]]
+        if "KEYS" not in options:
+            return []
+        return args[6 + options.index("KEYS") + 1 :]
+
+    async def execute(self):
+        if len(self.args) < 6:
+            return self.encoder.encode_error(
+                "wrong number of arguments for 'migrate' command"
+            )
+
+        copy = replace = False
+        for option in self.args[6:]:
+            option = option.upper()
+            if option == "COPY":
+                copy = True
+            elif option == "REPLACE":
+                replace = True
+            elif option == "KEYS":
+                if self.args[3]:
+                    return self.encoder.encode_error(
+                        "When using MIGRATE KEYS option, the key argument "
+                        "must be set to the empty string"
+                    )
+                break
+            else:
+                return self.encoder.encode_error("syntax error")
+
+        # The cached target connections belong to the main event loop
+        if self.config.threads > 1:
+            return self.encoder.encode_error("MIGRATE is not supported with --threads")
+
+        host = self.args[1]
+        try:
+            port, db_index, timeout = (int(self.args[i]) for i in (2, 4, 5))
+        except ValueError:
+            return self.encoder.encode_error("value is not an integer or out of range")
+        if db_index != 0:
+            return self.encoder.encode_error("Only database 0 can be migrated")
+        timeout = timeout / 1000 if timeout > 0 else 1
+
+        entries = []
+        for key in self.get_keys(self.args):
+            entry = self.db.get_entry(key)
+            if entry is not None:
+                entries.append((key, entry))
+        if not entries:
+            return self.encoder.encode_simple_string("NOKEY")
+
+        keys = [key for key, _ in entries]
+        if not self.db.migrating_keys.isdisjoint(keys):
+            return b"-TRYAGAIN Key being migrated, please try again\r\n"
+
+        # Clients get TRYAGAIN for writes to the keys until the target has
+        # them; the watches catch what still gets through (internal writes)
+        watches = [CommandState() for _ in entries]
+        for key, watch in zip(keys, watches):
+            self.db.watch(key, watch)
+        self.db.migrating_keys.update(keys)
+        try:
+            replies = await self._send(host, port, entries, replace, timeout)
+        except (OSError, asyncio.TimeoutError) as e:
+            logger.error(f"MIGRATE to {host}:{port} failed: {e}")
+            return b"-IOERR error or timeout talking to the target instance\r\n"
+        finally:
+            self.db.migrating_keys.difference_update(keys)
+            for watch in watches:
+                self.db.unwatch(watch)
+
+        moved, changed, error = [], [], None
+        for key, watch, reply in zip(keys, watches, replies):
+            if reply.startswith(b"-"):
+                error = error or reply[1:].decode(errors="replace")
+            elif watch.dirty_cas:
+                changed.append(key)
+            elif not copy:
+                self.db.delete(key)
+                moved.append(key)
+        if moved:
+            self.propagate_args = ["DEL", *moved]
+
+        if error:
+            return self.encoder.encode_error(
+                f"Target instance replied with error: {error}"
+            )
+        if changed:
+            # The target's copy is stale: the key stays here, and on both nodes
+            return self.encoder.encode_error(
+                "Keys changed while being migrated, not moved: " + " ".join(changed)
+            )
+        return self.encoder.encode_simple_string("OK")
+
+    async def _send(self, host, port, entries, replace, timeout):
+        """Pipeline one RESTORE per key and return the target's replies"""
+        # Only a cluster node needs ASKING semantics to accept the keys
+        restore = "RESTORE-ASKING" if self.db.cluster is not None else "RESTORE"
+        now = time.time() * 1000
+        commands = []
+        for key, (value, expiry) in entries:
+            ttl = max(int(expiry - now), 1) if expiry else 0
+            payload = RDBWriter.dump_value(value, self.config)
+            args = [restore, key, str(ttl), b"$%d\r\n%s\r\n" % (len(payload), payload)]
+            if replace:
+                args.append("REPLACE")
+            commands.append(self.encoder.encode_array(args))
+
+        return await self.db.migrate_connections.pipeline(
+            host, port, commands, timeout
+        )
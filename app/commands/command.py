@@ -1,26 +1,50 @@
 """Command Module"""
 
 import logging
+from typing import Optional
 from app.database import DataStore
 from app.utils.config import RedisServerConfig
-from .connection import PINGCommand, ECHOCommand
+from .connection import PINGCommand, ECHOCommand, READONLYCommand, READWRITECommand
 from app.protocol.resp_encoder import RESPEncoder
+from app.workers.channels import CROSSWORKER
 from .strings import (
     GETCommand,
     SETCommand,
+    DELCommand,
     KEYSCommand,
     INFOCommand,
     INCRCommand,
     MULTICommand,
     EXECCommand,
     DISCARDCommand,
+    WATCHCommand,
+    UNWATCHCommand,
     TYPECommand,
     XADDCommand,
     XRANGECommand,
     XREADCommand,
 )
 from .server import ConfigCommand
-from .replication import REPLCONFCommand, PSYNCCommand, WAITCommand
+from .persistence import (
+    SAVECommand,
+    BGSAVECommand,
+    LASTSAVECommand,
+    BGREWRITEAOFCommand,
+)
+from .cluster import (
+    CLUSTERCommand,
+    ASKINGCommand,
+    DUMPCommand,
+    RESTORECommand,
+    RESTOREASKINGCommand,
+    MIGRATECommand,
+)
+from .replication import (
+    REPLCONFCommand,
+    PSYNCCommand,
+    REPLICAOFCommand,
+    WAITCommand,
+)
 
 
 class CommandHandler:
@@ -35,61 +59,267 @@ class CommandHandler:
         self.commands = {
             "PING": PINGCommand,
             "ECHO": ECHOCommand,
+            "READONLY": READONLYCommand,
+            "READWRITE": READWRITECommand,
             "GET": GETCommand,
             "SET": SETCommand,
+            "DEL": DELCommand,
             "KEYS": KEYSCommand,
             "CONFIG": ConfigCommand,
             "INFO": INFOCommand,
             "REPLCONF": REPLCONFCommand,
             "PSYNC": PSYNCCommand,
             "WAIT": WAITCommand,
+            "REPLICAOF": REPLICAOFCommand,
+            "SLAVEOF": REPLICAOFCommand,
             "INCR": INCRCommand,
             "MULTI": MULTICommand,
             "EXEC": EXECCommand,
             "DISCARD": DISCARDCommand,
+            "WATCH": WATCHCommand,
+            "UNWATCH": UNWATCHCommand,
             "TYPE": TYPECommand,
             "XADD": XADDCommand,
             "XRANGE": XRANGECommand,
             "XREAD": XREADCommand,
+            "SAVE": SAVECommand,
+            "BGSAVE": BGSAVECommand,
+            "LASTSAVE": LASTSAVECommand,
+            "BGREWRITEAOF": BGREWRITEAOFCommand,
+            "CLUSTER": CLUSTERCommand,
+            "ASKING": ASKINGCommand,
+            "DUMP": DUMPCommand,
+            "RESTORE": RESTORECommand,
+            "RESTORE-ASKING": RESTOREASKINGCommand,
+            "MIGRATE": MIGRATECommand,
         }
 
+    def _replica_refusal(self, command_class, command_state) -> Optional[bytes]:
+        """The error a replica answers a client's command with, if any"""
+        link = self.db.master_link
+        if not self.config.replicaof or link is None or command_class.allow_stale:
+            return None
+
+        if command_class.write and self.config.replica_read_only:
+            return b"-READONLY You can't write against a read only replica.\r\n"
+        if not link.link_up and not self.config.replica_serve_stale_data:
+            return (
+                b"-MASTERDOWN Link with MASTER is down and "
+                b"replica-serve-stale-data is set to 'no'.\r\n"
+            )
+        if command_state.max_lag is not None and link.lag() > command_state.max_lag:
+            return (
+                f"-STALE Replica lag exceeds the {command_state.max_lag:g}s "
+                "allowed by READONLY MAXLAG\r\n"
+            ).encode()
+        return None
+
+    def _cluster_redirect(self, command_class, args, command_state) -> Optional[bytes]:
+        """MOVED, ASK or CROSSSLOT when the keys are not all served here"""
+        # ASKING only holds for the command right after it
+        asking = command_state.asking or command_class.asking
+        command_state.asking = False
+
+        keys = command_class.get_keys(args)
+        # A transaction's keys all have to live in one slot served here
+        if command_class is EXECCommand:
+            keys = [
+                key
+                for queued in command_state.command_queue or ()
+                for key in self.commands[queued[0].upper()].get_keys(queued)
+            ]
+        return self.db.cluster.redirect(
+            keys, asking, lambda key: self.db.get(key) is not None
+        )
+
+    def _migrating_refusal(self, command_class, args, command_state):
+        """TRYAGAIN for a write to a key MIGRATE is moving to another node"""
+        if command_class is EXECCommand:
+            keys = [
+                key
+                for queued in command_state.command_queue or ()
+                if self.commands[queued[0].upper()].write
+                for key in self.commands[queued[0].upper()].get_keys(queued)
+            ]
+        elif command_class.write:
+            keys = command_class.get_keys(args)
+        else:
+            return None
+        if self.db.migrating_keys.isdisjoint(keys):
+            return None
+        return b"-TRYAGAIN Key being migrated, please try again\r\n"
+
+    def _worker_route(self, command_class, args, command_state):
+        """(error, None), or (None, the other worker to forward to or None)"""
+        workers = self.db.workers
+        owner = workers.owner(command_class.get_keys(args))
+        if owner is None:
+            return CROSSWORKER, None
+        if owner == workers.worker_id:
+            return None, None
+        # Transactions run on the worker of the connection, with its keys only
+        if command_state.should_be_queued or command_class is WATCHCommand:
+            return (
+                self.encoder.encode_error(
+                    "Transactions can only use keys of this connection's worker"
+                ),
+                None,
+            )
+        return None, owner
+
+    @staticmethod
+    def _unwrap(args):
+        """Strip the "-p <port>" prefix some clients send before a command"""
+        if len(args) > 2 and args[0] == "-p" and args[1]:
+            return args[2:]
+        return args
+
+    def _blocks(self, command_class, command_state) -> bool:
+        """Whether a call may await; EXEC does if a queued command does"""
+        if command_class is not EXECCommand:
+            return command_class.blocking
+        return any(
+            self.commands[queued[0].upper()].blocking
+            for queued in command_state.command_queue or ()
+        )
+
+    def _offloads(self, command_class) -> bool:
+        """Whether a call goes to the offload thread pool (not within EXEC)"""
+        return command_class.offload and self.db.offloader.enabled
+
+    def may_block(self, args, command_state) -> bool:
+        """Whether handle_command(args) may await instead of running straight
+        through, so the Protocol transport has to give it a task"""
+        # Forwarding to another worker awaits its reply
+        if self.db.workers is not None:
+            return True
+        command_class = self.commands.get(self._unwrap(args)[0].upper())
+        if command_class is None:
+            return False
+        # Inside MULTI, commands are only queued
+        if command_state.should_be_queued and command_class is not EXECCommand:
+            return False
+        return self._blocks(command_class, command_state) or self._offloads(
+            command_class
+        )
+
+    def _keys_to_lock(self, command_class, args, command_state) -> list:
+        """The keys whose shard locks a call holds while it runs (--threads)
+
+        A transaction locks the keys of every queued command up front, so it
+        runs as a whole; one that would block can't hold locks and doesn't.
+        An offloaded command only holds them while it takes its snapshot.
+        """
+        if self._blocks(command_class, command_state) or self._offloads(
+            command_class
+        ):
+            return []
+        if command_class is not EXECCommand:
+            return command_class.get_keys(args)
+
+        return [
+            key
+            for queued in command_state.command_queue or ()
+            for key in self.commands[queued[0].upper()].get_keys(queued)
+        ]
+
     async def handle_command(self, args, command_state, writer=None):
 
+        args = self._unwrap(args)
         command_name = args[0].upper()
 
-        if len(args) > 2:
-            if args[0] == "-p" and args[1]:
-                command_name = args[2].upper()
-                args = args[2:]
-
-        print("Arguments", args)
         command_class = self.commands.get(command_name)
 
         # Handle Error if command is not found
         if not command_class:
+            # A transaction with an unknown command can't run as a whole
+            if command_state.should_be_queued:
+                command_state.queue_error = True
             logging.error(f"Command not found: {command_name}")
             return self.encoder.encode_error(f"Command not found: {command_name}")
 
-        # Handle MULTI Command
-        if command_name == "MULTI":
-            command_state.should_be_queued = True
-            command = command_class(args, self.db, self.config)
-            return await command.execute()
+        worker = None
+        if not command_state.internal:
+            refusal = self._replica_refusal(command_class, command_state)
+            if refusal is None and self.db.cluster is not None:
+                refusal = self._cluster_redirect(command_class, args, command_state)
+                # A transaction that can't run here is dropped at EXEC
+                if refusal and command_name == "EXEC":
+                    command_state.reset_transaction()
+                    self.db.unwatch(command_state)
+            # Checked when the write runs: queued ones at EXEC
+            if (
+                refusal is None
+                and self.db.migrating_keys
+                and (not command_state.should_be_queued or command_name == "EXEC")
+            ):
+                refusal = self._migrating_refusal(command_class, args, command_state)
+                if refusal and command_name == "EXEC":
+                    command_state.reset_transaction()
+                    self.db.unwatch(command_state)
+            if refusal is None and self.db.workers is not None:
+                refusal, worker = self._worker_route(command_class, args, command_state)
+            if refusal:
+                if command_state.should_be_queued:
+                    command_state.queue_error = True
+                return refusal
 
-        # Handle EXEC Command
-        if command_name in ("EXEC", "DISCARD"):
+        # Inside MULTI, commands are kept as arguments until EXEC runs them
+        if command_state.should_be_queued and command_name not in (
+            "MULTI",
+            "EXEC",
+            "DISCARD",
+            "WATCH",
+        ):
+            command_state.command_queue.append(args)
+            return self.encoder.encode_simple_string("QUEUED")
+
+        if worker is not None:
+            return await self.db.workers.forward(worker, args)
+        if self.db.sharded:
+            # Nothing in a non-blocking command awaits, so the locks are never
+            # held across a switch to another client of this thread's loop
+            keys = self._keys_to_lock(command_class, args, command_state)
+            with self.db.locked(keys):
+                return await self.execute(args, command_state, writer)
+        return await self.execute(args, command_state, writer)
+
+    async def execute(self, args, command_state, writer=None, inline=False):
+        """Run one command, already checked and looked up, for a client
+
+        inline keeps a CPU-heavy command on the loop: EXEC's commands run
+        with no other client in between.
+        """
+        command_name = args[0].upper()
+        command_class = self.commands[command_name]
+
+        # EXEC runs the queued commands through this same path
+        if command_name == "EXEC":
+            command = command_class(
+                args, self.db, self.config, command_state, self, writer
+            )
+        # Transactions, WATCH, READONLY and READWRITE change the client's state
+        elif command_name in (
+            "MULTI",
+            "DISCARD",
+            "WATCH",
+            "UNWATCH",
+            "ASKING",
+            "READONLY",
+            "READWRITE",
+        ):
+            command = command_class(args, self.db, self.config, command_state)
+        # WAIT waits for the replicas to reach this client's last write
+        elif command_name == "WAIT":
             command = command_class(
                 args,
                 self.db,
                 self.config,
-                command_state.should_be_queued,
-                command_state.command_queue,
+                writer,
+                command_state.last_write_offset,
             )
-            command_state.should_be_queued = False
-            return await command.execute()
-
-        # Handle PSYNC, REPLCONF, WAIT, etc.. command
-        if command_name in ["PSYNC", "REPLCONF", "WAIT"]:
+        # Handle PSYNC, REPLCONF, etc.. command
+        elif command_name in ["PSYNC", "REPLCONF"]:
             command = command_class(
                 args,
                 self.db,
@@ -100,9 +330,12 @@ class CommandHandler:
         else:
             command = command_class(args, self.db, self.config)
 
-        # Handle the commands if the MULTI command has been sent before
-        if command_state.should_be_queued:
-            await command_state.command_queue.put(command.execute())
-            return self.encoder.encode_simple_string("QUEUED")
-        else:
-            return await command.execute()
+        if not inline and self._offloads(command_class):
+            return await command.run_offloaded(self.db.offloader)
+
+        response = await command.run()
+        if command.propagate_args is not None:
+            command_state.last_write_offset = self.db._replication_data[
+                "master_repl_offset"
+            ]
+        return response
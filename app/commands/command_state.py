@@ -1,14 +1,32 @@
-import asyncio
 from dataclasses import dataclass
+from typing import List, Optional, Set
 
 
-@dataclass
+# eq=False keeps identity hashing, so a state can sit in the database's watch sets.
+# Every connection has one, so it has slots, and the transaction's containers
+# are only allocated by MULTI and WATCH.
+@dataclass(eq=False, slots=True)
 class CommandState:
     should_be_queued: bool = False
-    command_queue: asyncio.Queue = None
+    # Arguments of the commands queued by MULTI, run together by EXEC
+    command_queue: Optional[List[List[str]]] = None
+    # A command failed to queue, so EXEC discards the transaction
+    queue_error: bool = False
+    # Keys WATCHed by this client, and whether one changed since
+    watched_keys: Optional[Set[str]] = None
+    dirty_cas: bool = False
+    # Replication offset right after this client's latest write, for WAIT
+    last_write_offset: int = 0
+    # Commands replayed from our master or the AOF, or routed here by another
+    # worker, rather than sent by a client
+    internal: bool = False
+    # READONLY MAXLAG: the staleness, in seconds, this client accepts from a replica
+    max_lag: Optional[float] = None
+    # Sent ASKING: the next command may use a slot this node is importing
+    asking: bool = False
 
-    def __post_init__(self):
-        # Create a new queue for each instance
-
-        if self.command_queue is None:
-            self.command_queue = asyncio.Queue()
+    def reset_transaction(self) -> None:
+        """Leave MULTI, dropping the queued commands"""
+        self.should_be_queued = False
+        self.command_queue = None
+        self.queue_error = False
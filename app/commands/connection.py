@@ -4,6 +4,8 @@ from .base import Command
 
 
 class PINGCommand(Command):
+    allow_stale = True
+
     def __init__(self, args, db, config):
         super().__init__(args)
 
@@ -19,3 +21,42 @@ class ECHOCommand(Command):
         if len(self.args) < 2:
             return self.encoder.encode_error("ECHO command requires an argument")
         return self.encoder.encode_bulk_string(self.args[1])
+
+
+class READONLYCommand(Command):
+    """READONLY [MAXLAG seconds]: accept replica reads, optionally bounded in lag"""
+
+    allow_stale = True
+
+    def __init__(self, args, db, config, command_state):
+        super().__init__(args)
+        self.command_state = command_state
+
+    async def execute(self):
+        max_lag = None
+        if len(self.args) == 3 and self.args[1].upper() == "MAXLAG":
+            try:
+                max_lag = float(self.args[2])
+            except ValueError:
+                return self.encoder.encode_error("MAXLAG must be a number of seconds")
+            if max_lag < 0:
+                return self.encoder.encode_error("MAXLAG can't be negative")
+        elif len(self.args) != 1:
+            return self.encoder.encode_error("syntax error")
+
+        self.command_state.max_lag = max_lag
+        return self.encoder.encode_simple_string("OK")
+
+
+class READWRITECommand(Command):
+    """Drop the lag bound set with READONLY"""
+
+    allow_stale = True
+
+    def __init__(self, args, db, config, command_state):
+        super().__init__(args)
+        self.command_state = command_state
+
+    async def execute(self):
+        self.command_state.max_lag = None
+        return self.encoder.encode_simple_string("OK")
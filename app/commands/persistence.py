@@ -0,0 +1,74 @@
+"""Setup Commands for RDB Persistence"""
+
+import logging
+from .base import Command
+from app.database import DataStore
+
+logger = logging.getLogger(__name__)
+
+
+class SAVECommand(Command):
+    """Synchronously write the dataset to disk"""
+
+    def __init__(self, args, db: DataStore, config):
+        super().__init__(args)
+        self.db = db
+
+    async def execute(self):
+        if self.db.persistence.bgsave_in_progress:
+            return self.encoder.encode_error("Background save already in progress")
+
+        try:
+            self.db.persistence.save()
+        except Exception as e:
+            logger.error(f"SAVE failed: {e}")
+            return self.encoder.encode_error(f"Failed to save the DB: {e}")
+        return self.encoder.encode_simple_string("OK")
+
+
+class BGSAVECommand(Command):
+    """Write the dataset to disk from a forked child process"""
+
+    def __init__(self, args, db: DataStore, config):
+        super().__init__(args)
+        self.db = db
+
+    async def execute(self):
+        try:
+            self.db.persistence.bgsave()
+        except Exception as e:
+            return self.encoder.encode_error(str(e))
+        return self.encoder.encode_simple_string("Background saving started")
+
+
+class LASTSAVECommand(Command):
+    """Unix time of the last successful save"""
+
+    def __init__(self, args, db: DataStore, config):
+        super().__init__(args)
+        self.db = db
+
+    async def execute(self):
+        return self.encoder.encode_integer(self.db.persistence.lastsave)
+
+
+class BGREWRITEAOFCommand(Command):
+    """Compact the append only file from a forked child process"""
+
+    def __init__(self, args, db: DataStore, config):
+        super().__init__(args)
+        self.db = db
+
+    async def execute(self):
+        try:
+            self.db.aof.rewrite()
+        except Exception as e:
+            return self.encoder.encode_error(str(e))
+
+        if self.db.aof.rewrite_scheduled:
+            return self.encoder.encode_simple_string(
+                "Background append only file rewriting scheduled"
+            )
+        return self.encoder.encode_simple_string(
+            "Background append only file rewriting started"
+        )
@@ -1,14 +1,17 @@
-import time
 import asyncio
 import logging
 from .base import Command
 from app.utils.config import RedisServerConfig
 from app.database import DataStore
+from app.replication.master import FullSync, partial_sync
 
 logger = logging.getLogger(__name__)
 
 
 class REPLCONFCommand(Command):
+    allow_stale = True
+    blocking = True
+
     def __init__(
         self,
         args,
@@ -22,8 +25,6 @@ class REPLCONFCommand(Command):
         self.writer = writer
 
     async def execute(self):
-        print("Okay, I am here.")
-
         if len(self.args) > 2 and self.args[1].upper() == "GETACK":
             if self.args[2] == "*":
                 self.writer.write(
@@ -36,108 +37,168 @@ class REPLCONFCommand(Command):
                     )
                 )
                 await self.writer.drain()
+        elif len(self.args) > 2 and self.args[1].lower() == "listening-port":
+            try:
+                self.db.replica_ports[self.writer] = int(self.args[2])
+            except ValueError:
+                return self.encoder.encode_error("Invalid listening port")
+            return self.encoder.encode_simple_string("OK")
         elif len(self.args) > 2 and self.args[1].upper() == "ACK":
-            print("Have I entered here?")
-            self.db.ack_replicas[id(self.writer)] = "acknowledged"
+            try:
+                self.db.acknowledge(self.writer, int(self.args[2]))
+            except ValueError:
+                logger.error(f"Invalid REPLCONF ACK offset: {self.args[2]}")
         else:
+            # REPLCONF capa <capability> [capa <capability> ...]
+            for i in range(1, len(self.args) - 1, 2):
+                if self.args[i].lower() == "capa":
+                    capabilities = self.db.replica_capabilities.setdefault(
+                        self.writer, set()
+                    )
+                    capabilities.add(self.args[i + 1].lower())
+
             return self.encoder.encode_simple_string("OK")
 
 
 class PSYNCCommand(Command):
+    blocking = True
+
     def __init__(self, args, db: "DataStore", config, writer: asyncio.StreamWriter):
         super().__init__(args)
         self.db = db
+        self.config = config
         self.writer = writer
 
-    def _resynchronize(self):
-        content = bytes.fromhex(self.db._dummy_empty_rdb)
+    async def execute(self):
+        if len(self.args) < 3:
+            return self.encoder.encode_error(
+                "wrong number of arguments for 'psync' command"
+            )
 
-        return f"${len(content)}\r\n".encode() + content
+        replid, offset = self.args[1], self.args[2]
+        try:
+            offset = int(offset)
+        except ValueError:
+            return self.encoder.encode_error("value is not an integer or out of range")
 
-    async def execute(self):
-        response = self.encoder.encode_simple_string(
-            f"FULLRESYNC {self.db._replication_data.get("master_replid")} {self.db._replication_data.get("master_repl_offset")}"
-        )
+        # Each worker only holds a shard, so none of them has a dataset to sync
+        if self.config.workers > 1:
+            return self.encoder.encode_error(
+                "Replication is not supported with --workers"
+            )
+        # Replica links are written to from the loop of whichever client wrote
+        if self.config.threads > 1:
+            return self.encoder.encode_error(
+                "Replication is not supported with --threads"
+            )
 
-        self.writer.write(response)
-        await self.writer.drain()
-        rdb_content = self._resynchronize()
+        # A replica passes on its master's stream, so it needs to be in sync first
+        link = self.db.master_link
+        if self.config.replicaof and (link is None or not link.link_up):
+            return b"-NOMASTERLINK Can't SYNC while not connected with my master\r\n"
 
-        self.writer.write(rdb_content)
-        await self.writer.drain()
+        if replid != "?" and self.db.can_partial_resync(replid, offset):
+            await partial_sync(self.db, self.writer, self.encoder, offset)
+            return None
 
-        self.db.replicas.add(self.writer)
-        self.db.ack_replicas[id(self.writer)] = None
+        # Replicas that can take an EOF-marked payload get the RDB streamed
+        # straight from a forked child; the others get a BGSAVE file
+        capabilities = self.db.replica_capabilities.get(self.writer, set())
+        diskless = self.config.repl_diskless_sync and "eof" in capabilities
 
+        await FullSync(self.db, self.writer, self.encoder).run(diskless)
         return None
 
 
+class REPLICAOFCommand(Command):
+    allow_stale = True
+
+    def __init__(self, args, db: "DataStore", config: "RedisServerConfig"):
+        super().__init__(args)
+        self.db = db
+        self.config = config
+
+    async def execute(self):
+        if len(self.args) != 3:
+            return self.encoder.encode_error(
+                "wrong number of arguments for 'replicaof' command"
+            )
+
+        if self.db.master_link is not None:
+            self.db.master_link.stop()
+            self.db.master_link = None
+
+        if self.args[1].upper() == "NO" and self.args[2].upper() == "ONE":
+            if self.config.replicaof:
+                # Keep the old history as replid2 so our replicas can continue
+                self.config.replicaof = None
+                self.db._replication_data["role"] = "master"
+                self.db.shift_replid()
+                # Reconnecting makes our replicas pick up the new replid
+                self.db.disconnect_replicas()
+                logger.info("Promoted to master")
+            return self.encoder.encode_simple_string("OK")
+
+        try:
+            port = int(self.args[2])
+        except ValueError:
+            return self.encoder.encode_error("Invalid master port")
+
+        # Imported here: the replica module itself depends on the command table
+        from app.replication.replica import RedisReplica
+
+        self.config.replicaof = {"host": self.args[1], "port": port}
+        self.db._replication_data["role"] = "slave"
+        self.db.disconnect_replicas()
+        RedisReplica(self.config, self.db).start()
+        logger.info(f"Replicating {self.args[1]}:{port}")
+        return self.encoder.encode_simple_string("OK")
+
+
 class WAITCommand(Command):
+    blocking = True
+
     def __init__(
-        self, args, db: DataStore, config, writer: asyncio.StreamWriter = None
+        self,
+        args,
+        db: DataStore,
+        config,
+        writer: asyncio.StreamWriter = None,
+        last_write_offset: int = 0,
     ):
         super().__init__(args)
         self.config = config
         self.db = db
         self.writer = writer
-        self.sent_acks = set()
-        logger.info("WAITCommand initialized with writer: %s", writer is not None)
+        self.last_write_offset = last_write_offset
 
     async def execute(self):
-        if len(self.args) < 3:
-            raise ValueError(
-                "WAIT command requires exactly two arguments: numreplicas and timeout"
+        if len(self.args) != 3:
+            return self.encoder.encode_error(
+                "wrong number of arguments for 'wait' command"
             )
-
-        num_replicas = int(self.args[1])
-        timeout = int(self.args[2])
-        start_time = time.time()
-
-        for key in self.db.ack_replicas:
-            self.db.ack_replicas[key] = None
-
-        self.sent_acks.clear()
-
-        if self.db.should_acknowledge:
-            while (time.time() - start_time) * 1000 < timeout:
-                replicas = list(self.db.replicas)
-                for replica in replicas:
-                    replica_id = id(replica)
-
-                    if (
-                        replica_id not in self.sent_acks
-                        and self.db.ack_replicas[replica_id] is None
-                        and replica_id in self.db.ack_replicas
-                    ):
-                        try:
-                            print(self.db.ack_replicas)
-                            ack_cmd = self.encoder.encode_array(
-                                ["REPLCONF", "GETACK", "*"]
-                            )
-                            replica.write(ack_cmd)
-                            await replica.drain()
-                            self.sent_acks.add(replica_id)
-                        except Exception as e:
-                            logger.error(
-                                f"Failed to get ACK from replica with error: {e}"
-                            )
-                            if replica in self.db.replicas:
-                                self.db.replicas.remove(replica)
-                            if id(replica) in self.db.ack_replicas:
-                                del self.db.ack_replicas[id(replica)]
-
-                ack_count = sum(
-                    1 for ack in self.db.ack_replicas if ack == "acknowledged"
-                )
-                if ack_count >= num_replicas:
-                    return self.encoder.encode_integer(ack_count)
-
-                await asyncio.sleep(0.1)
-
-            result = sum(
-                1 for ack in self.db.ack_replicas.values() if ack == "acknowledged"
+        if self.config.replicaof:
+            return self.encoder.encode_error(
+                "WAIT cannot be used with replica instances"
             )
-            print("The result is ", result)
-            return self.encoder.encode_integer(result)
 
-        return self.encoder.encode_integer(len(self.db.replicas))
+        try:
+            num_replicas = int(self.args[1])
+            timeout = int(self.args[2])
+        except ValueError:
+            return self.encoder.encode_error("value is not an integer or out of range")
+
+        acked = self.db.count_acked(self.last_write_offset)
+        if acked >= num_replicas:
+            return self.encoder.encode_integer(acked)
+
+        # A timeout of 0 blocks until enough replicas caught up
+        future = self.db.wait_for_acks(self.last_write_offset, num_replicas)
+        try:
+            await asyncio.wait_for(future, timeout / 1000 if timeout > 0 else None)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            self.db.remove_ack_waiter(future)
+
+        return self.encoder.encode_integer(self.db.count_acked(self.last_write_offset))
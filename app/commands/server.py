@@ -3,6 +3,8 @@ from app.utils.config import RedisServerConfig
 
 
 class ConfigCommand(Command):
+    allow_stale = True
+
 
     def __init__(self, args, db, config: "RedisServerConfig"):
         super().__init__(args)
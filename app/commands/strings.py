@@ -1,5 +1,7 @@
 import asyncio
-from .base import Command
+import fnmatch
+import re
+from .base import Command, OffloadableCommand
 from ..database import DataStore
 import time
 import logging
@@ -9,6 +11,9 @@ logger = logging.getLogger(__name__)
 
 
 class GETCommand(Command):
+    first_key = 1
+    last_key = 1
+
     def __init__(self, args, db: "DataStore", config):
         super().__init__(args)
         self.db = db
@@ -22,6 +27,10 @@ class GETCommand(Command):
 
 
 class SETCommand(Command):
+    write = True
+    first_key = 1
+    last_key = 1
+
     def __init__(self, args, db: "DataStore", config):
         super().__init__(args)
         self.db = db
@@ -35,84 +44,103 @@ class SETCommand(Command):
             key, value = self.args[1], self.args[2]
             expiry = None
 
-            if len(self.args) > 3 and self.args[3].upper() == "PX":
+            if len(self.args) > 3 and self.args[3].upper() in ("PX", "PXAT"):
                 try:
                     px = int(self.args[4])
-                    expiry = time.time() * 1000 + px
+                    if self.args[3].upper() == "PX":
+                        expiry = time.time() * 1000 + px
+                    else:
+                        expiry = px
 
                 except (IndexError, ValueError):
                     return self.encoder.encode_error("Invalid PX value")
 
             self.db.set(key, value, expiry)
-            if self.config.replicaof:
-                return
-
-            async with self.db.lock:
-                replicas = list(self.db.replicas)
-
-            for replica in replicas:
-                try:
-                    logger.info("Propagating to replica....")
-                    replica.write(self.encoder.encode_array(self.args))
-                    await replica.drain()
 
-                    self.db.should_acknowledge = True
-                except Exception as e:
-                    logger.error(f"Error propagating to replica: {e}")
+            # Relative expiries are logged as absolute ones so a replay keeps them
+            self.propagate_args = ["SET", key, value]
+            if expiry is not None:
+                self.propagate_args += ["PXAT", str(int(expiry))]
 
             return self.encoder.encode_simple_string("OK")
         except Exception as e:
             logger.error(f"Got Error: {e}")
-        # finally:
-        #     # Propagating as a background process
-        #     await self._propagate_to_replicas()
-
-    # async def _propagate_to_replicas(self):
-    #     tasks = [self._propagate_to_replica(replica) for replica in self.db.replicas]
-    #     try:
-    #         await asyncio.gather(*tasks)
-    #     except Exception as e:
-    #         logger.error("Error propagating")
-    #         raise
-
-    # async def _propagate_to_replica(self, replica):
-    #     try:
-    #         logger.info("Propagating to replica....")
-    #         replica.write(self.encoder.encode_array(self.args))
-    #         await replica.drain()
-
-    #     except Exception as e:
-    #         logger.error(f"Error propagating to replica: {e}")
-    #         raise
-
-
-class KEYSCommand(Command):
+
+
+class KEYSCommand(OffloadableCommand):
+    """KEYS pattern: the live keys matching a glob-style pattern"""
+
+    # Keyspaces smaller than this are matched on the event loop
+    offload_min_keys = 1000
+
     def __init__(self, args, db: "DataStore", config):
         super().__init__(args)
         self.db = db
 
-    async def execute(self) -> bytes:
-        print("Ariguments in args", self.args)
-        print("Length of keys", self.db.keys())
+    def check(self):
         if len(self.args) < 2:
             return self.encoder.encode_error("Invalid Pattern")
-        else:
-            return self.encoder.encode_array(self.db.keys())
+        return None
+
+    def snapshot(self):
+        return time.time() * 1000, self.db.snapshot()
+
+    def worth_offloading(self, snapshot) -> bool:
+        return len(snapshot[1]) >= self.offload_min_keys
+
+    def compute(self, snapshot) -> bytes:
+        now, entries = snapshot
+        pattern = self.args[1]
+        match = None
+        if pattern != "*":
+            match = re.compile(fnmatch.translate(pattern)).match
+        return self.encoder.encode_array(
+            [
+                key
+                for key, (_, expiry) in entries
+                if (not expiry or expiry > now) and (match is None or match(key))
+            ]
+        )
 
 
 class INFOCommand(Command):
+    allow_stale = True
+
     def __init__(self, args, db: "DataStore", config):
         super().__init__(args)
         self.db = db
 
     async def execute(self) -> bytes:
+        section = self.args[1] if len(self.args) > 1 else None
+        return self.encoder.encode_bulk_string(self.db.info(section))
+
+
+class DELCommand(Command):
+    write = True
+    first_key = 1
+    last_key = -1
+
+    def __init__(self, args, db: DataStore, config):
+        super().__init__(args)
+        self.db = db
+
+    async def execute(self):
         if len(self.args) < 2:
-            self.encoder.encode_error("INFO requires an argument")
-        else:
-            return self.encoder.encode_bulk_string(self.db.info())
+            return self.encoder.encode_error(
+                "wrong number of arguments for 'del' command"
+            )
+
+        deleted = [key for key in self.args[1:] if self.db.delete(key)]
+        if deleted:
+            self.propagate_args = ["DEL", *deleted]
+        return self.encoder.encode_integer(len(deleted))
 
 
 class INCRCommand(Command):
+    write = True
+    first_key = 1
+    last_key = 1
+
     def __init__(self, args, db: DataStore, config):
         super().__init__(args)
         self.db = db
@@ -128,6 +156,7 @@ class INCRCommand(Command):
             if not self.db.get(key):
                 value = 1
                 self.db.set(key, value, expiry)
+                self.propagate_args = self.args
                 return self.encoder.encode_integer(value)
 
             value = self.db.get(key)
@@ -136,6 +165,7 @@ class INCRCommand(Command):
             try:
                 result = int(value) + 1
                 self.db.set(key, result, expiry)
+                self.propagate_args = self.args
                 return self.encoder.encode_integer(result)
             except Exception:
                 return self.encoder.encode_error(
@@ -147,62 +177,130 @@ class INCRCommand(Command):
 
 
 class MULTICommand(Command):
-    def __init__(self, args, db: DataStore, config):
+    allow_stale = True
+
+    def __init__(self, args, db: DataStore, config, command_state):
         super().__init__(args)
+        self.command_state = command_state
 
     async def execute(self):
+        if self.command_state.should_be_queued:
+            return self.encoder.encode_error("MULTI calls can not be nested")
+
+        self.command_state.should_be_queued = True
+        self.command_state.command_queue = []
         return self.encoder.encode_simple_string("OK")
 
 
 class EXECCommand(Command):
-    def __init__(self, args, db: DataStore, config, should_be_queued, queue):
-        super().__init__(args)
-        self.should_be_queued = should_be_queued
-        self.queue = queue
+    """Run the queued commands back to back, unless a WATCHed key changed"""
 
-    async def execute(self):
-        if self.should_be_queued == False:
-            return self.encoder.encode_error(f"EXEC without MULTI")
+    allow_stale = True
 
-        if self.queue.empty():
-            return self.encoder.encode_array(None)
+    def __init__(self, args, db: DataStore, config, command_state, handler, writer):
+        super().__init__(args)
+        self.db = db
+        self.command_state = command_state
+        self.handler = handler
+        self.writer = writer
 
+    async def execute(self):
+        state = self.command_state
+        if not state.should_be_queued:
+            return self.encoder.encode_error("EXEC without MULTI")
+
+        queued = state.command_queue
+        failed, changed = state.queue_error, state.dirty_cas
+        state.reset_transaction()
+        self.db.unwatch(state)
+
+        if failed:
+            return b"-EXECABORT Transaction discarded because of previous errors.\r\n"
+        if changed:
+            return b"*-1\r\n"
+
+        # Wrap the writes so the AOF and the replicas apply them as one unit
+        writes = any(self.handler.commands[args[0].upper()].write for args in queued)
+        if writes:
+            self.db.propagate(["MULTI"])
+
+        # None of the queued commands gives way to the loop, so no other
+        # client runs until the whole transaction is done
         responses = []
-        while True:
-            if self.queue.empty():
-                break
-            task = await self.queue.get()
-            response = await task
-            responses.append(response)
-            self.queue.task_done()
+        for args in queued:
+            responses.append(
+                await self.handler.execute(args, state, self.writer, inline=True)
+            )
 
-        print(self.encoder.encode_array(responses), "Final Result")
+        if writes:
+            self.db.propagate(["EXEC"])
+            # WAIT should cover the whole transaction, not just its last write
+            state.last_write_offset = self.db._replication_data["master_repl_offset"]
         return self.encoder.encode_array(responses)
 
 
 class DISCARDCommand(Command):
-    def __init__(self, args, config, db, should_be_queued, queue):
+    allow_stale = True
+
+    def __init__(self, args, db: DataStore, config, command_state):
         super().__init__(args)
-        self.should_be_queued = should_be_queued
-        self.queue = queue
+        self.db = db
+        self.command_state = command_state
 
     async def execute(self):
+        state = self.command_state
+        if not state.should_be_queued:
+            return self.encoder.encode_error("DISCARD without MULTI")
 
-        if not self.should_be_queued:
-            return self.encoder.encode_error(f"DISCARD without MULTI")
+        state.reset_transaction()
+        self.db.unwatch(state)
+        return self.encoder.encode_simple_string("OK")
 
-        while not self.queue.empty():
-            try:
-                self.queue.get_nowait()
-            except asyncio.QueueEmpty:
-                break
 
+class WATCHCommand(Command):
+    """WATCH key [key ...]: make the next EXEC fail if any of the keys change"""
+
+    allow_stale = True
+    first_key = 1
+    last_key = -1
+
+    def __init__(self, args, db: DataStore, config, command_state):
+        super().__init__(args)
+        self.db = db
+        self.command_state = command_state
+
+    async def execute(self):
+        if len(self.args) < 2:
+            return self.encoder.encode_error(
+                "wrong number of arguments for 'watch' command"
+            )
+        if self.command_state.should_be_queued:
+            return self.encoder.encode_error("WATCH inside MULTI is not allowed")
+
+        for key in self.args[1:]:
+            self.db.watch(key, self.command_state)
+        return self.encoder.encode_simple_string("OK")
+
+
+class UNWATCHCommand(Command):
+    allow_stale = True
+
+    def __init__(self, args, db: DataStore, config, command_state):
+        super().__init__(args)
+        self.db = db
+        self.command_state = command_state
+
+    async def execute(self):
+        self.db.unwatch(self.command_state)
         return self.encoder.encode_simple_string("OK")
 
 
 class TYPECommand(Command):
     """Returns the type of value for the key stored in the database"""
 
+    first_key = 1
+    last_key = 1
+
     def __init__(self, args, db: DataStore, config):
         super().__init__(args)
         self.db = db
@@ -227,6 +325,10 @@ class TYPECommand(Command):
 class XADDCommand(Command):
     """Adding Data to the stream"""
 
+    write = True
+    first_key = 1
+    last_key = 1
+
     def __init__(self, args, db: DataStore, config):
         super().__init__(args)
         self.db = db
@@ -249,9 +351,10 @@ class XADDCommand(Command):
             key, id, fields = self.parse_entry()
 
             stream = self.db.get(key)
-            if stream is None:
+            created = stream is None
+            if created:
+                # Stored only once the entry is accepted: a bad ID creates nothing
                 stream = StreamData()
-                self.db.set(key, stream)
             elif not isinstance(stream, StreamData):
                 return self.encoder.encode_error(
                     "WRONGTYPE operation with the key holding data type other than stream"
@@ -259,6 +362,17 @@ class XADDCommand(Command):
 
             try:
                 new_entry = stream.add_entry(id, fields)
+                if not new_entry.startswith(b"-"):
+                    if created:
+                        # Counts the write and flags watchers
+                        self.db.set(key, stream)
+                    else:
+                        self.db.dirty += 1
+                        self.db.touch(key)
+                    # Log the generated ID so a replay recreates the same entry
+                    self.propagate_args = ["XADD", key, stream.get_last_id()]
+                    for field, value in fields.items():
+                        self.propagate_args += [field, value]
                 return new_entry
             except Exception as e:
                 return self.encoder.encode_error(str(e))
@@ -271,6 +385,9 @@ class XRANGECommand(Command):
     XRANGE key start end [COUNT count]
     """
 
+    first_key = 1
+    last_key = 1
+
     def __init__(self, args, db: DataStore, config):
         super().__init__(args)
         self.db = db
@@ -311,10 +428,21 @@ class XREADCommand(Command):
     Example: XREAD COUNT 2 STREAMS mystream 0-0
     """
 
+    blocking = True
+
     def __init__(self, args, db: DataStore, config):
         super().__init__(args)
         self.db = db
 
+    @classmethod
+    def get_keys(cls, args):
+        # The keys are the first half of what follows STREAMS
+        lowered = [arg.lower() for arg in args]
+        if "streams" not in lowered:
+            return []
+        streams = args[lowered.index("streams") + 1 :]
+        return streams[: len(streams) // 2]
+
     async def process_stream(self, stream_infos):
         """Process the results"""
 
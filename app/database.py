@@ -1,33 +1,105 @@
 """Database for my REDIS"""
 
 import asyncio
+import contextlib
+import os
 import secrets
 import string
+import threading
 import time
 import logging
-from typing import Dict, Tuple, Optional
+from typing import Dict, List, Tuple, Optional
 from app.utils.config import RedisServerConfig
 from app.protocol.resp_encoder import RESPEncoder
+from app.persistence.rdb import RDBPersistence
+from app.persistence.aof import AppendOnlyFile
+from app.replication.backlog import ReplicationBacklog
+from app.cluster.slots import key_hash_slot
+from app.cluster.state import ClusterState
+from app.cluster.migrate import MigrateConnections
+from app.workers.channels import WorkerChannels
+from app.utils.sharded_map import ShardedMap
+from app.utils.offload import Offloader
 
 logger = logging.getLogger(__name__)
 
+# Stands in for a shard lock when a single thread owns the keyspace
+NO_LOCK = contextlib.nullcontext()
+
 
 class DataStore:
     def __init__(self, config: "RedisServerConfig"):
         self.config = config
         self.encoder = RESPEncoder()
-        self.lock = asyncio.Lock()
-        self._data: Dict[str, Tuple[str, Optional[int]]] = {}
-        self.replicas = set()
-        self.ack_replicas = {}
-        self.should_acknowledge = False
+        # With --threads every event loop thread works on the keyspace, so
+        # it is split into shards that each have a lock
+        self.sharded = config.threads > 1
+        self._data: Dict[str, Tuple[str, Optional[int]]] = self._new_keyspace({})
+        if self.sharded:
+            # A forked snapshot child must not copy a shard in mid-update. Looked
+            # up at fork time: swap_keyspace replaces _data
+            os.register_at_fork(
+                before=lambda: self._data.acquire_all(),
+                after_in_parent=lambda: self._data.release_all(),
+                after_in_child=lambda: self._data.release_all(),
+            )
+        # Guards the WATCH bookkeeping and the replication stream across threads
+        self.watch_lock = threading.Lock()
+        self.stream_lock = threading.Lock()
+        # Writes since the last successful snapshot
+        self.dirty = 0
+        # Counters shown in INFO stats
+        self.stats = {
+            "client_query_buffer_limit_disconnections": 0,
+            "client_output_buffer_limit_disconnections": 0,
+        }
+        self.output_buffer_limits = config.output_buffer_limits
+        # WATCHed keys -> the CommandStates of the clients watching them
+        self.watched_keys: Dict[str, set] = {}
+        # Online replicas: writer -> ReplicaOutput
+        self.replicas: Dict[object, object] = {}
+        # Replicas receiving a full sync, with the writes made since their snapshot
+        self.syncing_replicas: Dict[object, bytearray] = {}
+        # REPLCONF capa values announced by each replica connection
+        self.replica_capabilities: Dict[object, set] = {}
+        # REPLCONF listening-port of each replica connection
+        self.replica_ports: Dict[object, int] = {}
+        # WAIT calls in progress: (offset, number of replicas, future)
+        self.ack_waiters: List[Tuple[int, int, asyncio.Future]] = []
+        self.getack_scheduled = False
+        self.last_replica_ping = time.time()
         self._replication_data = {
             "role": "master",
             "master_replid": self._generate_secure_random_string(),
             "master_repl_offset": 0,
+            # History we can still serve after a failover (see shift_replid)
+            "master_replid2": "0" * 40,
+            "second_repl_offset": -1,
         }
-        self._dummy_empty_rdb = "524544495330303131fa0972656469732d76657205372e322e30fa0a72656469732d62697473c040fa056374696d65c26d08bc65fa08757365642d6d656dc2b0c41000fa08616f662d62617365c000fff06e3bfec0ff5aa2"
         self._update_replication_data()
+        self.backlog = ReplicationBacklog(config.repl_backlog_size)
+        # The RedisReplica linking us to our master, when we are a replica
+        self.master_link = None
+        # Cluster topology, and the keys stored in each slot, in cluster mode
+        self.cluster: Optional[ClusterState] = None
+        self.slot_keys: Optional[Dict[int, set]] = None
+        if config.cluster_enabled:
+            self.cluster = ClusterState.load(
+                config.cluster_config_path, config.host, config.port
+            )
+            self.slot_keys = {}
+        # Connections MIGRATE keeps open to its targets
+        self.migrate_connections = MigrateConnections()
+        # Keys MIGRATE is sending right now: clients can't write them meanwhile
+        self.migrating_keys: set = set()
+        # Channels to the other workers, in --workers mode
+        self.workers: Optional[WorkerChannels] = None
+        if config.workers > 1:
+            self.workers = WorkerChannels(config)
+        self.persistence = RDBPersistence(config, self)
+        self.aof = AppendOnlyFile(config, self)
+        # Where CPU-heavy commands run, off the event loop
+        self.offloader = Offloader(config.offload_threads)
 
     def _generate_secure_random_string(self, length: int = 40) -> str:
         characters = string.ascii_letters + string.digits
@@ -40,23 +112,119 @@ class DataStore:
         if self.config.replicaof is not None:
             self._replication_data["role"] = "slave"
 
+    def _new_keyspace(self, entries: Dict) -> Dict:
+        if not self.sharded:
+            return entries
+        keyspace = ShardedMap()
+        keyspace.update(entries)
+        return keyspace
+
+    def key_lock(self, key: str):
+        """The lock of key's shard, a no-op unless the keyspace is sharded"""
+        return self._data.lock_for(key) if self.sharded else NO_LOCK
+
+    def locked(self, keys: List[str]):
+        """Hold the shard locks of keys, always taken in the same order"""
+        return self._data.locked(keys) if self.sharded else NO_LOCK
+
     def set(self, key: str, value: str, expiry: Optional[int] = None) -> None:
         """Set a key-value pair with optional expiry (in milliseconds)."""
-        self._data[key] = (value, expiry)
+        with self.key_lock(key):
+            if self.slot_keys is not None and key not in self._data:
+                self.slot_keys.setdefault(key_hash_slot(key), set()).add(key)
+            self._data[key] = (value, expiry)
+        # Approximate under --threads: it only paces the save points
+        self.dirty += 1
+        if self.watched_keys:
+            self.touch(key)
         logger.debug(f"Set key '{key}' with value '{value}' and expiry {expiry}")
 
     def get(self, key: str) -> Optional[str]:
         """Get value for key if it exists and hasn't expired."""
-        if key not in self._data:
-            return None
+        entry = self.get_entry(key)
+        return None if entry is None else entry[0]
+
+    def get_entry(self, key: str) -> Optional[Tuple[object, Optional[int]]]:
+        """(value, expiry) of a live key, e.g. to serialize it"""
+        with self.key_lock(key):
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+
+            if entry[1] and time.time() * 1000 > entry[1]:
+                self._remove(key)
+                logger.debug(f"Key '{key}' has expired")
+                return None
+        return entry
+
+    def delete(self, key: str) -> bool:
+        """Remove a key; False if there was no such (live) key"""
+        with self.key_lock(key):
+            if self.get_entry(key) is None:
+                return False
+            self._remove(key)
+        self.dirty += 1
+        return True
+
+    def _remove(self, key: str) -> None:
+        del self._data[key]
+        if self.slot_keys is not None:
+            self._unindex(key)
+        if self.watched_keys:
+            self.touch(key)
+
+    def _unindex(self, key: str) -> None:
+        slot = key_hash_slot(key)
+        keys = self.slot_keys.get(slot)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self.slot_keys[slot]
+
+    def _reindex(self) -> None:
+        """Rebuild the slot -> keys index after a bulk load"""
+        if self.slot_keys is None:
+            return
+        self.slot_keys = {}
+        for key in self._data:
+            self.slot_keys.setdefault(key_hash_slot(key), set()).add(key)
+
+    def count_keys_in_slot(self, slot: int) -> int:
+        return len(self.slot_keys.get(slot, ()))
 
-        value, expiry = self._data[key]
-        if expiry and time.time() * 1000 > expiry:
-            del self._data[key]
-            logger.debug(f"Key '{key}' has expired")
-            return None
+    def keys_in_slot(self, slot: int, count: int) -> List[str]:
+        keys = self.slot_keys.get(slot, ())
+        return [key for key, _ in zip(keys, range(count))]
 
-        return value
+    def touch(self, key: str) -> None:
+        """Flag the transactions watching key: it was modified"""
+        with self.watch_lock:
+            for client in self.watched_keys.get(key, ()):
+                client.dirty_cas = True
+
+    def watch(self, key: str, client) -> None:
+        """Make EXEC fail for client if key changes before it runs"""
+        if client.watched_keys is None:
+            client.watched_keys = set()
+        elif key in client.watched_keys:
+            return
+        client.watched_keys.add(key)
+        with self.watch_lock:
+            self.watched_keys.setdefault(key, set()).add(client)
+
+    def unwatch(self, client) -> None:
+        """Forget every key client watches"""
+        client.dirty_cas = False
+        if not client.watched_keys:
+            return
+        with self.watch_lock:
+            for key in client.watched_keys:
+                clients = self.watched_keys.get(key)
+                if clients is not None:
+                    clients.discard(client)
+                    if not clients:
+                        del self.watched_keys[key]
+        client.watched_keys = None
 
     def keys(self) -> list[str]:
         """Return all non-expired keys."""
@@ -68,11 +236,217 @@ class DataStore:
         ]
         return valid_keys
 
-    def info(self) -> dict:
+    def snapshot(self) -> List[Tuple[str, Tuple[object, Optional[int]]]]:
+        """The (key, (value, expiry)) pairs as they are now
+
+        Copying them is quick enough for the event loop; going through them
+        is left to whoever reads the copy.
+        """
+        return list(self._data.items())
+
+    def load(self, entries: Dict[str, Tuple[str, Optional[int]]], size_hint: int = 0):
+        """Bulk insert loaded keys; a dict update resizes the table once up front."""
+        if size_hint:
+            logger.info(f"Loading {len(entries)} keys (RESIZEDB hint {size_hint})")
+        self._data.update(entries)
+        self._reindex()
+
+    def swap_keyspace(self, entries: Dict[str, Tuple[str, Optional[int]]]) -> None:
+        """Replace the whole dataset in one step, e.g. with the master's snapshot"""
+        self._data = self._new_keyspace(entries)
+        self._reindex()
+        self.dirty += 1
+        # Any watched key may have changed
+        for key in list(self.watched_keys):
+            self.touch(key)
+
+    def propagate(self, args: List[str]) -> None:
+        """Encode a write command once and feed it to the AOF and the replicas"""
+        payload = self.encoder.encode_array(args)
+        with self.stream_lock:
+            self.aof.feed(payload)
+
+            # A replica's stream is the master's, fed by the replication link
+            if not self.config.replicaof:
+                self.replicate(payload)
+
+    def replicate(self, payload: bytes) -> None:
+        """Append bytes to the replication stream: offset, backlog and replicas"""
+        self._replication_data["master_repl_offset"] += len(payload)
+        self.backlog.append(payload)
+        # The snapshot isn't sent yet, so only the hard limit applies here
+        limit = self.output_buffer_limits["replica"].hard
+        for writer, buffer in list(self.syncing_replicas.items()):
+            buffer += payload
+            if limit and len(buffer) >= limit:
+                logger.warning(
+                    f"Writes buffered during a full sync passed {limit} bytes, "
+                    "disconnecting the replica"
+                )
+                self.stats["client_output_buffer_limit_disconnections"] += 1
+                del self.syncing_replicas[writer]
+                writer.transport.abort()
+
+        for output in list(self.replicas.values()):
+            output.feed(payload)
+
+    def replication_cron(self) -> None:
+        """Ping the replicas now and then, so they can tell a dead link from a quiet one"""
+        if self.config.replicaof or not self.replicas:
+            return
+        now = time.time()
+        # A replica stays over its soft limit without any new write too
+        for output in list(self.replicas.values()):
+            output.over_limit(now)
+        if now - self.last_replica_ping >= self.config.repl_ping_replica_period:
+            self.last_replica_ping = now
+            self.replicate(self.encoder.encode_array(["PING"]))
+
+    def count_acked(self, offset: int) -> int:
+        """Number of replicas that acknowledged the stream up to offset"""
+        return sum(1 for output in self.replicas.values() if output.ack_offset >= offset)
+
+    def wait_for_acks(self, offset: int, num_replicas: int) -> asyncio.Future:
+        """Future resolved once num_replicas replicas acknowledged offset"""
+        future = asyncio.get_running_loop().create_future()
+        self.ack_waiters.append((offset, num_replicas, future))
+
+        # One GETACK per loop iteration, however many WAITs asked for it
+        if not self.getack_scheduled:
+            self.getack_scheduled = True
+            asyncio.get_running_loop().call_soon(self._send_getack)
+        return future
+
+    def _send_getack(self) -> None:
+        self.getack_scheduled = False
+        # GETACK travels in the replication stream, so it moves the offset too
+        self.replicate(self.encoder.encode_array(["REPLCONF", "GETACK", "*"]))
+
+    def remove_ack_waiter(self, future: asyncio.Future) -> None:
+        self.ack_waiters = [w for w in self.ack_waiters if w[2] is not future]
+
+    def acknowledge(self, writer, offset: int) -> None:
+        """Record a replica's REPLCONF ACK and wake the WAITs it satisfies"""
+        output = self.replicas.get(writer)
+        if output is None:
+            return
+        output.ack_offset = max(output.ack_offset, offset)
+        output.ack_time = time.time()
+
+        for target, num_replicas, future in self.ack_waiters:
+            if not future.done() and self.count_acked(target) >= num_replicas:
+                future.set_result(None)
+
+    def reset_replication_stream(self, replid: str, offset: int) -> None:
+        """Follow a new replication history, e.g. after a full resync"""
+        self._replication_data["master_replid"] = replid
+        self._replication_data["master_repl_offset"] = offset
+        self._replication_data["master_replid2"] = "0" * 40
+        self._replication_data["second_repl_offset"] = -1
+        self.backlog.reset(offset)
+
+    def shift_replid(self, new_replid: Optional[str] = None) -> None:
+        """Start a new history, keeping the old one as replid2
+
+        Happens on promotion, or when our master continued under a new id.
+        Replicas following the old history can still partially resync up
+        to the offset where the two histories diverge.
+        """
+        replication = self._replication_data
+        if new_replid == replication["master_replid"]:
+            return
+        replication["master_replid2"] = replication["master_replid"]
+        replication["second_repl_offset"] = replication["master_repl_offset"] + 1
+        replication["master_replid"] = new_replid or self._generate_secure_random_string()
+        logger.info(
+            f"Set the secondary replication id to {replication['master_replid2']}, "
+            f"valid up to offset {replication['second_repl_offset']}"
+        )
+
+    def can_partial_resync(self, replid: str, offset: int) -> bool:
+        """Whether PSYNC replid offset can continue from the backlog"""
+        replication = self._replication_data
+        if replid != replication["master_replid"] and not (
+            replid == replication["master_replid2"]
+            and offset <= replication["second_repl_offset"]
+        ):
+            return False
+        return self.backlog.contains(offset)
+
+    def disconnect_replicas(self) -> None:
+        """Drop our replicas so they resync and learn about a new history"""
+        for writer in list(self.replicas) + list(self.syncing_replicas):
+            self.remove_replica(writer)
+            writer.close()
+
+    def remove_replica(self, writer) -> None:
+        """Forget a replica connection that went away"""
+        output = self.replicas.pop(writer, None)
+        if output is not None:
+            output.close()
+        self.syncing_replicas.pop(writer, None)
+        self.replica_capabilities.pop(writer, None)
+        self.replica_ports.pop(writer, None)
+
+    def items(self) -> list[Tuple[str, object, Optional[int]]]:
+        """Return (key, value, expiry) for every stored key."""
+        return [(key, value, expiry) for key, (value, expiry) in self._data.items()]
+
+    def _replica_lines(self) -> List[str]:
+        """connected_slaves and one slaveN line per replica, with its lag"""
+        now = time.time()
+        replicas = [
+            (writer, "online", output.ack_offset, int(now - output.ack_time))
+            for writer, output in self.replicas.items()
+        ]
+        replicas += [(writer, "send_bulk", 0, -1) for writer in self.syncing_replicas]
+
+        lines = [f"connected_slaves:{len(replicas)}"]
+        for i, (writer, state, offset, lag) in enumerate(replicas):
+            peer = writer.get_extra_info("peername") or ("?", 0)
+            port = self.replica_ports.get(writer, peer[1])
+            lines.append(
+                f"slave{i}:ip={peer[0]},port={port},state={state},"
+                f"offset={offset},lag={lag}"
+            )
+        return lines
+
+    def replication_info(self) -> str:
         """Return the replication Info"""
         line = ["# Replication"]
 
         for key, value in self._replication_data.items():
             line.append(f"{key}:{value}")
+            if key == "role":
+                if self.master_link is not None:
+                    line.append(self.master_link.info())
+                line.extend(self._replica_lines())
+
+        line.append("repl_backlog_active:1")
+        line.append(f"repl_backlog_size:{self.backlog.size}")
+        line.append(f"repl_backlog_first_byte_offset:{self.backlog.first_byte_offset}")
+        line.append(f"repl_backlog_histlen:{self.backlog.histlen}")
 
         return "\n".join(line)
+
+    def stats_info(self) -> str:
+        lines = ["# Stats"]
+        lines.extend(f"{name}:{value}" for name, value in self.stats.items())
+        lines.append(f"total_offloaded_commands:{self.offloader.offloaded}")
+        return "\n".join(lines)
+
+    def info(self, section: Optional[str] = None) -> str:
+        """Return the requested INFO section, or every section"""
+        sections = {
+            "stats": self.stats_info,
+            "persistence": lambda: f"{self.persistence.info()}\n{self.aof.info()}",
+            "replication": self.replication_info,
+            "cluster": lambda: (
+                self.cluster.info() if self.cluster else "# Cluster\ncluster_enabled:0"
+            ),
+        }
+        if not section or section.lower() in ("all", "everything", "default"):
+            return "\n\n".join(render() for render in sections.values())
+        if section.lower() in sections:
+            return sections[section.lower()]()
+        return ""
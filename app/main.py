@@ -5,6 +5,7 @@ import logging
 import sys
 from app.utils.config import RedisServerConfig
 from app.server import RedisServer
+from app.workers.supervisor import WorkerSupervisor
 
 """Logging Setup Configuration"""
 
@@ -26,6 +27,10 @@ def main():
         config = RedisServerConfig.parse_args(args=sys.argv[1:])
         print("Configuration", config)
 
+        if config.workers > 1:
+            WorkerSupervisor(config).run()
+            return
+
         server = RedisServer(config)
         asyncio.run(server.start())
     except Exception as e:
@@ -0,0 +1 @@
+# persistence/__init__.py
@@ -0,0 +1,376 @@
+"""Append-only file: log every write command and replay it at startup"""
+
+import asyncio
+import os
+import signal
+import time
+import logging
+from typing import Optional
+from app.commands.command_state import CommandState
+from app.persistence.fork import fork_child, reap_child
+from app.protocol.RDBLoader import RDBParser
+from app.protocol.RDBWriter import RDBWriter
+from app.protocol.resp_decoder import RESPDecoder
+from app.protocol.resp_encoder import RESPEncoder
+from app.streams.streamData import StreamData
+from app.utils.config import RedisServerConfig
+
+logger = logging.getLogger(__name__)
+
+APPENDFSYNC_ALWAYS = "always"
+APPENDFSYNC_EVERYSEC = "everysec"
+APPENDFSYNC_NO = "no"
+
+
+def _fsync_and_close(fd: int) -> None:
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class AppendOnlyFile:
+    def __init__(self, config: "RedisServerConfig", db):
+        self.config = config
+        self.db = db
+        self.fd: Optional[int] = None
+        self.loading = False
+        # Commands produced during the current event loop iteration
+        self.buffer = bytearray()
+        self.flush_future: Optional[asyncio.Future] = None
+        self.current_size = 0
+        self.last_write_status = "ok"
+        self.last_fsync = time.time()
+        self.unsynced = False
+        self.fsync_in_progress = False
+        # Size right after the last rewrite, the reference for auto rewrites
+        self.base_size = 0
+        self.rewrite_child_pid: Optional[int] = None
+        self.rewrite_started_at: Optional[float] = None
+        self.rewrite_scheduled = False
+        # Commands that arrive while the child writes the compacted file
+        self.rewrite_buffer = bytearray()
+        self.last_rewrite_status = "ok"
+        self.last_rewrite_time_sec = -1
+
+    @property
+    def enabled(self) -> bool:
+        return self.fd is not None
+
+    @property
+    def rewrite_in_progress(self) -> bool:
+        return self.rewrite_child_pid is not None
+
+    def open(self) -> None:
+        path = self.config.aof_path
+        self.fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        self.current_size = os.fstat(self.fd).st_size
+        logger.info(f"Append only file opened at {path}")
+
+        self.base_size = self.current_size
+
+        # A fresh AOF has to start from the dataset loaded from the RDB
+        if self.current_size == 0 and self.db.keys():
+            self._write_base(self.fd)
+            self.current_size = self.base_size = os.fstat(self.fd).st_size
+
+    def _write_base(self, fd: int) -> None:
+        """Write the dataset as an RDB preamble, or as commands without it"""
+        with os.fdopen(os.dup(fd), "wb") as f:
+            if self.config.aof_use_rdb_preamble:
+                RDBWriter.write_store(f.write, self.db)
+            else:
+                for payload in self._dataset_commands():
+                    f.write(payload)
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _dataset_commands(self):
+        """Commands recreating the current dataset"""
+        encoder = RESPEncoder()
+        for key, value, expiry in self.db.items():
+            if isinstance(value, StreamData):
+                for entry in value.entries:
+                    args = ["XADD", key, entry.id]
+                    for field, field_value in entry.fields.items():
+                        args += [field, field_value]
+                    yield encoder.encode_array(args)
+                continue
+
+            args = ["SET", key, str(value)]
+            if expiry:
+                args += ["PXAT", str(int(expiry))]
+            yield encoder.encode_array(args)
+
+    def feed(self, payload: bytes) -> None:
+        """Queue an encoded command; one write covers the whole loop iteration"""
+        if not self.enabled or self.loading:
+            return
+
+        self.buffer += payload
+        if self.rewrite_in_progress:
+            self.rewrite_buffer += payload
+        if self.flush_future is None:
+            loop = asyncio.get_running_loop()
+            self.flush_future = loop.create_future()
+            loop.call_soon(self.flush)
+
+    async def wait_flushed(self) -> None:
+        """Wait for the group commit holding the commands fed so far"""
+        if self.flush_future is not None:
+            await asyncio.shield(self.flush_future)
+
+    def flush(self) -> None:
+        """Group commit: a single write (and fsync for 'always') per iteration"""
+        future, self.flush_future = self.flush_future, None
+
+        try:
+            if self.buffer:
+                written = 0
+                try:
+                    while written < len(self.buffer):
+                        written += os.write(self.fd, self.buffer[written:])
+                finally:
+                    del self.buffer[:written]
+                    self.current_size += written
+                    self.unsynced = True
+
+                if self.config.appendfsync == APPENDFSYNC_ALWAYS:
+                    os.fsync(self.fd)
+                    self.unsynced = False
+                    self.last_fsync = time.time()
+
+            self.last_write_status = "ok"
+        except OSError as e:
+            # Keep what was not written; the cron retries the flush
+            logger.error(f"Error writing to the AOF: {e}")
+            self.last_write_status = "err"
+        finally:
+            if future is not None and not future.done():
+                future.set_result(None)
+
+    def rewrite(self) -> None:
+        """Fork a child that writes the compacted AOF"""
+        if self.rewrite_in_progress:
+            raise RuntimeError("Background append only file rewriting already in progress")
+        if self.db.persistence.bgsave_in_progress:
+            # Only one child at a time; the cron starts it once BGSAVE is done
+            self.rewrite_scheduled = True
+            return
+
+        temp_path = self._rewrite_temp_path()
+
+        def write_compacted():
+            fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+            try:
+                self._write_base(fd)
+            finally:
+                os.close(fd)
+
+        try:
+            pid, fork_usec = fork_child(write_compacted, "Background AOF rewrite")
+        except OSError as e:
+            self.last_rewrite_status = "err"
+            raise RuntimeError(f"Can't fork for AOF rewrite: {e}")
+
+        self.db.persistence.latest_fork_usec = fork_usec
+        self.rewrite_scheduled = False
+        self.rewrite_child_pid = pid
+        self.rewrite_started_at = time.time()
+        self.rewrite_buffer.clear()
+        logger.info(f"Background append only file rewriting started by pid {pid}")
+
+    def _rewrite_temp_path(self) -> str:
+        directory = self.config.aof_path.parent
+        return str(directory / f"temp-rewriteaof-bg-{os.getpid()}.aof")
+
+    def _check_rewrite_child(self) -> None:
+        """Reap the rewrite child and swap in the compacted file"""
+        exit_code = reap_child(self.rewrite_child_pid)
+        if exit_code is None:
+            return
+
+        # The child was forked from this process, so the temp file carries our pid
+        temp_path = self._rewrite_temp_path()
+        self.rewrite_child_pid = None
+        self.last_rewrite_time_sec = int(time.time() - self.rewrite_started_at)
+        self.rewrite_started_at = None
+
+        if exit_code != 0:
+            self.last_rewrite_status = "err"
+            self.rewrite_buffer.clear()
+            if os.path.exists(temp_path):
+                os.unlink(temp_path)
+            logger.error("Background AOF rewrite terminated with error")
+            return
+
+        try:
+            self._finish_rewrite(temp_path)
+            self.last_rewrite_status = "ok"
+            logger.info("Background AOF rewrite finished successfully")
+        except OSError as e:
+            self.last_rewrite_status = "err"
+            logger.error(f"Failed to install the rewritten AOF: {e}")
+            if os.path.exists(temp_path):
+                os.unlink(temp_path)
+        finally:
+            self.rewrite_buffer.clear()
+
+    def _finish_rewrite(self, temp_path: str) -> None:
+        # Everything fed so far must be in the rewrite buffer before the swap
+        if self.enabled:
+            self.flush()
+
+        fd = os.open(temp_path, os.O_WRONLY | os.O_APPEND)
+        try:
+            written = 0
+            while written < len(self.rewrite_buffer):
+                written += os.write(fd, self.rewrite_buffer[written:])
+            os.fsync(fd)
+        except OSError:
+            os.close(fd)
+            raise
+
+        os.replace(temp_path, self.config.aof_path)
+        if self.enabled:
+            os.close(self.fd)
+            self.fd = fd
+            self.current_size = self.base_size = os.fstat(fd).st_size
+        else:
+            os.close(fd)
+
+    def _should_auto_rewrite(self) -> bool:
+        percentage = self.config.auto_aof_rewrite_percentage
+        if not percentage or self.current_size < self.config.auto_aof_rewrite_min_size:
+            return False
+        base = self.base_size or 1
+        growth = (self.current_size - base) * 100 / base
+        return growth >= percentage
+
+    def cron(self) -> None:
+        """Retry failed writes and hand the everysec fsync to a thread"""
+        if self.rewrite_in_progress:
+            self._check_rewrite_child()
+        elif not self.db.persistence.bgsave_in_progress and (
+            self.rewrite_scheduled or (self.enabled and self._should_auto_rewrite())
+        ):
+            try:
+                self.rewrite()
+            except Exception as e:
+                logger.error(f"Automatic AOF rewrite failed: {e}")
+                self.rewrite_scheduled = False
+
+        if not self.enabled:
+            return
+
+        if self.buffer and self.flush_future is None:
+            self.flush()
+
+        if (
+            self.config.appendfsync == APPENDFSYNC_EVERYSEC
+            and self.unsynced
+            and not self.fsync_in_progress
+            and time.time() - self.last_fsync >= 1
+        ):
+            # A copy of the descriptor: a rewrite or close() may close ours
+            fd = os.dup(self.fd)
+            self.fsync_in_progress = True
+            self.unsynced = False
+            future = asyncio.get_running_loop().run_in_executor(
+                None, _fsync_and_close, fd
+            )
+            future.add_done_callback(self._fsync_done)
+
+    def _fsync_done(self, future: asyncio.Future) -> None:
+        self.fsync_in_progress = False
+        self.last_fsync = time.time()
+        if future.exception():
+            logger.error(f"Background AOF fsync failed: {future.exception()}")
+            self.unsynced = True
+
+    def close(self) -> None:
+        if self.rewrite_in_progress:
+            # The half written file is useless without the parent's buffer
+            os.kill(self.rewrite_child_pid, signal.SIGKILL)
+            os.waitpid(self.rewrite_child_pid, 0)
+            temp_path = self._rewrite_temp_path()
+            if os.path.exists(temp_path):
+                os.unlink(temp_path)
+            self.rewrite_child_pid = None
+
+        if not self.enabled:
+            return
+        self.flush()
+        os.fsync(self.fd)
+        os.close(self.fd)
+        self.fd = None
+
+    async def load(self, command_handler) -> None:
+        """Replay the AOF through the command handler"""
+        path = self.config.aof_path
+        with open(path, "rb") as f:
+            data = f.read()
+
+        command_state = CommandState(internal=True)
+        pos = 0
+        count = 0
+
+        if data.startswith(b"REDIS"):
+            # Rewritten files start with an RDB snapshot of the dataset
+            parser = RDBParser(data, checksum=self.config.rdbchecksum)
+            try:
+                parser.parse()
+            finally:
+                parser.buf.release()
+            parser.apply(self.db)
+            pos = parser.pos
+            logger.info(f"Loaded the RDB preamble of the AOF ({pos} bytes)")
+
+        self.loading = True
+        try:
+            while pos < len(data):
+                parsed = RESPDecoder.parse_command(data, pos)
+                if parsed is None:
+                    self._truncated_tail(path, pos, len(data))
+                    break
+                args, pos = parsed
+                await command_handler.handle_command(args, command_state)
+                count += 1
+        finally:
+            self.loading = False
+
+        logger.info(f"Replayed {count} commands from the AOF {path}")
+
+    def _truncated_tail(self, path, valid_size: int, size: int) -> None:
+        """Handle a command cut short, e.g. by a crash in the middle of a write"""
+        if not self.config.aof_load_truncated:
+            raise ValueError(
+                f"Bad file format reading the append only file {path}: "
+                "truncated command at the end"
+            )
+
+        logger.warning(
+            f"AOF {path} ends with a truncated command, "
+            f"truncating from {size} to {valid_size} bytes"
+        )
+        os.truncate(path, valid_size)
+
+    def info(self) -> str:
+        line = []
+        fields = {
+            "aof_enabled": int(self.enabled),
+            "aof_current_size": self.current_size,
+            "aof_buffer_length": len(self.buffer),
+            "aof_last_write_status": self.last_write_status,
+            "aof_pending_bio_fsync": int(self.fsync_in_progress),
+            "aof_base_size": self.base_size,
+            "aof_rewrite_in_progress": int(self.rewrite_in_progress),
+            "aof_rewrite_scheduled": int(self.rewrite_scheduled),
+            "aof_last_rewrite_time_sec": self.last_rewrite_time_sec,
+            "aof_last_bgrewrite_status": self.last_rewrite_status,
+            "aof_rewrite_buffer_length": len(self.rewrite_buffer),
+        }
+        for key, value in fields.items():
+            line.append(f"{key}:{value}")
+
+        return "\n".join(line)
@@ -0,0 +1,43 @@
+"""Run persistence jobs in a forked child over a copy-on-write view"""
+
+import gc
+import os
+import time
+import logging
+from typing import Callable, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+def fork_child(job: Callable[[], None], name: str) -> Tuple[int, int]:
+    """Start job in a child process; returns (pid, fork time in microseconds)"""
+    start = time.perf_counter()
+
+    # Keep the collector from touching (and so copying) every object page
+    gc.freeze()
+    try:
+        pid = os.fork()
+    except OSError:
+        gc.unfreeze()
+        raise
+
+    if pid == 0:
+        exit_code = 1
+        try:
+            job()
+            exit_code = 0
+        except Exception as e:
+            logger.error(f"{name} failed: {e}")
+        finally:
+            os._exit(exit_code)
+
+    gc.unfreeze()
+    return pid, int((time.perf_counter() - start) * 1_000_000)
+
+
+def reap_child(pid: int) -> Optional[int]:
+    """Exit code of a finished child, or None while it is still running"""
+    done, status = os.waitpid(pid, os.WNOHANG)
+    if done == 0:
+        return None
+    return os.waitstatus_to_exitcode(status)
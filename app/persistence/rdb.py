@@ -0,0 +1,125 @@
+"""RDB snapshots: SAVE, BGSAVE and the automatic save points"""
+
+import time
+import logging
+from typing import Optional
+from app.persistence.fork import fork_child, reap_child
+from app.protocol.RDBWriter import RDBWriter
+from app.utils.config import RedisServerConfig
+
+logger = logging.getLogger(__name__)
+
+# Wait this long before retrying an automatic BGSAVE that failed
+BGSAVE_RETRY_DELAY = 5
+
+
+class RDBPersistence:
+    def __init__(self, config: "RedisServerConfig", db):
+        self.config = config
+        self.db = db
+        self.lastsave = int(time.time())
+        self.last_bgsave_try = 0
+        self.last_bgsave_status = "ok"
+        self.last_bgsave_time_sec = -1
+        self.latest_fork_usec = 0
+        self.child_pid: Optional[int] = None
+        self.child_started_at: Optional[float] = None
+        self.dirty_at_fork = 0
+
+    @property
+    def bgsave_in_progress(self) -> bool:
+        return self.child_pid is not None
+
+    def save(self) -> None:
+        """Synchronous snapshot on the event loop"""
+        start = time.time()
+        RDBWriter.dump(self.config.rdb_path, self.db)
+        self.db.dirty = 0
+        self.lastsave = int(time.time())
+        logger.info(f"DB saved on disk in {time.time() - start:.3f}s")
+
+    def bgsave(self) -> None:
+        """Fork a child that writes a copy-on-write view of the dataset"""
+        if self.bgsave_in_progress:
+            raise RuntimeError("Background save already in progress")
+        if self.db.aof.rewrite_in_progress:
+            raise RuntimeError("Can't BGSAVE while AOF log rewriting is in progress")
+
+        self.last_bgsave_try = time.time()
+        try:
+            pid, self.latest_fork_usec = fork_child(
+                lambda: RDBWriter.dump(self.config.rdb_path, self.db), "Background saving"
+            )
+        except OSError as e:
+            self.last_bgsave_status = "err"
+            raise RuntimeError(f"Can't fork for background saving: {e}")
+
+        self.child_pid = pid
+        self.child_started_at = time.time()
+        self.dirty_at_fork = self.db.dirty
+        logger.info(f"Background saving started by pid {pid}")
+
+    def check_child(self) -> None:
+        """Reap a finished BGSAVE child without blocking"""
+        if not self.bgsave_in_progress:
+            return
+
+        exit_code = reap_child(self.child_pid)
+        if exit_code is None:
+            return
+
+        self.last_bgsave_time_sec = int(time.time() - self.child_started_at)
+        if exit_code == 0:
+            self.db.dirty = max(0, self.db.dirty - self.dirty_at_fork)
+            self.lastsave = int(time.time())
+            self.last_bgsave_status = "ok"
+            logger.info("Background saving terminated with success")
+        else:
+            self.last_bgsave_status = "err"
+            logger.error("Background saving error")
+
+        self.child_pid = None
+        self.child_started_at = None
+
+    def cron(self) -> None:
+        """Called periodically by the server to drive save points"""
+        self.check_child()
+        if self.bgsave_in_progress or self.db.aof.rewrite_in_progress:
+            return
+
+        now = time.time()
+        for seconds, changes in self.config.save_points:
+            if self.db.dirty < changes or now - self.lastsave < seconds:
+                continue
+            # Back off after a failure instead of forking in a tight loop
+            if (
+                self.last_bgsave_status != "ok"
+                and now - self.last_bgsave_try < BGSAVE_RETRY_DELAY
+            ):
+                continue
+
+            logger.info(f"{changes} changes in {seconds} seconds. Saving...")
+            try:
+                self.bgsave()
+            except Exception as e:
+                logger.error(f"Automatic BGSAVE failed: {e}")
+            break
+
+    def info(self) -> str:
+        line = ["# Persistence"]
+        current = (
+            int(time.time() - self.child_started_at) if self.child_started_at else -1
+        )
+        fields = {
+            "rdb_changes_since_last_save": self.db.dirty,
+            "rdb_bgsave_in_progress": int(self.bgsave_in_progress),
+            "rdb_last_save_time": self.lastsave,
+            "rdb_last_bgsave_status": self.last_bgsave_status,
+            "rdb_last_bgsave_time_sec": self.last_bgsave_time_sec,
+            "rdb_current_bgsave_time_sec": current,
+            "latest_fork_usec": self.latest_fork_usec,
+        }
+        for key, value in fields.items():
+            line.append(f"{key}:{value}")
+
+        return "\n".join(line)
@@ -1,93 +1,416 @@
+import mmap
 import struct
 import time
 import logging
-from ..database import DataStore
+from typing import TYPE_CHECKING, Dict, Optional, Tuple
+from app.protocol import listpack, lzf
+from app.protocol.crc64 import crc64
+from app.streams.streamData import StreamData
+
+if TYPE_CHECKING:
+    from ..database import DataStore
 
 logger = logging.getLogger(__name__)
 
+# Newest RDB version whose DUMP payloads we accept
+RDB_MAX_VERSION = 12
 
-class RDBLoader:
-    @staticmethod
-    def read_length(f) -> int:
-        byte = f.read(1)
-        if not byte:
-            raise EOFError("Unexpected end of file")
-
-        first_byte = byte[0]
-        if first_byte < 0xC0:
-            return first_byte
-        elif first_byte == 0xC0:
-            next_byte = f.read(1)
-            return struct.unpack("B", next_byte)[0]
-        elif first_byte == 0xC1:
-            next_bytes = f.read(2)
-            return struct.unpack("<H", next_bytes)[0]
-        elif first_byte == 0xC2:
-            next_bytes = f.read(4)
-            return struct.unpack("<I", next_bytes)[0]
+# Opcodes
+RDB_OPCODE_FUNCTION2 = 0xF5
+RDB_OPCODE_MODULE_AUX = 0xF7
+RDB_OPCODE_IDLE = 0xF8
+RDB_OPCODE_FREQ = 0xF9
+RDB_OPCODE_AUX = 0xFA
+RDB_OPCODE_RESIZEDB = 0xFB
+RDB_OPCODE_EXPIRETIME_MS = 0xFC
+RDB_OPCODE_EXPIRETIME = 0xFD
+RDB_OPCODE_SELECTDB = 0xFE
+RDB_OPCODE_EOF = 0xFF
+
+# Value types
+RDB_TYPE_STRING = 0
+RDB_TYPE_STREAM_LISTPACKS = 15
+RDB_TYPE_STREAM_LISTPACKS_2 = 19
+RDB_TYPE_STREAM_LISTPACKS_3 = 21
+
+# Special string encodings (length byte 11xxxxxx)
+RDB_ENC_INT8 = 0
+RDB_ENC_INT16 = 1
+RDB_ENC_INT32 = 2
+RDB_ENC_LZF = 3
+
+STREAM_ITEM_FLAG_DELETED = 1
+STREAM_ITEM_FLAG_SAMEFIELDS = 2
+
+
+class RDBIncompleteError(EOFError):
+    """The buffer ended in the middle of a record"""
+
+    def __init__(self, needed: int):
+        super().__init__("Unexpected end of RDB data")
+        # Buffer length the failed read needed
+        self.needed = needed
+
+
+class RDBParser:
+    """Parse RDB records out of an in-memory buffer (bytes, mmap, memoryview)"""
+
+    def __init__(self, buf, checksum: bool = True):
+        self.buf = memoryview(buf)
+        self.pos = 0
+        self.checksum = checksum
+        self.version: Optional[int] = None
+        self.db_index = 0
+        self.done = False
+        # Keys of database 0, inserted into the store in one go at the end
+        self.data: Dict[str, Tuple[object, Optional[float]]] = {}
+        self.size_hint = 0
+        self.expires_hint = 0
+        self.skipped = 0
+        # Key and expiry of the record being read
+        self.record_key: Optional[Tuple[str, Optional[float]]] = None
+        self.now = time.time() * 1000
+
+    def _read(self, size: int) -> memoryview:
+        end = self.pos + size
+        if end > len(self.buf):
+            raise RDBIncompleteError(end)
+        chunk = self.buf[self.pos : end]
+        self.pos = end
+        return chunk
+
+    def _read_byte(self) -> int:
+        if self.pos >= len(self.buf):
+            raise RDBIncompleteError(self.pos + 1)
+        byte = self.buf[self.pos]
+        self.pos += 1
+        return byte
+
+    def read_length(self) -> Tuple[int, bool]:
+        """Return (length, is_encoded); encoded lengths carry a string encoding"""
+        first_byte = self._read_byte()
+        kind = first_byte >> 6
+
+        if kind == 0:
+            return first_byte & 0x3F, False
+        if kind == 1:
+            return ((first_byte & 0x3F) << 8) | self._read_byte(), False
+        if kind == 3:
+            return first_byte & 0x3F, True
+        if first_byte == 0x80:
+            return struct.unpack(">I", self._read(4))[0], False
+        if first_byte == 0x81:
+            return struct.unpack(">Q", self._read(8))[0], False
+        raise ValueError(f"Unknown length encoding {first_byte:#x}")
+
+    def read_len(self) -> int:
+        length, encoded = self.read_length()
+        if encoded:
+            raise ValueError("Unexpected encoded length")
+        return length
+
+    def read_string(self) -> bytes:
+        length, encoded = self.read_length()
+        if not encoded:
+            return bytes(self._read(length))
+
+        if length == RDB_ENC_INT8:
+            return str(struct.unpack("<b", self._read(1))[0]).encode()
+        if length == RDB_ENC_INT16:
+            return str(struct.unpack("<h", self._read(2))[0]).encode()
+        if length == RDB_ENC_INT32:
+            return str(struct.unpack("<i", self._read(4))[0]).encode()
+        if length == RDB_ENC_LZF:
+            compressed_length = self.read_len()
+            original_length = self.read_len()
+            compressed = bytes(self._read(compressed_length))
+            return lzf.decompress(compressed, original_length)
+        raise ValueError(f"Unsupported string encoding {length}")
+
+    def parse_header(self) -> None:
+        magic = bytes(self._read(9))
+        if magic[:5] != b"REDIS":
+            raise ValueError("Invalid RDB file format")
+        self.version = int(magic[5:])
+
+    def parse(self) -> bool:
+        """Parse complete records until EOF; returns True once the footer is read"""
+        if self.version is None:
+            self.parse_header()
+
+        while not self.done:
+            self._parse_record()
+        return self.done
+
+    def _parse_record(self) -> None:
+        expiry = None
+        opcode = self._read_byte()
+
+        if opcode == RDB_OPCODE_EOF:
+            self._verify_checksum()
+            self.done = True
+            return
+        if opcode == RDB_OPCODE_SELECTDB:
+            self.db_index = self.read_len()
+            return
+        if opcode == RDB_OPCODE_RESIZEDB:
+            size, expires = self.read_len(), self.read_len()
+            if self.db_index == 0:
+                self.size_hint += size
+                self.expires_hint += expires
+            return
+        if opcode == RDB_OPCODE_AUX:
+            key, value = self.read_string(), self.read_string()
+            logger.debug(f"RDB aux field {key!r}: {value!r}")
+            return
+        if opcode == RDB_OPCODE_FUNCTION2:
+            self.read_string()  # Function library code, not supported
+            return
+        if opcode == RDB_OPCODE_MODULE_AUX:
+            raise ValueError("Module data in RDB is not supported")
+
+        # A key may be prefixed by expiry and eviction metadata
+        while opcode in (
+            RDB_OPCODE_EXPIRETIME_MS,
+            RDB_OPCODE_EXPIRETIME,
+            RDB_OPCODE_IDLE,
+            RDB_OPCODE_FREQ,
+        ):
+            if opcode == RDB_OPCODE_EXPIRETIME_MS:
+                expiry = struct.unpack("<Q", self._read(8))[0]
+            elif opcode == RDB_OPCODE_EXPIRETIME:
+                expiry = struct.unpack("<I", self._read(4))[0] * 1000
+            elif opcode == RDB_OPCODE_IDLE:
+                self.read_len()
+            else:
+                self._read(1)
+            opcode = self._read_byte()
+
+        key = self.read_string().decode("utf-8", "surrogateescape")
+        self.record_key = key, expiry
+        self._add_key(key, self._read_value(opcode), expiry)
+
+    def _add_key(self, key: str, value, expiry: Optional[float]) -> None:
+        if self.db_index != 0:
+            self.skipped += 1
+        elif expiry is None or expiry > self.now:
+            self.data[key] = (value, expiry)
+
+    def _read_value(self, value_type: int):
+        if value_type == RDB_TYPE_STRING:
+            return self.read_string().decode("utf-8", "surrogateescape")
+        if value_type in (
+            RDB_TYPE_STREAM_LISTPACKS,
+            RDB_TYPE_STREAM_LISTPACKS_2,
+            RDB_TYPE_STREAM_LISTPACKS_3,
+        ):
+            return self._read_stream(value_type)
+        raise ValueError(f"Unsupported RDB value type {value_type}")
+
+    def _read_stream(
+        self, value_type: int, stream: Optional[StreamData] = None, nodes: int = 0
+    ) -> StreamData:
+        """Read a stream, or the rest of one that has nodes listpacks left"""
+        if stream is None:
+            stream, nodes = StreamData(), self.read_len()
+
+        while nodes:
+            master_ms, master_seq = struct.unpack(">QQ", self.read_string())
+            items = listpack.decode(self.read_string())
+            self._read_stream_node(stream, master_ms, master_seq, items)
+            nodes -= 1
+            self._stream_progress(value_type, stream, nodes)
+
+        self.read_len()  # Number of live entries
+        stream.last_timestamp = self.read_len()
+        stream.last_sequence = self.read_len()
+
+        if value_type >= RDB_TYPE_STREAM_LISTPACKS_2:
+            for _ in range(5):  # first id, max deleted id, entries added
+                self.read_len()
+
+        # Consumer groups are not supported, so they are parsed and dropped
+        for _ in range(self.read_len()):
+            self.read_string()
+            self.read_len(), self.read_len()
+            if value_type >= RDB_TYPE_STREAM_LISTPACKS_2:
+                self.read_len()
+            for _ in range(self.read_len()):
+                self._read(16 + 8)
+                self.read_len()
+            for _ in range(self.read_len()):
+                self.read_string()
+                self._read(8)
+                if value_type >= RDB_TYPE_STREAM_LISTPACKS_3:
+                    self._read(8)
+                self._read(16 * self.read_len())
+
+        return stream
+
+    def _stream_progress(self, value_type: int, stream: StreamData, nodes: int):
+        """Called after each listpack node of a stream is read"""
 
     @staticmethod
-    def read_string(f) -> str:
-        length = RDBLoader.read_length(f)
-        data = f.read(length)
-        if len(data) != length:
-            raise EOFError("Unexpected end of file while reading string")
-        return data.decode("utf-8")
+    def _read_stream_node(stream, master_ms, master_seq, items) -> None:
+        def text(item):
+            if isinstance(item, bytes):
+                return item.decode("utf-8", "surrogateescape")
+            return str(item)
+
+        # Master entry: count, deleted, num fields, fields..., 0
+        num_master_fields = items[2]
+        master_fields = [text(field) for field in items[3 : 3 + num_master_fields]]
+        pos = 3 + num_master_fields + 1
+
+        while pos < len(items):
+            flags = items[pos]
+            entry_id = f"{master_ms + items[pos + 1]}-{master_seq + items[pos + 2]}"
+            pos += 3
+
+            if flags & STREAM_ITEM_FLAG_SAMEFIELDS:
+                values = items[pos : pos + num_master_fields]
+                fields = dict(zip(master_fields, map(text, values)))
+                pos += num_master_fields
+            else:
+                num_fields = items[pos]
+                pairs = items[pos + 1 : pos + 1 + 2 * num_fields]
+                fields = {
+                    text(pairs[i]): text(pairs[i + 1]) for i in range(0, len(pairs), 2)
+                }
+                pos += 1 + 2 * num_fields
+
+            pos += 1  # lp-count
+            if not flags & STREAM_ITEM_FLAG_DELETED:
+                stream._append(entry_id, fields)
+
+    def _verify_checksum(self) -> None:
+        eof_pos = self.pos
+        if self.version < 5:
+            return
+
+        expected = struct.unpack("<Q", self._read(8))[0]
+        # A zero checksum means the writer had checksums disabled
+        if not self.checksum or expected == 0:
+            return
+        if self._checksum(eof_pos) != expected:
+            raise ValueError("Wrong RDB checksum")
+
+    def _checksum(self, end: int) -> int:
+        """CRC of everything before end"""
+        return crc64(self.buf[:end])
+
+    def apply(self, store: "DataStore") -> None:
+        store.load(self.data, self.size_hint)
+        if self.skipped:
+            logger.warning(f"Skipped {self.skipped} keys stored in databases other than 0")
+
+
+class RDBStreamParser(RDBParser):
+    """Parse an RDB that arrives in chunks, e.g. from a socket
+
+    Only the unparsed tail of the data is kept. A record cut off at the end
+    of a chunk is parsed again once the bytes its failed read needs have
+    arrived, and a stream resumes after its last complete listpack node,
+    so every byte is parsed a bounded number of times however big the key.
+    """
+
+    def __init__(self, checksum: bool = True):
+        super().__init__(b"", checksum)
+        self.pending = bytearray()
+        self.crc = 0
+        self.record_start = 0
+        self.bytes_fed = 0
+        # Bytes pending has to hold before parsing is worth trying again
+        self.needed = 0
+        # (pos, (key, expiry), value type, stream, nodes left) after the
+        # last complete node of the stream being read
+        self.checkpoint: Optional[Tuple] = None
+        # The same, minus pos, for a stream to carry on with
+        self.partial: Optional[Tuple] = None
+
+    def feed(self, chunk: bytes) -> bool:
+        """Parse every complete record seen so far; True once the footer is read"""
+        self.pending += chunk
+        self.bytes_fed += len(chunk)
+        if len(self.pending) < self.needed:
+            return self.done
+        self.buf = memoryview(self.pending)
+        self.pos = 0
+        try:
+            while not self.done:
+                self.record_start = self.pos
+                self.checkpoint = None
+                try:
+                    if self.version is None:
+                        self.parse_header()
+                    else:
+                        self._parse_record()
+                except RDBIncompleteError as e:
+                    self.pos = self.record_start
+                    if self.checkpoint is not None:
+                        # Drop the nodes read so far, keeping what they built
+                        self.pos, *partial = self.checkpoint
+                        self.partial = tuple(partial)
+                        self._update_crc()
+                    self.needed = e.needed - self.pos
+                    break
+                self._update_crc()
+        finally:
+            self.buf.release()
+            del self.pending[: self.pos]
+            self.pos = 0
+        return self.done
+
+    def _update_crc(self) -> None:
+        if self.checksum and not self.done:
+            self.crc = crc64(self.buf[self.record_start : self.pos], self.crc)
+
+    def _parse_record(self) -> None:
+        if self.partial is None:
+            super()._parse_record()
+            return
+        (key, expiry), value_type, stream, nodes = self.partial
+        self.record_key = key, expiry
+        value = self._read_stream(value_type, stream, nodes)
+        self.partial = None
+        self._add_key(key, value, expiry)
+
+    def _stream_progress(self, value_type: int, stream: StreamData, nodes: int):
+        self.checkpoint = (self.pos, self.record_key, value_type, stream, nodes)
+
+    def _checksum(self, end: int) -> int:
+        return crc64(self.buf[self.record_start : end], self.crc)
+
+
+class RDBLoader:
+    @classmethod
+    def restore_value(cls, payload: bytes):
+        """The value serialized in a DUMP payload, after checking its footer"""
+        if len(payload) < 10:
+            raise ValueError("DUMP payload version or checksum are wrong")
+        version, expected = struct.unpack("<HQ", payload[-10:])
+        if version > RDB_MAX_VERSION or crc64(payload[:-8]) != expected:
+            raise ValueError("DUMP payload version or checksum are wrong")
+
+        parser = RDBParser(payload[:-10])
+        parser.version = version
+        value = parser._read_value(parser._read_byte())
+        if parser.pos != len(parser.buf):
+            raise ValueError("Bad data format")
+        return value
 
     @classmethod
     def load(cls, filename: str, store: "DataStore") -> None:
         try:
             with open(filename, "rb") as f:
-                magic = f.read(5)
-                if magic != b"REDIS":
-                    raise ValueError("Invalid RDB file format")
-
-                version = f.read(4)  # Skip version for now
-
-                while True:
-                    type_byte = f.read(1)
-                    if not type_byte:
-                        break
-
-                    opcode = type_byte[0]
-                    if opcode == 0xFF:
-                        break
-                    elif opcode == 0xFE:
-                        f.read(1)  # Skip database number
-                        continue
-                    elif opcode == 0xFB:
-                        cls._process_database_content(f, store)
-                        return
-
-        except (IOError, EOFError) as e:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                    parser = RDBParser(mapped, checksum=store.config.rdbchecksum)
+                    try:
+                        parser.parse()
+                    finally:
+                        parser.buf.release()
+                    parser.apply(store)
+
+        except (IOError, EOFError, ValueError) as e:
             logger.error(f"Error loading RDB file: {e}")
             raise
-
-    @classmethod
-    def _process_database_content(cls, f, store: "DataStore") -> None:
-        f.read(2)  # Skip database hash size
-
-        while True:
-            type_byte = f.read(1)
-            if not type_byte:
-                return
-
-            opcode = type_byte[0]
-            if opcode == 0xFF:
-                return
-
-            expiry = None
-            if opcode == 0xFD:
-                expiry = struct.unpack("<I", f.read(4))[0] * 1000
-                type_byte = f.read(1)
-                opcode = type_byte[0]
-            elif opcode == 0xFC:
-                expiry = struct.unpack("<Q", f.read(8))[0]
-                type_byte = f.read(1)
-                opcode = type_byte[0]
-
-            key = cls.read_string(f)
-            value = cls.read_string(f)
-
-            if expiry is None or expiry > time.time() * 1000:
-                store.set(key, value, expiry)
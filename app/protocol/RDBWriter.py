@@ -0,0 +1,307 @@
+"""Serialize the dataset into a Redis compatible RDB file"""
+
+import os
+import struct
+import time
+import logging
+from typing import Callable, Dict, Iterable, Optional, Tuple
+from app.protocol import listpack, lzf
+from app.protocol.crc64 import crc64
+from app.streams.streamData import StreamData
+
+logger = logging.getLogger(__name__)
+
+# Opcodes
+RDB_OPCODE_AUX = 0xFA
+RDB_OPCODE_RESIZEDB = 0xFB
+RDB_OPCODE_EXPIRETIME_MS = 0xFC
+RDB_OPCODE_SELECTDB = 0xFE
+RDB_OPCODE_EOF = 0xFF
+
+# Value types
+RDB_TYPE_STRING = 0
+RDB_TYPE_STREAM_LISTPACKS = 15
+
+# Integer encoded strings
+RDB_ENC_INT8 = 0xC0
+RDB_ENC_INT16 = 0xC1
+RDB_ENC_INT32 = 0xC2
+RDB_ENC_LZF = 0xC3
+
+STREAM_ITEM_FLAG_SAMEFIELDS = 2
+STREAM_NODE_MAX_ENTRIES = 100
+
+
+class RDBWriter:
+    """Write RDB opcodes into a sink, keeping the running CRC64"""
+
+    RDB_VERSION = 11
+    CHUNK_SIZE = 64 * 1024
+
+    def __init__(
+        self,
+        sink: Callable[[bytes], object],
+        checksum: bool = True,
+        compression_threshold: Optional[int] = None,
+    ):
+        self.sink = sink
+        self.checksum = checksum
+        # Strings longer than this are LZF compressed; None disables compression
+        self.compression_threshold = compression_threshold
+        self.crc = 0
+        self.written = 0
+        self.buffer = bytearray()
+
+    def write(self, data: bytes) -> None:
+        self.buffer += data
+        if len(self.buffer) >= self.CHUNK_SIZE:
+            self.flush()
+
+    def flush(self) -> None:
+        if not self.buffer:
+            return
+        chunk = bytes(self.buffer)
+        self.buffer.clear()
+        if self.checksum:
+            self.crc = crc64(chunk, self.crc)
+        self.written += len(chunk)
+        self.sink(chunk)
+
+    def write_length(self, length: int) -> None:
+        if length < 0x40:
+            self.write(bytes([length]))
+        elif length < 0x4000:
+            self.write(bytes([0x40 | (length >> 8), length & 0xFF]))
+        elif length <= 0xFFFFFFFF:
+            self.write(b"\x80" + struct.pack(">I", length))
+        else:
+            self.write(b"\x81" + struct.pack(">Q", length))
+
+    def write_string(self, value) -> None:
+        if isinstance(value, int):
+            value = str(value)
+        if isinstance(value, str):
+            encoded = self._try_integer_encoding(value)
+            if encoded is not None:
+                self.write(encoded)
+                return
+            value = value.encode("utf-8", "surrogateescape")
+
+        if (
+            self.compression_threshold is not None
+            and len(value) > self.compression_threshold
+            and self._write_compressed(value)
+        ):
+            return
+
+        self.write_length(len(value))
+        self.write(value)
+
+    def _write_compressed(self, value: bytes) -> bool:
+        """Write an LZF string, unless that would not save at least 4 bytes"""
+        compressed = lzf.compress(value, len(value) - 4)
+        if compressed is None:
+            return False
+        self.write(bytes([RDB_ENC_LZF]))
+        self.write_length(len(compressed))
+        self.write_length(len(value))
+        self.write(compressed)
+        return True
+
+    @staticmethod
+    def _try_integer_encoding(value: str) -> Optional[bytes]:
+        """Store strings holding a canonical 32 bit integer in integer form"""
+        if not value or len(value) > 11:
+            return None
+        try:
+            number = int(value)
+        except ValueError:
+            return None
+        if str(number) != value:
+            return None
+
+        if -(1 << 7) <= number < (1 << 7):
+            return bytes([RDB_ENC_INT8]) + struct.pack("<b", number)
+        if -(1 << 15) <= number < (1 << 15):
+            return bytes([RDB_ENC_INT16]) + struct.pack("<h", number)
+        if -(1 << 31) <= number < (1 << 31):
+            return bytes([RDB_ENC_INT32]) + struct.pack("<i", number)
+        return None
+
+    def write_header(self) -> None:
+        self.write(b"REDIS%04d" % self.RDB_VERSION)
+        self.write_aux("redis-ver", "7.2.0")
+        self.write_aux("redis-bits", "64")
+        self.write_aux("ctime", str(int(time.time())))
+        self.write_aux("aof-base", "0")
+
+    def write_aux(self, key: str, value: str) -> None:
+        self.write(bytes([RDB_OPCODE_AUX]))
+        self.write_string(key)
+        self.write_string(value)
+
+    def write_select_db(self, index: int, size: int, expires: int) -> None:
+        self.write(bytes([RDB_OPCODE_SELECTDB]))
+        self.write_length(index)
+        self.write(bytes([RDB_OPCODE_RESIZEDB]))
+        self.write_length(size)
+        self.write_length(expires)
+
+    def write_entry(self, key: str, value, expiry: Optional[float] = None) -> None:
+        """Write a single key with its value and optional expiry in ms"""
+        value_type = self._value_type(value)
+        if value_type is None:
+            logger.warning(f"Skipping key '{key}' of unsupported type {type(value)}")
+            return
+
+        if expiry is not None:
+            self.write(bytes([RDB_OPCODE_EXPIRETIME_MS]))
+            self.write(struct.pack("<Q", int(expiry)))
+
+        self.write(bytes([value_type]))
+        self.write_string(key)
+        self._write_value(value_type, value)
+
+    @staticmethod
+    def _value_type(value) -> Optional[int]:
+        if isinstance(value, StreamData):
+            return RDB_TYPE_STREAM_LISTPACKS
+        if isinstance(value, (str, bytes, int)):
+            return RDB_TYPE_STRING
+        return None
+
+    def _write_value(self, value_type: int, value) -> None:
+        if value_type == RDB_TYPE_STRING:
+            self.write_string(value)
+        else:
+            self._write_stream(value)
+
+    def _write_stream(self, stream: StreamData) -> None:
+        """Stream as listpack nodes of up to STREAM_NODE_MAX_ENTRIES entries"""
+        entries = stream.entries
+        nodes = [
+            entries[i : i + STREAM_NODE_MAX_ENTRIES]
+            for i in range(0, len(entries), STREAM_NODE_MAX_ENTRIES)
+        ]
+
+        self.write_length(len(nodes))
+        for node in nodes:
+            master_ms, master_seq = map(int, node[0].id.split("-"))
+            master_fields = list(node[0].fields)
+
+            items = [len(node), 0, len(master_fields), *master_fields, 0]
+            for entry in node:
+                ms, seq = map(int, entry.id.split("-"))
+                same_fields = list(entry.fields) == master_fields
+                items += [
+                    STREAM_ITEM_FLAG_SAMEFIELDS if same_fields else 0,
+                    ms - master_ms,
+                    seq - master_seq,
+                ]
+                if same_fields:
+                    items += entry.fields.values()
+                else:
+                    items.append(len(entry.fields))
+                    for field, value in entry.fields.items():
+                        items += [field, value]
+
+                lp_count = len(entry.fields) + 3
+                if not same_fields:
+                    lp_count += len(entry.fields) + 1
+                items.append(lp_count)
+
+            self.write_string(struct.pack(">QQ", master_ms, master_seq))
+            self.write_string(listpack.encode(items))
+
+        self.write_length(len(entries))
+        self.write_length(stream.last_timestamp)
+        self.write_length(stream.last_sequence)
+        self.write_length(0)  # Consumer groups
+
+    def write_footer(self) -> None:
+        self.write(bytes([RDB_OPCODE_EOF]))
+        self.flush()
+        # The checksum covers everything up to and including the EOF opcode
+        trailer = struct.pack("<Q", self.crc if self.checksum else 0)
+        self.written += len(trailer)
+        self.sink(trailer)
+
+    def write_databases(
+        self, databases: Dict[int, Iterable[Tuple[str, object, Optional[float]]]]
+    ) -> None:
+        """Write a complete RDB: header, every database and the CRC trailer"""
+        self.write_header()
+        now = time.time() * 1000
+        for index, items in sorted(databases.items()):
+            items = [
+                (key, value, expiry)
+                for key, value, expiry in items
+                if not expiry or expiry > now
+            ]
+            if not items:
+                continue
+            expires = sum(1 for _, _, expiry in items if expiry)
+            self.write_select_db(index, len(items), expires)
+            for key, value, expiry in items:
+                self.write_entry(key, value, expiry)
+        self.write_footer()
+
+    @classmethod
+    def for_config(cls, sink: Callable[[bytes], object], config) -> "RDBWriter":
+        return cls(
+            sink,
+            checksum=config.rdbchecksum,
+            compression_threshold=(
+                config.rdbcompression_threshold if config.rdbcompression else None
+            ),
+        )
+
+    @classmethod
+    def dump_value(cls, value, config) -> bytes:
+        """DUMP payload: the value as in an RDB, the RDB version and a CRC64"""
+        value_type = cls._value_type(value)
+        if value_type is None:
+            raise ValueError(f"Can't serialize values of type {type(value)}")
+
+        chunks = []
+        writer = cls.for_config(chunks.append, config)
+        writer.write(bytes([value_type]))
+        writer._write_value(value_type, value)
+        writer.write(struct.pack("<H", cls.RDB_VERSION))
+        writer.flush()
+        payload = b"".join(chunks)
+        # Unlike the file trailer, the payload checksum is always there
+        return payload + struct.pack("<Q", crc64(payload))
+
+    @classmethod
+    def dumps(cls, store) -> bytes:
+        """Serialize the store into an in-memory RDB payload"""
+        chunks = []
+        cls.write_store(chunks.append, store)
+        return b"".join(chunks)
+
+    @classmethod
+    def write_store(cls, sink: Callable[[bytes], object], store) -> int:
+        """Write a complete RDB of the store into sink; returns the bytes written"""
+        writer = cls.for_config(sink, store.config)
+        writer.write_databases({0: store.items()})
+        return writer.written
+
+    @classmethod
+    def dump(cls, filename, store) -> int:
+        """Write the store to a temp file and atomically rename it into place"""
+        directory = os.path.dirname(os.path.abspath(filename))
+        temp_path = os.path.join(directory, f"temp-{os.getpid()}.rdb")
+
+        try:
+            with open(temp_path, "wb") as f:
+                written = cls.write_store(f.write, store)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp_path, filename)
+        except Exception:
+            if os.path.exists(temp_path):
+                os.unlink(temp_path)
+            raise
+
+        return written
@@ -0,0 +1,137 @@
+"""Listpack encoding used by RDB stream nodes"""
+
+import struct
+from typing import Iterable, List, Union
+
+LP_EOF = 0xFF
+
+
+def _encode_backlen(length: int) -> bytes:
+    """Reverse-readable length of an element, stored after it"""
+    if length <= 127:
+        return bytes([length])
+    if length < 16383:
+        return bytes([length >> 7, (length & 127) | 128])
+    if length < 2097151:
+        return bytes([length >> 14, ((length >> 7) & 127) | 128, (length & 127) | 128])
+    if length < 268435455:
+        return bytes(
+            [
+                length >> 21,
+                ((length >> 14) & 127) | 128,
+                ((length >> 7) & 127) | 128,
+                (length & 127) | 128,
+            ]
+        )
+    return bytes(
+        [
+            length >> 28,
+            ((length >> 21) & 127) | 128,
+            ((length >> 14) & 127) | 128,
+            ((length >> 7) & 127) | 128,
+            (length & 127) | 128,
+        ]
+    )
+
+
+def _encode_int(value: int) -> bytes:
+    if 0 <= value <= 127:
+        return bytes([value])
+    if -4096 <= value <= 4095:
+        value &= 0x1FFF
+        return bytes([0xC0 | (value >> 8), value & 0xFF])
+    if -(1 << 15) <= value < (1 << 15):
+        return b"\xf1" + struct.pack("<h", value)
+    if -(1 << 23) <= value < (1 << 23):
+        return b"\xf2" + (value & 0xFFFFFF).to_bytes(3, "little")
+    if -(1 << 31) <= value < (1 << 31):
+        return b"\xf3" + struct.pack("<i", value)
+    return b"\xf4" + struct.pack("<q", value)
+
+
+def _encode_string(data: bytes) -> bytes:
+    length = len(data)
+    if length < 64:
+        return bytes([0x80 | length]) + data
+    if length < 4096:
+        return bytes([0xE0 | (length >> 8), length & 0xFF]) + data
+    return b"\xf0" + struct.pack("<I", length) + data
+
+
+def encode(items: Iterable[Union[int, str, bytes]]) -> bytes:
+    """Build a listpack blob out of integers and strings"""
+    body = []
+    count = 0
+    for item in items:
+        if isinstance(item, int):
+            element = _encode_int(item)
+        else:
+            if isinstance(item, str):
+                item = item.encode("utf-8", "surrogateescape")
+            element = _encode_string(item)
+        body.append(element)
+        body.append(_encode_backlen(len(element)))
+        count += 1
+
+    payload = b"".join(body)
+    total = 6 + len(payload) + 1
+    return (
+        struct.pack("<IH", total, min(count, 65535)) + payload + bytes([LP_EOF])
+    )
+
+
+def _backlen_size(length: int) -> int:
+    if length <= 127:
+        return 1
+    if length < 16383:
+        return 2
+    if length < 2097151:
+        return 3
+    if length < 268435455:
+        return 4
+    return 5
+
+
+def decode(blob) -> List[Union[int, bytes]]:
+    """Read every element of a listpack blob"""
+    buf = memoryview(blob)
+    pos = 6
+    items = []
+    while True:
+        byte = buf[pos]
+        if byte == LP_EOF:
+            break
+
+        if byte < 0x80:
+            value, header, size = byte, 1, 0
+        elif byte < 0xC0:
+            header, size = 1, byte & 0x3F
+            value = bytes(buf[pos + 1 : pos + 1 + size])
+        elif byte < 0xE0:
+            value = ((byte & 0x1F) << 8) | buf[pos + 1]
+            if value >= 1 << 12:
+                value -= 1 << 13
+            header, size = 2, 0
+        elif byte < 0xF0:
+            header, size = 2, ((byte & 0x0F) << 8) | buf[pos + 1]
+            value = bytes(buf[pos + 2 : pos + 2 + size])
+        elif byte == 0xF0:
+            header, size = 5, struct.unpack_from("<I", buf, pos + 1)[0]
+            value = bytes(buf[pos + 5 : pos + 5 + size])
+        elif byte == 0xF1:
+            value, header, size = struct.unpack_from("<h", buf, pos + 1)[0], 3, 0
+        elif byte == 0xF2:
+            value = int.from_bytes(buf[pos + 1 : pos + 4], "little", signed=True)
+            header, size = 4, 0
+        elif byte == 0xF3:
+            value, header, size = struct.unpack_from("<i", buf, pos + 1)[0], 5, 0
+        elif byte == 0xF4:
+            value, header, size = struct.unpack_from("<q", buf, pos + 1)[0], 9, 0
+        else:
+            raise ValueError(f"Invalid listpack encoding byte {byte:#x}")
+
+        element = header + size
+        items.append(value)
+        pos += element + _backlen_size(element)
+
+    return items
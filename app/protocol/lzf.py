@@ -0,0 +1,127 @@
+"""LZF compression as used for RDB strings (0xC3 encoding)"""
+
+from typing import Optional
+
+MAX_LITERAL = 1 << 5  # Longest literal run
+MAX_OFFSET = 1 << 13  # Furthest back-reference
+MAX_REF = (1 << 8) + (1 << 3)  # Longest back-reference
+
+
+def decompress(data, expected_length: int) -> bytes:
+    """Inflate an LZF buffer; back-references are copied as whole slices"""
+    data = memoryview(data)
+    out = bytearray()
+    pos = 0
+    end = len(data)
+
+    while pos < end:
+        ctrl = data[pos]
+        pos += 1
+
+        if ctrl < 32:
+            # Literal run of ctrl + 1 bytes
+            run = ctrl + 1
+            if pos + run > end:
+                raise ValueError("LZF literal run past end of input")
+            out += data[pos : pos + run]
+            pos += run
+            if len(out) > expected_length:
+                raise ValueError("LZF output longer than expected")
+            continue
+
+        length = ctrl >> 5
+        if length == 7:
+            if pos >= end:
+                raise ValueError("LZF back-reference past end of input")
+            length += data[pos]
+            pos += 1
+        if pos >= end:
+            raise ValueError("LZF back-reference past end of input")
+        offset = ((ctrl & 0x1F) << 8) + data[pos] + 1
+        pos += 1
+        length += 2
+
+        start = len(out) - offset
+        if start < 0:
+            raise ValueError("LZF back-reference before start of output")
+        if len(out) + length > expected_length:
+            raise ValueError("LZF output longer than expected")
+
+        if offset >= length:
+            out += out[start : start + length]
+        else:
+            # Overlapping reference: the last `offset` bytes repeat as a pattern
+            pattern = out[start:]
+            repeats, remainder = divmod(length, offset)
+            out += pattern * repeats + pattern[:remainder]
+
+    if len(out) != expected_length:
+        raise ValueError(
+            f"LZF output is {len(out)} bytes, expected {expected_length}"
+        )
+    return bytes(out)
+
+
+def _match_length(data: bytes, ref: int, pos: int, limit: int) -> int:
+    """Length of the common prefix of data[ref:] and data[pos:], up to limit"""
+    length = 0
+    step = 32
+    # Compare in slices first, then narrow down on the first mismatching block
+    while length + step <= limit and (
+        data[ref + length : ref + length + step] == data[pos + length : pos + length + step]
+    ):
+        length += step
+    while length < limit and data[ref + length] == data[pos + length]:
+        length += 1
+    return length
+
+
+def compress(data: bytes, max_length: Optional[int] = None) -> Optional[bytes]:
+    """Deflate with LZF; returns None if the output would exceed max_length"""
+    data = bytes(data)
+    size = len(data)
+    if max_length is None:
+        max_length = size + size // 32 + 1
+
+    out = bytearray()
+    table = {}
+    literal_start = 0
+    pos = 0
+
+    def flush_literals(until: int) -> None:
+        for start in range(literal_start, until, MAX_LITERAL):
+            chunk = data[start : min(start + MAX_LITERAL, until)]
+            out.append(len(chunk) - 1)
+            out.extend(chunk)
+
+    while pos < size - 2:
+        key = data[pos : pos + 3]
+        ref = table.get(key)
+        table[key] = pos
+
+        if ref is None or pos - ref > MAX_OFFSET:
+            pos += 1
+            continue
+
+        length = _match_length(data, ref, pos, min(MAX_REF, size - pos))
+        flush_literals(pos)
+
+        offset = pos - ref - 1
+        encoded = length - 2
+        if encoded < 7:
+            out.append((encoded << 5) | (offset >> 8))
+        else:
+            out.append((7 << 5) | (offset >> 8))
+            out.append(encoded - 7)
+        out.append(offset & 0xFF)
+
+        if len(out) > max_length:
+            return None
+
+        pos += length
+        literal_start = pos
+
+    flush_literals(size)
+    if len(out) > max_length:
+        return None
+    return bytes(out)
@@ -1,53 +1,117 @@
 import asyncio
 import logging
+from typing import List, Optional, Tuple
 
 logger = logging.getLogger(__name__)
 
 """RESP Decoder"""
 
 
+class ProtocolError(ValueError):
+    """A malformed or oversized request; the connection can't go on"""
+
+
+class QueryBufferLimitError(ProtocolError):
+    """The client sent more than client-query-buffer-limit unparsed bytes"""
+
+
 class RESPDecoder:
-    def __init__(self):
+    __slots__ = ("buffer", "max_bulk_len", "max_buffer")
+
+    def __init__(
+        self, max_bulk_len: Optional[int] = None, max_buffer: Optional[int] = None
+    ):
         self.buffer = b""
+        # proto-max-bulk-len and client-query-buffer-limit; None for no limit
+        self.max_bulk_len = max_bulk_len
+        self.max_buffer = max_buffer
+
+    @staticmethod
+    def parse_command(
+        buffer: bytes, pos: int = 0, max_bulk_len: Optional[int] = None
+    ) -> Optional[Tuple[List[str], int]]:
+        """Parse one array of bulk strings at pos; None if it is not complete yet"""
+        line_end = buffer.find(b"\r\n", pos)
+        if line_end == -1:
+            return None
+        if buffer[pos : pos + 1] != b"*":
+            raise ProtocolError(
+                f"Protocol error: expected '*', got {buffer[pos:pos + 1]!r}"
+            )
+
+        args_length = int(buffer[pos + 1 : line_end])
+        pos = line_end + 2
+        args = []
+        for _ in range(args_length):
+            line_end = buffer.find(b"\r\n", pos)
+            if line_end == -1:
+                return None
+            if buffer[pos : pos + 1] != b"$":
+                raise ProtocolError(
+                    f"Protocol error: expected '$', got {buffer[pos:pos + 1]!r}"
+                )
+
+            bulk_length = int(buffer[pos + 1 : line_end])
+            # Refused before it arrives, so it is never buffered
+            if max_bulk_len is not None and bulk_length > max_bulk_len:
+                raise ProtocolError("Protocol error: invalid bulk length")
+            start = line_end + 2
+            end = start + bulk_length
+            if end + 2 > len(buffer):
+                return None
+            # Bytes that aren't UTF-8 (e.g. DUMP payloads) survive as surrogates
+            args.append(buffer[start:end].decode("utf-8", "surrogateescape"))
+            pos = end + 2
+
+        return args, pos
+
+    def parse(self, raw: bool = False) -> list:
+        """Take every complete command out of the buffer
 
-    async def decode(self, reader: asyncio.StreamReader):
+        With raw=True each command comes with the exact bytes it was parsed
+        from, as (args, raw_bytes).
+        """
+        args_list = []
+        pos = 0
+        while pos < len(self.buffer):
+            if self.buffer[pos : pos + 1] != b"*":
+                # Not a command array (e.g. a stray +OK line): skip the line
+                line_end = self.buffer.find(b"\r\n", pos)
+                if line_end == -1:
+                    break
+                pos = line_end + 2
+                continue
+
+            parsed = self.parse_command(self.buffer, pos, self.max_bulk_len)
+            if parsed is None:
+                break
+            args, end = parsed
+            args_list.append((args, self.buffer[pos:end]) if raw else args)
+            pos = end
+
+        self.buffer = self.buffer[pos:]
+        if self.max_buffer is not None and len(self.buffer) > self.max_buffer:
+            raise QueryBufferLimitError(
+                f"Query buffer of {len(self.buffer)} bytes over the limit"
+            )
+        return args_list
+
+    async def decode(self, reader: asyncio.StreamReader, raw: bool = False):
         """Decode RESP protocol data from stream"""
 
         try:
-            args_list = []
             while True:
-                data = await reader.read(4096)
+                args_list = self.parse(raw)
+                if args_list:
+                    return args_list
 
+                # Wait for the rest of a partially received command
+                data = await reader.read(4096)
                 if not data:
-                    break
-                print("Received data", data)
-
-                print("Data", data.decode())
-
+                    return []
                 self.buffer += data
 
-                while b"\r\n" in self.buffer:
-                    line_end = self.buffer.find(b"\r\n")
-                    if line_end == -1:
-                        break
-                    line = self.buffer[:line_end].decode()
-                    self.buffer = self.buffer[line_end + 2 :]
-
-                    if line.startswith("*"):
-                        args_length = int(line[1:])
-                        args = []
-                        print(args_length, "Args Len")
-                        for _ in range(args_length):
-                            if self.buffer.startswith(b"$"):
-                                end = self.buffer.find(b"\r\n")
-                                bulk_length = int(self.buffer[1:end])
-                                self.buffer = self.buffer[end + 2 :]
-                                arg = self.buffer[:bulk_length].decode()
-                                args.append(arg)
-                                self.buffer = self.buffer[bulk_length + 2 :]
-
-                        args_list.append(args)
-                return args_list
-
+        except ProtocolError:
+            raise
         except Exception as e:
-            logger.error(f"Error decoding the stream")
+            logger.error(f"Error decoding the stream: {e}")
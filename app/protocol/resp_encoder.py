@@ -16,25 +16,26 @@ class RESPEncoder:
     def encode_bulk_string(s: str) -> bytes:
         if s is None:
             return b"$-1\r\n"
-        s = str(s)
-        return f"${len(s)}\r\n{s}\r\n".encode()
+        data = str(s).encode("utf-8", "surrogateescape")
+        return b"$%d\r\n%s\r\n" % (len(data), data)
 
     @staticmethod
     def encode_array(items: List[str]) -> bytes:
-        print("Items in encode_array", items)
         if not items:
             return b"*0\r\n"
-        response = f"*{len(items)}\r\n".encode()
+        parts = [f"*{len(items)}\r\n".encode()]
         for item in items:
             if item is None:
-                response += "$-1\r\n".encode()
+                parts.append(b"$-1\r\n")
             elif isinstance(item, str):
-                response += f"${len(item)}\r\n{item}\r\n".encode()
+                data = item.encode("utf-8", "surrogateescape")
+                parts.append(b"$%d\r\n%s\r\n" % (len(data), data))
             elif isinstance(item, bytes):
-                response += item
+                # Already encoded RESP (e.g. cached stream entries) is spliced in as is
+                parts.append(item)
             elif isinstance(item, list):
-                response += RESPEncoder.encode_array(item)
-        return response
+                parts.append(RESPEncoder.encode_array(item))
+        return b"".join(parts)
 
     @staticmethod
     def encode_integer(number: int) -> bytes:
@@ -0,0 +1,62 @@
+"""Replication backlog: the latest bytes of the replication stream"""
+
+
+class ReplicationBacklog:
+    """Fixed-size circular buffer indexed by replication offset
+
+    Offsets follow Redis: the first byte ever propagated has offset 1, so a
+    replica that processed N bytes asks to continue from offset N + 1.
+    """
+
+    def __init__(self, size: int):
+        self.size = size
+        self.buffer = bytearray(size)
+        self.idx = 0  # Where the next byte goes
+        self.histlen = 0  # Number of valid bytes
+        self.master_offset = 0  # Offset of the last byte written
+
+    @property
+    def first_byte_offset(self) -> int:
+        return self.master_offset - self.histlen + 1
+
+    def reset(self, offset: int) -> None:
+        """Drop the history and continue from the given replication offset"""
+        self.idx = 0
+        self.histlen = 0
+        self.master_offset = offset
+
+    def append(self, data: bytes) -> None:
+        length = len(data)
+        self.master_offset += length
+
+        if length >= self.size:
+            # Only the tail fits; it fills the whole buffer
+            self.buffer[:] = data[length - self.size :]
+            self.idx = 0
+            self.histlen = self.size
+            return
+
+        first = min(length, self.size - self.idx)
+        self.buffer[self.idx : self.idx + first] = data[:first]
+        if first < length:
+            self.buffer[: length - first] = data[first:]
+        self.idx = (self.idx + length) % self.size
+        self.histlen = min(self.size, self.histlen + length)
+
+    def contains(self, offset: int) -> bool:
+        """Whether the stream from offset onwards is still available"""
+        return self.first_byte_offset <= offset <= self.master_offset + 1
+
+    def read_from(self, offset: int) -> bytes:
+        """Every byte from offset up to the end of the stream"""
+        if not self.contains(offset):
+            raise ValueError(f"Offset {offset} is not in the backlog")
+
+        skip = offset - self.first_byte_offset
+        length = self.histlen - skip
+        start = (self.idx - self.histlen + skip) % self.size
+        if start + length <= self.size:
+            return bytes(self.buffer[start : start + length])
+        return bytes(self.buffer[start:]) + bytes(
+            self.buffer[: length - (self.size - start)]
+        )
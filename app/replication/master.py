@@ -0,0 +1,230 @@
+"""Master side of resynchronization: continue from the backlog or ship a snapshot"""
+
+import asyncio
+import os
+import secrets
+import signal
+import time
+import logging
+from typing import Optional
+from app.persistence.fork import fork_child
+from app.protocol.RDBWriter import RDBWriter
+from app.utils.buffer_limits import OutputBufferGuard
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 64 * 1024
+# Diskless transfers end with a random 40 byte mark instead of a length prefix
+EOF_MARK_SIZE = 40
+# How often a disk-based sync checks whether its BGSAVE is done (seconds)
+BGSAVE_POLL_INTERVAL = 0.05
+
+
+class ReplicaOutput:
+    """Output buffer of an online replica, drained by its own writer task
+
+    Propagation only appends here, so a slow replica never holds up the
+    client that made the write, and everything produced in one event loop
+    iteration leaves in a single send.
+    """
+
+    def __init__(self, db, writer: asyncio.StreamWriter):
+        self.db = db
+        self.writer = writer
+        self.buffer = bytearray()
+        self.ready = asyncio.Event()
+        # Latest REPLCONF ACK: the offset the replica processed, and when
+        self.ack_offset = 0
+        self.ack_time = time.time()
+        # client-output-buffer-limit of the replica class
+        self.guard = OutputBufferGuard(db.output_buffer_limits["replica"])
+        self.task = asyncio.create_task(self._flush_loop())
+
+    @property
+    def pending(self) -> int:
+        """Bytes not yet handed to the kernel"""
+        return len(self.buffer) + self.writer.transport.get_write_buffer_size()
+
+    def feed(self, payload: bytes) -> None:
+        self.buffer += payload
+        if not self.over_limit():
+            self.ready.set()
+
+    def over_limit(self, now: Optional[float] = None) -> bool:
+        """Disconnect the replica if its output buffer is over the limit"""
+        if not self.guard.exceeded(self.pending, now):
+            return False
+        logger.warning(
+            f"Replica output buffer of {self.pending} bytes over the limit, "
+            "disconnecting it"
+        )
+        self.db.stats["client_output_buffer_limit_disconnections"] += 1
+        self.db.remove_replica(self.writer)
+        self.writer.transport.abort()
+        return True
+
+    async def _flush_loop(self) -> None:
+        try:
+            while True:
+                await self.ready.wait()
+                self.ready.clear()
+                data = bytes(self.buffer)
+                self.buffer.clear()
+                self.writer.write(data)
+                await self.writer.drain()
+        except ConnectionError as e:
+            logger.error(f"Error writing to replica: {e}")
+            self.db.remove_replica(self.writer)
+
+    def close(self) -> None:
+        self.task.cancel()
+
+
+def _stop_output(db, writer) -> None:
+    """Stop the stream an earlier PSYNC on this connection left running"""
+    output = db.replicas.pop(writer, None)
+    if output is not None:
+        output.close()
+
+
+async def partial_sync(db, writer: asyncio.StreamWriter, encoder, offset: int) -> None:
+    """Reply CONTINUE and send the part of the stream the replica missed"""
+    # No await until the replica is online, so no write can fall in between
+    writer.write(
+        encoder.encode_simple_string(f"CONTINUE {db._replication_data['master_replid']}")
+    )
+    missing = db.backlog.read_from(offset)
+    writer.write(missing)
+    _stop_output(db, writer)
+    db.replicas[writer] = ReplicaOutput(db, writer)
+    logger.info(
+        f"Partial resynchronization accepted, sending {len(missing)} bytes "
+        f"from offset {offset}"
+    )
+    await writer.drain()
+
+
+class FullSync:
+    """Send a consistent RDB snapshot to one replica, then its buffered writes"""
+
+    def __init__(self, db, writer: asyncio.StreamWriter, encoder):
+        self.db = db
+        self.writer = writer
+        self.encoder = encoder
+
+    def _start(self) -> None:
+        """Reply FULLRESYNC and buffer writes from the snapshot point onwards
+
+        Must run without awaiting between the fork and this call, so the
+        offset sent to the replica matches the snapshot.
+        """
+        replication = self.db._replication_data
+        self.writer.write(
+            self.encoder.encode_simple_string(
+                f"FULLRESYNC {replication['master_replid']} {replication['master_repl_offset']}"
+            )
+        )
+        # The old stream would send writes the snapshot already holds
+        _stop_output(self.db, self.writer)
+        self.db.syncing_replicas[self.writer] = bytearray()
+
+    async def run(self, diskless: bool) -> None:
+        try:
+            if diskless:
+                await self._send_diskless()
+            else:
+                await self._send_from_disk()
+            await self._go_online()
+        finally:
+            self.db.syncing_replicas.pop(self.writer, None)
+
+    async def _send_diskless(self) -> None:
+        """Stream the RDB from a forked child through a pipe, never staging it"""
+        read_fd, write_fd = os.pipe()
+
+        def write_snapshot():
+            os.close(read_fd)
+            with os.fdopen(write_fd, "wb", buffering=CHUNK_SIZE) as pipe:
+                RDBWriter.write_store(pipe.write, self.db)
+
+        try:
+            pid, fork_usec = fork_child(write_snapshot, "Diskless replication")
+        except OSError:
+            os.close(read_fd)
+            os.close(write_fd)
+            raise
+        os.close(write_fd)
+        self.db.persistence.latest_fork_usec = fork_usec
+        self._start()
+
+        mark = secrets.token_hex(EOF_MARK_SIZE // 2).encode()
+        self.writer.write(b"$EOF:" + mark + b"\r\n")
+
+        loop = asyncio.get_running_loop()
+        reader = asyncio.StreamReader(limit=CHUNK_SIZE)
+        transport, _ = await loop.connect_read_pipe(
+            lambda: asyncio.StreamReaderProtocol(reader), os.fdopen(read_fd, "rb")
+        )
+        exit_code = None
+        try:
+            while chunk := await reader.read(CHUNK_SIZE):
+                self.writer.write(chunk)
+                await self.writer.drain()
+
+            _, status = await loop.run_in_executor(None, os.waitpid, pid, 0)
+            exit_code = os.waitstatus_to_exitcode(status)
+        finally:
+            transport.close()
+            if exit_code is None:
+                # The replica went away mid-transfer: stop the child
+                os.kill(pid, signal.SIGKILL)
+                await loop.run_in_executor(None, os.waitpid, pid, 0)
+
+        if exit_code != 0:
+            raise RuntimeError("Diskless replication child failed")
+
+        self.writer.write(mark)
+        await self.writer.drain()
+
+    async def _send_from_disk(self) -> None:
+        """BGSAVE to the dump file, then send it with a length prefix"""
+        persistence = self.db.persistence
+
+        # Wait for other children to finish so the snapshot starts from now
+        while persistence.bgsave_in_progress or self.db.aof.rewrite_in_progress:
+            await asyncio.sleep(BGSAVE_POLL_INTERVAL)
+            persistence.check_child()
+
+        persistence.bgsave()
+        self._start()
+
+        while persistence.bgsave_in_progress:
+            await asyncio.sleep(BGSAVE_POLL_INTERVAL)
+            persistence.check_child()
+
+        if persistence.last_bgsave_status != "ok":
+            raise RuntimeError("BGSAVE for replication failed")
+
+        path = self.db.config.rdb_path
+        with open(path, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            self.writer.write(f"${size}\r\n".encode())
+            while chunk := f.read(CHUNK_SIZE):
+                self.writer.write(chunk)
+                await self.writer.drain()
+
+    async def _go_online(self) -> None:
+        """Flush the writes buffered during the transfer and join the stream"""
+        while True:
+            buffer = self.db.syncing_replicas[self.writer]
+            if not buffer:
+                break
+            self.db.syncing_replicas[self.writer] = bytearray()
+            self.writer.write(bytes(buffer))
+            await self.writer.drain()
+
+        # No await between the last check and here, so nothing can slip through
+        del self.db.syncing_replicas[self.writer]
+        _stop_output(self.db, self.writer)
+        self.db.replicas[self.writer] = ReplicaOutput(self.db, self.writer)
+        logger.info("Replica synchronized and online")
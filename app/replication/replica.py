@@ -1,16 +1,26 @@
 import asyncio
 import logging
-import signal
+import random
+import time
 from app.utils.config import RedisServerConfig
 from app.protocol.resp_encoder import RESPEncoder
 from app.protocol.resp_decoder import RESPDecoder
 from app.commands.command import CommandHandler
 from app.database import DataStore
 from app.commands.command_state import CommandState
+from app.protocol.RDBLoader import RDBStreamParser
 from typing import Optional
 
 logger = logging.getLogger(__name__)
 
+# How often the replica reports its offset to the master (seconds)
+ACK_INTERVAL = 1
+# Bytes of the snapshot read from the master at a time
+SYNC_CHUNK_SIZE = 64 * 1024
+# Reconnect delays double from the base up to the cap (seconds)
+RECONNECT_BASE_DELAY = 0.1
+RECONNECT_MAX_DELAY = 5
+
 
 class RedisReplica:
     def __init__(self, config: RedisServerConfig, db: DataStore):
@@ -21,42 +31,84 @@ class RedisReplica:
         self.command_handler = CommandHandler(self.db, config)
         self.reader: Optional[asyncio.StreamReader] = None
         self.writer: Optional[asyncio.StreamWriter] = None
-        self.server_task = None
+        self.task: Optional[asyncio.Task] = None
+        self.link_up = False
+        # When we last received anything from the master
+        self.last_io: Optional[float] = None
+        self.acked_offset = -1
+        self.sync_in_progress = False
+        # Snapshot size (-1 for diskless transfers) and bytes received so far
+        self.sync_total_bytes = 0
+        self.sync_read_bytes = 0
+        # Whether we ever synced with this master, so PSYNC can try to continue
+        self.synced = False
+        self.link_down_since: Optional[float] = time.time()
+        # Failed attempts since the link was last up, and links re-established
+        self.reconnect_attempts = 0
+        self.reconnects = 0
+        self.full_syncs = 0
+        self.partial_syncs = 0
+
+    def start(self) -> None:
+        """Run the replication link in the background"""
+        self.db.master_link = self
+        self.task = asyncio.create_task(self.handle_replication())
+
+    def stop(self) -> None:
+        if self.task:
+            self.task.cancel()
 
     async def handle_replication(self):
-        """Main replication loop"""
+        """Keep the link to the master up, reconnecting with backoff"""
         while True:
             try:
+                was_synced = self.synced
                 await self._connect()
                 await self._perform_handshakes()
+                if was_synced:
+                    self.reconnects += 1
+                self.reconnect_attempts = 0
                 await self._handle_master_stream()
-            except asyncio.CancelledError as e:
-                logger.error(f"Replication cancelled with error {e}")
+            except asyncio.CancelledError:
+                logger.info("Replication link stopped")
+                self._close()
                 break
             except Exception as e:
-                logger.error(f"Error during replication {e}")
-                raise
+                self._close()
+                delay = self._backoff_delay()
+                self.reconnect_attempts += 1
+                logger.error(
+                    f"Replication link failed: {e}; reconnecting in {delay:.2f}s"
+                )
+                await asyncio.sleep(delay)
+
+    def _backoff_delay(self) -> float:
+        delay = min(RECONNECT_MAX_DELAY, RECONNECT_BASE_DELAY * 2**self.reconnect_attempts)
+        # Jitter keeps the replicas of a restarted master from reconnecting in step
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    def _close(self) -> None:
+        """Drop the connection and anything half-read from it"""
+        self.link_up = False
+        if self.link_down_since is None:
+            self.link_down_since = time.time()
+        if self.writer:
+            self.writer.close()
+            self.writer = None
+        self.decoder = RESPDecoder()
 
     async def _connect(self):
         """Establish connection to master with timeout"""
-        try:
-            logger.info(
-                f"Replica is connecting to the master at {self.config.replicaof['host']} at port {self.config.replicaof['port']}"
-            )
-
-            self.reader, self.writer = await asyncio.wait_for(
-                asyncio.open_connection(
-                    self.config.replicaof["host"], self.config.replicaof["port"]
-                ),
-                timeout=5.0,
-            )
+        logger.info(
+            f"Replica is connecting to the master at {self.config.replicaof['host']} at port {self.config.replicaof['port']}"
+        )
 
-            for sig in (signal.SIGTERM, signal.SIGINT):
-                asyncio.get_running_loop().add_signal_handler(
-                    sig, lambda s=sig: asyncio.create_task(self.shutdown(s))
-                )
-        except Exception as e:
-            logger.error(f"Error connecting to the master due to the error: {e}")
+        self.reader, self.writer = await asyncio.wait_for(
+            asyncio.open_connection(
+                self.config.replicaof["host"], self.config.replicaof["port"]
+            ),
+            timeout=5.0,
+        )
 
     async def _perform_handshakes(self):
         """Handle the hanshakes"""
@@ -71,13 +123,12 @@ class RedisReplica:
             )
             await self._read_response()
 
-            # Handle REPLCONF capa command
-            await self._send_command(["REPLCONF", "capa", "psync2"])
+            # Handle REPLCONF capa command; eof lets the master stream diskless
+            await self._send_command(["REPLCONF", "capa", "eof", "capa", "psync2"])
             await self._read_response()
 
             # Handle PSYNC command
-            psync_command = ["PSYNC", "?", "-1"]
-            await self._send_command(psync_command)
+            await self._send_command(self._psync_command())
             response = await self._read_response()
 
             await self._process_psync(response)
@@ -86,28 +137,69 @@ class RedisReplica:
             logger.error(f"Error performing handshakes: {e}")
             raise
 
+    def _psync_command(self):
+        """Ask to continue our history if we have one, else for a full sync"""
+        replication = self.db._replication_data
+        if not self.synced and replication["master_repl_offset"] == 0:
+            return ["PSYNC", "?", "-1"]
+        # A demoted master offers its own history, which its replicas may share
+        return [
+            "PSYNC",
+            replication["master_replid"],
+            str(replication["master_repl_offset"] + 1),
+        ]
+
     async def _handle_master_stream(self):
-        """Process the command stream from master"""
-        command_state = CommandState()
+        """Apply the command stream from the master batch by batch"""
+        command_state = CommandState(internal=True)
+        self.link_up = True
+        self.link_down_since = None
+        self.last_io = time.time()
+        ack_task = asyncio.create_task(self._ack_periodically())
         try:
             while True:
-                commands = await self.decoder.decode(self.reader)
-                if not commands:
-                    raise Exception(f"Error decoding")
+                batch = await self.decoder.decode(self.reader, raw=True)
+                if not batch:
+                    raise ConnectionError("Lost the connection to the master")
+                self.last_io = time.time()
 
-                for command in commands:
+                for command, raw in batch:
                     await self._process_command(command, command_state)
+                    # The offset moves by exactly the bytes the master sent,
+                    # which also go to our backlog for later partial resyncs
+                    self.db.replicate(raw)
 
-                    # Keep track of the number of bytes of commmand processed
-                    total = len(self.encoder.encode_array(command))
-                    self.db._replication_data["master_repl_offset"] += total
-                    logger.info(
-                        f"After counting, the offset is {self.db._replication_data["master_repl_offset"]}"
-                    )
+                await self._send_ack()
 
         except Exception as e:
             logger.error(f"Error while handling master stream: {e}")
             raise
+        finally:
+            self.link_up = False
+            ack_task.cancel()
+
+    async def _send_ack(self, always: bool = False):
+        """Report our offset to the master, unless it already has it"""
+        offset = self.db._replication_data["master_repl_offset"]
+        if offset == self.acked_offset and not always:
+            return
+        self.acked_offset = offset
+        await self._send_command(["REPLCONF", "ACK", str(offset)])
+
+    async def _ack_periodically(self):
+        """Heartbeat: lets the master see our progress even without GETACK"""
+        while True:
+            await asyncio.sleep(ACK_INTERVAL)
+            # The master pings us regularly, so silence means the link is dead
+            if time.time() - self.last_io > self.config.repl_timeout:
+                logger.error("Timeout connecting to the master, dropping the link")
+                self.writer.transport.abort()
+                return
+            try:
+                await self._send_ack(always=True)
+            except ConnectionError as e:
+                logger.error(f"Failed to send REPLCONF ACK: {e}")
+                return
 
     async def _send_command(self, command):
         """Send the command to the master"""
@@ -125,29 +217,91 @@ class RedisReplica:
             if b"FULLRESYNC" in response:
                 replica_parts = response.split()
 
-                # Updating the replication infos whenever we get the response
-                self.db._replication_data["master_replid"] = replica_parts[1].decode()
-                self.db._replication_data["master_repl_offset"] = int(
-                    replica_parts[2].decode()
-                )
-
-                # Get the size of RDB
-                size_data = await self.reader.readline()
-                if not b"$" in size_data:
-                    logger.error("Inappropriate format of RDB file")
-                    raise Exception("Invalid RDB size format")
-
-                # Extract the size of rdb_file
-                rdb_size = int(size_data[1:-2])
+                await self._load_snapshot()
+                # Our replicas followed the old history: make them resync from us
+                self.db.disconnect_replicas()
 
-                # Extract the content of the rdb_file
-                rdb_content = await self.reader.read(rdb_size)
-                logger.info(f"The RDB content for the replica is {rdb_content}")
+                # The snapshot starts a new history at the master's offset
+                self.db.reset_replication_stream(
+                    replica_parts[1].decode(), int(replica_parts[2].decode())
+                )
+                # Whatever the AOF held before no longer matches the dataset
+                if self.db.aof.enabled:
+                    self.db.aof.rewrite_scheduled = True
+                self.synced = True
+                self.full_syncs += 1
+            elif b"CONTINUE" in response:
+                # The master may have been promoted and changed its replid
+                replica_parts = response.split()
+                new_replid = replica_parts[1].decode() if len(replica_parts) > 1 else None
+                if new_replid and new_replid != self.db._replication_data["master_replid"]:
+                    self.db.shift_replid(new_replid)
+                    # Reconnecting makes our replicas pick up the new replid
+                    self.db.disconnect_replicas()
+                self.synced = True
+                self.partial_syncs += 1
+                logger.info("Partial resynchronization with the master succeeded")
             else:
                 raise Exception(f"Unexpected PSYNC Response: {response}")
 
         except Exception as e:
             logger.error(f"Handling PSYNC emerged with error: {e}")
+            raise
+
+    async def _load_snapshot(self):
+        """Parse the master's RDB straight off the socket, then swap it in
+
+        The new keyspace is built next to the old one, which keeps serving
+        reads until the load is complete.
+        """
+        header = await self.reader.readline()
+        if not header.startswith(b"$"):
+            raise ValueError(f"Invalid RDB payload header: {header!r}")
+
+        parser = RDBStreamParser(checksum=self.config.rdbchecksum)
+        self.sync_in_progress = True
+        self.sync_read_bytes = 0
+        try:
+            if header.startswith(b"$EOF:"):
+                # Diskless transfer: no length up front, a mark follows the RDB
+                mark = header[5:].rstrip(b"\r\n")
+                self.sync_total_bytes = -1
+                while not parser.feed(await self._read_snapshot(SYNC_CHUNK_SIZE)):
+                    pass
+
+                rest = bytes(parser.pending)
+                while len(rest) < len(mark):
+                    rest += await self._read_snapshot(len(mark) - len(rest))
+                if rest[: len(mark)] != mark:
+                    raise ValueError("Diskless RDB transfer does not end with its mark")
+                # Anything after the mark is already the command stream
+                self.decoder.buffer = rest[len(mark) :]
+            else:
+                remaining = self.sync_total_bytes = int(header[1:])
+                while remaining:
+                    chunk = await self._read_snapshot(min(SYNC_CHUNK_SIZE, remaining))
+                    remaining -= len(chunk)
+                    parser.feed(chunk)
+                if not parser.done:
+                    raise ValueError("RDB from the master ends before its EOF marker")
+        finally:
+            self.sync_in_progress = False
+
+        self.db.swap_keyspace(parser.data)
+        if parser.skipped:
+            logger.warning(f"Skipped {parser.skipped} keys stored in databases other than 0")
+        logger.info(
+            f"Loaded {len(parser.data)} keys from the master's snapshot "
+            f"({self.sync_read_bytes} bytes)"
+        )
+
+    async def _read_snapshot(self, size: int) -> bytes:
+        chunk = await self.reader.read(size)
+        if not chunk:
+            raise ConnectionError("Master closed the connection during the sync")
+        self.sync_read_bytes += len(chunk)
+        self.last_io = time.time()
+        return chunk
 
     async def _process_command(self, command, command_state):
         """Handle the command using command_handler"""
@@ -161,22 +315,36 @@ class RedisReplica:
             logger.error(f"Error Processing the Commmand: {e}")
             raise
 
-    async def shutdown(self, sig):
-        """Gracefully shutdown the server"""
-        logger.info(f"Received signal {sig}, shutting down...")
-        if self.writer:
-            self.writer.close()
-            await self.writer.wait_closed()
-
-        if self.server_task:
-            self.server_task.cancel()
-            try:
-                await self.server_task
-            except asyncio.CancelledError:
-                logger.info("Server task was cancelled")
+    def lag(self) -> float:
+        """Seconds since we last heard from the master"""
+        if self.last_io is None:
+            return float("inf")
+        return time.time() - self.last_io
 
-        tasks = [t for t in asyncio.all_tasks() if t is not asyncio.current_task()]
-        [task.cancel() for task in tasks]
-        await asyncio.gather(*tasks, return_exceptions=True)
-
-        asyncio.get_event_loop().stop()
+    def info(self) -> str:
+        """Replica fields of the replication INFO section"""
+        offset = self.db._replication_data["master_repl_offset"]
+        last_io = -1 if self.last_io is None else int(time.time() - self.last_io)
+        fields = {
+            "master_host": self.config.replicaof["host"],
+            "master_port": self.config.replicaof["port"],
+            "master_link_status": "up" if self.link_up else "down",
+            "master_last_io_seconds_ago": last_io,
+            "master_sync_in_progress": int(self.sync_in_progress),
+            # Read from the socket but not applied yet
+            "slave_read_repl_offset": offset + len(self.decoder.buffer),
+            "slave_repl_offset": offset,
+            "slave_read_only": int(self.config.replica_read_only),
+        }
+        if self.link_down_since is not None:
+            fields["master_link_down_since_seconds"] = int(
+                time.time() - self.link_down_since
+            )
+        fields["master_reconnect_attempts"] = self.reconnect_attempts
+        fields["master_reconnects"] = self.reconnects
+        fields["master_full_syncs"] = self.full_syncs
+        fields["master_partial_syncs"] = self.partial_syncs
+        if self.sync_in_progress:
+            fields["master_sync_total_bytes"] = self.sync_total_bytes
+            fields["master_sync_read_bytes"] = self.sync_read_bytes
+        return "\n".join(f"{key}:{value}" for key, value in fields.items())
@@ -1,15 +1,29 @@
 import asyncio
+import itertools
 import logging
+import os
+import resource
 import signal
+import socket
+import sys
+import threading
+import time
+from pathlib import Path
 from app.database import DataStore
-from typing import Optional
+from typing import List, Optional
 from app.commands.command import CommandHandler
 from app.protocol.RDBLoader import RDBLoader
-from app.protocol.resp_decoder import RESPDecoder
+from app.protocol.resp_decoder import (
+    RESPDecoder,
+    ProtocolError,
+    QueryBufferLimitError,
+)
 from app.utils.config import RedisServerConfig
 from app.protocol.resp_encoder import RESPEncoder
 from app.replication.replica import RedisReplica
-from app.commands.command_state import CommandState
+from app.workers.channels import channel_path
+from app.client_protocol import ClientProtocol
+from app.clients import MAXCLIENTS_ERROR, Client, Clients
 
 """Redis Server"""
 # Database
@@ -20,6 +34,11 @@ from app.commands.command_state import CommandState
 
 logger = logging.getLogger(__name__)
 
+# How often the background housekeeping runs (seconds)
+CRON_INTERVAL = 0.1
+# File descriptors kept free for everything but clients: files, listeners...
+RESERVED_FDS = 32
+
 
 class RedisServer:
     def __init__(
@@ -28,29 +47,96 @@ class RedisServer:
         self.config = config
         self.database = DataStore(self.config) if database is None else database
         self.server: Optional[asyncio.AbstractServer] = None
-        self.resp_decoder = RESPDecoder()
         self.encoder = RESPEncoder()
         self.command_handler = CommandHandler(self.database, config)
-        self._asyncio_queue = asyncio.Queue()
+        self.cron_task: Optional[asyncio.Task] = None
+        # Unix socket the other workers forward commands to, in --workers mode
+        self.channel_server: Optional[asyncio.AbstractServer] = None
+        # Clients connecting through the unixsocket path
+        self.unix_server: Optional[asyncio.AbstractServer] = None
+        self.shutting_down = False
+        # Every open client connection, replicas included
+        self.clients = Clients(config, self.database)
+        # --threads: the listening socket, and the loops beside the main one
+        self.listener: Optional[socket.socket] = None
+        self.loops: List[asyncio.AbstractEventLoop] = []
+        self.loop_threads: List[threading.Thread] = []
+
+    def _check_threads(self) -> None:
+        """Refuse what --threads can't share between event loops"""
+        if self.config.threads <= 1:
+            return
+        if (
+            self.config.appendonly
+            or self.config.replicaof
+            or self.config.cluster_enabled
+            or self.config.workers > 1
+        ):
+            raise ValueError(
+                "--threads can't be combined with the AOF, replication, "
+                "cluster mode or --workers"
+            )
+        if getattr(sys, "_is_gil_enabled", lambda: True)():
+            logger.warning(
+                "The GIL is enabled: the event loop threads won't run in parallel"
+            )
+
+    def _raise_open_files_limit(self) -> None:
+        """Make room for maxclients connections, or lower maxclients to fit"""
+        needed = self.config.maxclients + RESERVED_FDS
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if soft == resource.RLIM_INFINITY or soft >= needed:
+            return
+        limit = needed if hard == resource.RLIM_INFINITY else min(needed, hard)
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (limit, hard))
+        except (ValueError, OSError) as e:
+            logger.warning(f"Failed to raise the open files limit: {e}")
+            limit = soft
+        if limit < needed:
+            self.config.maxclients = max(limit - RESERVED_FDS, 1)
+            logger.warning(
+                f"Open files limit of {limit}: maxclients lowered to "
+                f"{self.config.maxclients}"
+            )
 
     async def start(self):
+        self._check_threads()
+        self._raise_open_files_limit()
+
+        # The AOF is the more complete record, so it wins over the RDB file
+        if self.config.appendonly and self.config.aof_path.exists():
+            try:
+                await self.database.aof.load(self.command_handler)
+            except Exception as e:
+                logger.error(f"Failed to load the AOF: {e}")
+                raise
         # Load the RDB file if present
-        if self.config.rdb_path.exists():
+        elif self.config.rdb_path.exists():
             try:
                 RDBLoader.load(self.config.rdb_path, self.database)
                 logger.info(f"RDB Load Successful from {self.config.rdb_path}")
             except Exception as e:
                 logger.error(f"Failed to load RDB file: {e}")
 
+        if self.config.appendonly:
+            self.database.aof.open()
+
         # If it's a replica, open connection to the master for various purposes like handshakes, and more
         if self.config.replicaof:
-            replica = RedisReplica(self.config, self.database)
-            asyncio.create_task(replica.handle_replication())
+            RedisReplica(self.config, self.database).start()
 
-        # Starting the server and listening for incoming connections
-        self.server = await asyncio.start_server(
-            self.handle_client, self.config.host, self.config.port
-        )
+        if self.config.workers > 1:
+            path = channel_path(self.config, self.config.worker_id)
+            path.unlink(missing_ok=True)
+            self.channel_server = await asyncio.start_unix_server(
+                lambda reader, writer: self.handle_client(reader, writer, True),
+                str(path),
+            )
+
+        await self._serve_unix_socket()
+
+        self.cron_task = asyncio.create_task(self._cron())
 
         # Signal Setup
         for sig in (signal.SIGTERM, signal.SIGINT):
@@ -58,73 +144,332 @@ class RedisServer:
                 sig, lambda s=sig: asyncio.create_task(self.shutdown(s))
             )
 
+        if self.config.threads > 1:
+            await self._serve_threads()
+            return
+
+        # Starting the server and listening for incoming connections;
+        # workers share the port and the kernel balances connections
+        if self.config.io_mode == "protocol":
+            self.server = await asyncio.get_running_loop().create_server(
+                lambda: ClientProtocol(self),
+                self.config.host,
+                self.config.port,
+                backlog=self.config.tcp_backlog,
+                reuse_port=self.config.workers > 1,
+            )
+        else:
+            self.server = await asyncio.start_server(
+                self.handle_client,
+                self.config.host,
+                self.config.port,
+                backlog=self.config.tcp_backlog,
+                reuse_port=self.config.workers > 1,
+            )
+
         async with self.server:
             await self.server.serve_forever()
 
+    async def _serve_unix_socket(self):
+        """Accept clients on the unixsocket path as well as on the TCP port
+
+        With --workers only the first worker listens there and forwards
+        commands for the others' keys; with --threads the main loop serves
+        these connections.
+        """
+        path = self.config.unixsocket
+        if not path or self.config.worker_id != 0:
+            return
+        # Left over by a server that didn't shut down cleanly
+        Path(path).unlink(missing_ok=True)
+        if self.config.io_mode == "protocol":
+            self.unix_server = await asyncio.get_running_loop().create_unix_server(
+                lambda: ClientProtocol(self), path, backlog=self.config.tcp_backlog
+            )
+        else:
+            self.unix_server = await asyncio.start_unix_server(
+                self.handle_client, path, backlog=self.config.tcp_backlog
+            )
+        if self.config.unixsocketperm:
+            os.chmod(path, self.config.unixsocketperm)
+        logger.info(f"Accepting connections on the Unix socket {path}")
+
+    async def _serve_threads(self):
+        """--threads N: one event loop per thread, connections dealt round-robin
+
+        The main loop accepts every connection and serves every Nth one
+        itself; the others are handed to the loops running in their own
+        threads. All of them work on the same sharded keyspace.
+        """
+        main_loop = asyncio.get_running_loop()
+        for index in range(1, self.config.threads):
+            loop = asyncio.new_event_loop()
+            thread = threading.Thread(
+                target=loop.run_forever, name=f"event-loop-{index}", daemon=True
+            )
+            thread.start()
+            self.loops.append(loop)
+            self.loop_threads.append(thread)
+
+        self.listener = socket.create_server(
+            (self.config.host, self.config.port), backlog=self.config.tcp_backlog
+        )
+        self.listener.setblocking(False)
+        logger.info(f"Serving clients from {self.config.threads} event loop threads")
+
+        targets = itertools.cycle([main_loop, *self.loops])
+        while True:
+            try:
+                client, _ = await main_loop.sock_accept(self.listener)
+            except OSError as e:
+                logger.error(f"Failed to accept a connection: {e}")
+                continue
+            loop = next(targets)
+            if loop is main_loop:
+                main_loop.create_task(self._serve_socket(client))
+            else:
+                asyncio.run_coroutine_threadsafe(self._serve_socket(client), loop)
+
+    async def _serve_socket(self, client: socket.socket):
+        """Serve an accepted connection on the event loop we are running on"""
+        if self.config.io_mode == "protocol":
+            await asyncio.get_running_loop().connect_accepted_socket(
+                lambda: ClientProtocol(self), client
+            )
+            return
+        reader, writer = await asyncio.open_connection(sock=client)
+        await self.handle_client(reader, writer)
+
+    @staticmethod
+    async def _cancel_tasks():
+        tasks = [t for t in asyncio.all_tasks() if t is not asyncio.current_task()]
+        [task.cancel() for task in tasks]
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def _stop_loops(self):
+        """Stop the --threads event loops once their connections are gone"""
+        for loop in self.loops:
+            done = asyncio.run_coroutine_threadsafe(self._cancel_tasks(), loop)
+            try:
+                await asyncio.wait_for(asyncio.wrap_future(done), 1)
+            except Exception as e:
+                logger.warning(f"Failed to stop the tasks of an event loop: {e}")
+            loop.call_soon_threadsafe(loop.stop)
+        for thread in self.loop_threads:
+            await asyncio.to_thread(thread.join, 1)
+
+    async def _cron(self):
+        """Periodic housekeeping: reap snapshot children and apply save points"""
+        while True:
+            try:
+                self._check_output_buffers()
+                self._close_idle_clients()
+                self.database.persistence.cron()
+                self.database.aof.cron()
+                self.database.replication_cron()
+                self.database.migrate_connections.cron()
+            except Exception as e:
+                logger.error(f"Error in server cron: {e}")
+            await asyncio.sleep(CRON_INTERVAL)
+
     async def shutdown(self, sig):
         """Gracefully shutdown the server"""
+        # A terminal's Ctrl-C reaches the workers both directly and via the supervisor
+        if self.shutting_down:
+            return
+        self.shutting_down = True
         logger.info(f"Received signal {sig}, shutting down...")
+        if self.cron_task:
+            self.cron_task.cancel()
+
+        if self.channel_server:
+            self.channel_server.close()
+            channel_path(self.config, self.config.worker_id).unlink(missing_ok=True)
+
+        if self.unix_server:
+            self.unix_server.close()
+            Path(self.config.unixsocket).unlink(missing_ok=True)
+
+        if self.listener:
+            self.listener.close()
+            for client in self.clients:
+                client.close()
+            await self._stop_loops()
+
         if self.server:
             self.server.close()
+            # wait_closed() waits for open connections too, so close them first
+            for client in self.clients:
+                client.close()
             await self.server.wait_closed()
 
-        if self.database.replicas:
-            for replica in self.database.replicas:
-                try:
-                    replica.close()
-                    await replica.wait_closed()
-                except Exception as e:
-                    logger.warning(f"Failed to close replica: {e}")
+        # Persist pending changes before exiting when snapshots are enabled
+        if self.config.save_points and self.database.dirty:
+            try:
+                self.database.persistence.save()
+            except Exception as e:
+                logger.error(f"Failed to save the DB on shutdown: {e}")
 
-        tasks = [t for t in asyncio.all_tasks() if t is not asyncio.current_task()]
-        [task.cancel() for task in tasks]
-        await asyncio.gather(*tasks, return_exceptions=True)
+        self.database.offloader.shutdown()
+
+        try:
+            self.database.aof.close()
+        except Exception as e:
+            logger.error(f"Failed to close the AOF on shutdown: {e}")
+
+        await self._cancel_tasks()
 
         asyncio.get_event_loop().stop()
 
+    def tune_connection(self, sock) -> None:
+        """Apply tcp-nodelay and tcp-keepalive to an accepted TCP socket"""
+        if sock is None or sock.family not in (socket.AF_INET, socket.AF_INET6):
+            return
+        try:
+            sock.setsockopt(
+                socket.IPPROTO_TCP, socket.TCP_NODELAY, int(self.config.tcp_nodelay)
+            )
+            interval = self.config.tcp_keepalive
+            if interval <= 0:
+                return
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+            # As Redis does: the first probe after interval idle seconds, then
+            # three more interval / 3 apart before the peer is given up on
+            for option, value in (
+                ("TCP_KEEPIDLE", interval),
+                ("TCP_KEEPINTVL", max(interval // 3, 1)),
+                ("TCP_KEEPCNT", 3),
+            ):
+                if hasattr(socket, option):
+                    sock.setsockopt(socket.IPPROTO_TCP, getattr(socket, option), value)
+        except OSError as e:
+            logger.warning(f"Failed to set the options of a client socket: {e}")
+
+    def new_decoder(self) -> RESPDecoder:
+        """A parser with the request limits every client connection has"""
+        return RESPDecoder(
+            self.config.proto_max_bulk_len, self.config.client_query_buffer_limit
+        )
+
+    def query_limit_reached(self, address, error: Exception) -> None:
+        logger.warning(f"Closing the connection of {address}: {error}")
+        self.database.stats["client_query_buffer_limit_disconnections"] += 1
+
+    def output_over_limit(
+        self, client: Client, now: Optional[float] = None
+    ) -> bool:
+        """Disconnect a client whose unsent replies are over its class's limit"""
+        guard, writer = client.output_guard, client.writer
+        # Replicas are accounted for by their ReplicaOutput
+        if (
+            guard is None
+            or writer in self.database.replicas
+            or writer in self.database.syncing_replicas
+        ):
+            return False
+        size = writer.transport.get_write_buffer_size()
+        if not guard.exceeded(size, now):
+            return False
+
+        logger.warning(
+            f"Output buffer of {size} bytes over the limit, closing the "
+            f"connection of {writer.get_extra_info('peername')}"
+        )
+        self.database.stats["client_output_buffer_limit_disconnections"] += 1
+        client.output_guard = None
+        client.abort()
+        return True
+
+    def _check_output_buffers(self) -> None:
+        """Soft limits also expire while a slow client reads nothing"""
+        if self.clients.normal_limit is None:
+            return
+        now = time.time()
+        for client in self.clients:
+            self.output_over_limit(client, now)
+
+    def _close_idle_clients(self) -> None:
+        if not self.config.timeout:
+            return
+        for client in self.clients.idle(self.config.timeout):
+            address = client.writer.get_extra_info("peername")
+            logger.info(f"Closing the idle connection of {address}")
+            client.close()
+
     async def handle_client(
-        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+        self,
+        reader: asyncio.StreamReader,
+        writer: asyncio.StreamWriter,
+        forwarded: bool = False,
     ):
-        """Handle Individual Client Connection"""
+        """Handle Individual Client Connection
+
+        forwarded connections come from the other workers, with commands
+        already routed to this worker.
+        """
 
         address = writer.get_extra_info("peername")
+        client = self.clients.add(writer, forwarded)
+        if client is None:
+            logger.warning(f"Refusing {address}: maxclients reached")
+            writer.write(MAXCLIENTS_ERROR)
+            writer.close()
+            return
         logger.info(f"New Connection from {address}")
+        if not forwarded:
+            self.tune_connection(writer.get_extra_info("socket"))
 
-        command_state = CommandState()
+        command_state = client.state
+        # Every connection parses its own byte stream
+        resp_decoder = RESPDecoder() if forwarded else self.new_decoder()
 
         try:
             try:
                 while True:
 
-                    command_args_list = await self.resp_decoder.decode(reader)
+                    command_args_list = await resp_decoder.decode(reader)
                     if not command_args_list:
                         break
 
                     for command_args in command_args_list:
+                        self.clients.touch(client)
                         try:
+                            client.busy = True
                             response = await self.command_handler.handle_command(
                                 command_args, command_state, writer
                             )
+                            # Reply only once the group commit holding our writes is done
+                            await self.database.aof.wait_flushed()
                             if response:
                                 logger.debug(f"Writing response: {response!r}")
                                 writer.write(response)
+                                if self.output_over_limit(client):
+                                    return
                                 await writer.drain()
                         except Exception as e:
                             logger.error(f"Error handling command {command_args}: {e}")
                             error_response = self.encoder.encode_error(str(e))
                             writer.write(error_response)
                             await writer.drain()
+                        finally:
+                            client.busy = False
 
             except asyncio.TimeoutError:
                 logger.error(f"Timeout while reading from Peer: {address}")
+        except QueryBufferLimitError as e:
+            self.query_limit_reached(address, e)
+        except ProtocolError as e:
+            logger.error(f"Protocol error from {address}: {e}")
+            writer.write(self.encoder.encode_error(str(e)))
         except ConnectionError as e:
             logger.error(f"Connection Error: {e}")
         except Exception as e:
             logger.error(f"Error: {e}")
         finally:
             # Close the connection
-            if writer in self.database.replicas:
-                self.database.replicas.remove(writer)
+            self.database.unwatch(command_state)
+            self.database.remove_replica(writer)
+            self.clients.remove(writer)
 
             try:
                 writer.close()
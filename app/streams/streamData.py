@@ -1,7 +1,8 @@
 """Implementing the logic of Stream Database in Redis (Basic not based on Radix Trie)"""
 
+import copy
 import time
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from typing import Dict, List, Optional
 from app.protocol.resp_encoder import RESPEncoder
 
@@ -12,6 +13,8 @@ class StreamEntry:
 
     id: str
     fields: Dict[str, str]
+    # RESP bytes of [id, [k, v, ...]]; entries are immutable so this is built once
+    encoded: bytes = field(default=b"", repr=False, compare=False)
 
 
 class StreamData:
@@ -27,6 +30,12 @@ class StreamData:
         self.penultimate_sequence = 0
         self.encoder = RESPEncoder()
 
+    def copy(self) -> "StreamData":
+        """A copy that later XADDs don't extend, to read from another thread"""
+        clone = copy.copy(self)
+        clone.entries = list(self.entries)
+        return clone
+
     def get_last_id(self):
         return f"{self.last_timestamp}-{self.last_sequence}"
 
@@ -94,20 +103,27 @@ class StreamData:
         validation = self._validate(entry_id)
 
         if validation == "validated":
-            entry = StreamEntry(id=entry_id, fields=fields)
-            self.entries.append(entry)
-            print(
-                "The result is",
-                self.encoder.encode_simple_string(
-                    f"{self.last_timestamp}-{self.last_sequence}"
-                ),
-            )
+            self._append(f"{self.last_timestamp}-{self.last_sequence}", fields)
             return self.encoder.encode_bulk_string(
                 f"{self.last_timestamp}-{self.last_sequence}"
             )
 
         return validation
 
+    def _append(self, entry_id: str, fields: Dict[str, str]) -> StreamEntry:
+        """Store an entry together with its pre-encoded RESP reply"""
+        flat = []
+        for key, value in fields.items():
+            flat.extend([key, value])
+
+        entry = StreamEntry(
+            id=entry_id,
+            fields=fields,
+            encoded=self.encoder.encode_array([entry_id, flat]),
+        )
+        self.entries.append(entry)
+        return entry
+
     def _validate_xread_id(self, start, entry_id):
         """Validate the id given in XREAD Command to allow only greater ids"""
         start_timestamp, start_sequence = map(int, start.split("-"))
@@ -157,12 +173,10 @@ class StreamData:
                     push = True
             else:
                 push = self._validate_xread_id(start, entry.id)
-                print("The first push is ", push)
-                print("Push", push)
 
             # Push each entry to the entries
             if push:
-                entries.append([entry.id, entry.fields])
+                entries.append(entry.encoded)
 
             # Deal if the id contains "-"
             if contains_hyphen and end != "+":
@@ -170,17 +184,5 @@ class StreamData:
                     push = False
                     break
 
-        result = []
-
-        for id, field in entries:
-            entry = [id]
-
-            fields = []
-            for key, value in field.items():
-                fields.extend([key, value])
-
-            entry.append(fields)
-
-            result.append(entry)
-
-        return result
+        # Pre-encoded entries, ready to be spliced into an array reply
+        return entries
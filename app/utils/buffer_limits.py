@@ -0,0 +1,72 @@
+"""Client buffer limits: client-output-buffer-limit and its memory sizes"""
+
+import time
+from dataclasses import dataclass
+from typing import Dict, Optional
+
+CLIENT_CLASSES = ("normal", "replica", "pubsub")
+# Suffixes of memory sizes, as Redis reads them: 1k = 1000, 1kb = 1024
+MEMORY_UNITS = {
+    "k": 1000,
+    "kb": 1024,
+    "m": 1000**2,
+    "mb": 1024**2,
+    "g": 1000**3,
+    "gb": 1024**3,
+}
+
+
+def parse_memory(value) -> int:
+    """Bytes in a size such as 1024, 64mb or 1gb"""
+    text = str(value).strip().lower()
+    for unit in sorted(MEMORY_UNITS, key=len, reverse=True):
+        if text.endswith(unit):
+            return int(text[: -len(unit)]) * MEMORY_UNITS[unit]
+    return int(text)
+
+
+@dataclass(frozen=True)
+class OutputBufferLimit:
+    """Disconnect past hard bytes, or after soft_seconds over soft bytes; 0 disables"""
+
+    hard: int
+    soft: int
+    soft_seconds: int
+
+    @staticmethod
+    def parse_all(spec: str) -> Dict[str, "OutputBufferLimit"]:
+        """Limits per client class from "<class> <hard> <soft> <seconds> ..." """
+        limits = {name: OutputBufferLimit(0, 0, 0) for name in CLIENT_CLASSES}
+        fields = spec.split()
+        if len(fields) % 4:
+            raise ValueError(f"Invalid client-output-buffer-limit: {spec!r}")
+        for index in range(0, len(fields), 4):
+            name, hard, soft, seconds = fields[index : index + 4]
+            name = "replica" if name.lower() == "slave" else name.lower()
+            if name not in CLIENT_CLASSES:
+                raise ValueError(f"Invalid client class {name!r} in {spec!r}")
+            limits[name] = OutputBufferLimit(
+                parse_memory(hard), parse_memory(soft), int(seconds)
+            )
+        return limits
+
+
+class OutputBufferGuard:
+    """Checks one connection's unsent bytes against its class's limit"""
+
+    def __init__(self, limit: OutputBufferLimit):
+        self.limit = limit
+        # When the buffer last went over the soft limit
+        self.soft_since: Optional[float] = None
+
+    def exceeded(self, size: int, now: Optional[float] = None) -> bool:
+        limit = self.limit
+        if limit.hard and size >= limit.hard:
+            return True
+        if not limit.soft or size < limit.soft:
+            self.soft_since = None
+            return False
+        now = time.time() if now is None else now
+        if self.soft_since is None:
+            self.soft_since = now
+        return now - self.soft_since > limit.soft_seconds
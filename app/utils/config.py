@@ -2,6 +2,7 @@ from dataclasses import dataclass
 from pathlib import Path
 import argparse
 import logging
+from app.utils.buffer_limits import OutputBufferLimit, parse_memory
 
 """All configuration settings for REDIS"""
 
@@ -15,11 +16,95 @@ class RedisServerConfig:
     dir: str = "/tmp"
     dbfilename: str = "dump.rdb"
     replicaof: dict = None
+    # "<seconds> <changes>" pairs; an empty string disables automatic snapshots
+    save: str = "3600 1 300 100 60 10000"
+    # CRC64 of RDB files and full syncs: install crcmod for its C extension,
+    # the pure-Python fallback checksums only about 8 MB/s
+    rdbchecksum: bool = True
+    rdbcompression: bool = False
+    # Only strings longer than this many bytes are LZF compressed
+    rdbcompression_threshold: int = 20
+    appendonly: bool = False
+    appendfilename: str = "appendonly.aof"
+    # always | everysec | no
+    appendfsync: str = "everysec"
+    aof_load_truncated: bool = True
+    aof_use_rdb_preamble: bool = True
+    # Rewrite the AOF once it grew this many percent over its size after the last rewrite
+    auto_aof_rewrite_percentage: int = 100
+    auto_aof_rewrite_min_size: int = 64 * 1024 * 1024
+    # Stream full syncs from a forked child instead of going through the RDB file
+    repl_diskless_sync: bool = True
+    # Bytes of the replication stream kept for partial resynchronization
+    repl_backlog_size: int = 1024 * 1024
+    # Answer from the old dataset while the link is down or a full sync runs
+    replica_serve_stale_data: bool = True
+    # Refuse write commands from clients while we are a replica
+    replica_read_only: bool = True
+    # Seconds without traffic after which the replication link counts as dead
+    repl_timeout: int = 60
+    # How often a master pings its replicas (seconds)
+    repl_ping_replica_period: int = 10
+    # Serve a share of the 16384 hash slots, as listed in the cluster config file
+    cluster_enabled: bool = False
+    cluster_config_file: str = "nodes.conf"
+    # Pre-forked processes sharing the port, each serving a shard of the keys
+    workers: int = 1
+    # Which of those this process is (set by the supervisor, not the CLI)
+    worker_id: int = 0
+    # Event loop threads sharing one keyspace, for free-threaded CPython builds
+    threads: int = 1
+    # How client connections are served: asyncio "streams" or a "protocol"
+    io_mode: str = "streams"
+    # "<class> <hard> <soft> <soft seconds>" per client class, as in Redis:
+    # past hard bytes of unsent output, or soft bytes for that long, the
+    # client is disconnected. 0 disables a limit.
+    client_output_buffer_limit: str = (
+        "normal 0 0 0 replica 256mb 64mb 60 pubsub 32mb 8mb 60"
+    )
+    # Most unparsed bytes a client may send ahead
+    client_query_buffer_limit: int = 1024 * 1024 * 1024
+    # Longest bulk string a request may contain
+    proto_max_bulk_len: int = 512 * 1024 * 1024
+    # Most client connections at once
+    maxclients: int = 10000
+    # Close a client's connection after this many idle seconds, 0 never does
+    timeout: int = 0
+    # Also listen on this Unix socket path, with these octal permissions
+    # (0 keeps the umask's); an empty path disables it
+    unixsocket: str = ""
+    unixsocketperm: int = 0
+    # Pending connections the kernel queues on the TCP listener
+    tcp_backlog: int = 511
+    # Send TCP keepalives to idle clients every this many seconds, 0 disables
+    tcp_keepalive: int = 300
+    # Send small replies right away instead of coalescing them (Nagle off)
+    tcp_nodelay: bool = True
+    # Threads CPU-heavy commands (KEYS, DUMP) run on, 0 runs them on the loop
+    offload_threads: int = 2
 
     @property
     def rdb_path(self):
         return Path(self.dir) / self.dbfilename
 
+    @property
+    def aof_path(self):
+        return Path(self.dir) / self.appendfilename
+
+    @property
+    def cluster_config_path(self):
+        # An absolute file name is used as is, so nodes can share one file
+        return Path(self.dir) / self.cluster_config_file
+
+    @property
+    def output_buffer_limits(self) -> dict[str, OutputBufferLimit]:
+        return OutputBufferLimit.parse_all(self.client_output_buffer_limit)
+
+    @property
+    def save_points(self) -> list[tuple[int, int]]:
+        values = [int(value) for value in self.save.split()]
+        return list(zip(values[::2], values[1::2]))
+
     @classmethod
     def parse_args(cls, args):
         config = cls
@@ -40,6 +125,174 @@ class RedisServerConfig:
             help="Replicate the data from the master",
             required=False,
         )
+        parser.add_argument(
+            "--save",
+            help="Snapshot after <seconds> if at least <changes> writes happened",
+            default=config.save,
+        )
+        parser.add_argument(
+            "--rdbchecksum",
+            help="Write and verify the CRC64 trailer of RDB files (yes/no)",
+            default="yes" if config.rdbchecksum else "no",
+        )
+        parser.add_argument(
+            "--rdbcompression",
+            help="LZF compress long strings when writing RDB files (yes/no)",
+            default="yes" if config.rdbcompression else "no",
+        )
+        parser.add_argument(
+            "--rdbcompression-threshold",
+            help="Minimum string length in bytes before LZF compression is tried",
+            default=config.rdbcompression_threshold,
+        )
+        parser.add_argument(
+            "--appendonly",
+            help="Log every write command to the append only file (yes/no)",
+            default="yes" if config.appendonly else "no",
+        )
+        parser.add_argument(
+            "--appendfilename",
+            help="Filename of the append only file",
+            default=config.appendfilename,
+        )
+        parser.add_argument(
+            "--appendfsync",
+            help="When to fsync the append only file",
+            choices=["always", "everysec", "no"],
+            default=config.appendfsync,
+        )
+        parser.add_argument(
+            "--aof-load-truncated",
+            help="Load an AOF whose last command is truncated, cutting it off (yes/no)",
+            default="yes" if config.aof_load_truncated else "no",
+        )
+        parser.add_argument(
+            "--aof-use-rdb-preamble",
+            help="Start rewritten AOFs with an RDB snapshot of the dataset (yes/no)",
+            default="yes" if config.aof_use_rdb_preamble else "no",
+        )
+        parser.add_argument(
+            "--auto-aof-rewrite-percentage",
+            help="Growth over the last rewritten size that triggers a rewrite, 0 disables",
+            default=config.auto_aof_rewrite_percentage,
+        )
+        parser.add_argument(
+            "--auto-aof-rewrite-min-size",
+            help="Smallest AOF size in bytes that may be rewritten automatically",
+            default=config.auto_aof_rewrite_min_size,
+        )
+        parser.add_argument(
+            "--repl-diskless-sync",
+            help="Stream full syncs to replicas without writing the RDB file (yes/no)",
+            default="yes" if config.repl_diskless_sync else "no",
+        )
+        parser.add_argument(
+            "--repl-backlog-size",
+            help="Bytes of the replication stream kept for partial resyncs",
+            default=config.repl_backlog_size,
+        )
+        parser.add_argument(
+            "--replica-serve-stale-data",
+            help="Serve the old dataset while the replica resynchronizes (yes/no)",
+            default="yes" if config.replica_serve_stale_data else "no",
+        )
+        parser.add_argument(
+            "--replica-read-only",
+            help="Refuse writes from clients while replicating (yes/no)",
+            default="yes" if config.replica_read_only else "no",
+        )
+        parser.add_argument(
+            "--repl-timeout",
+            help="Seconds of silence after which the replication link is dropped",
+            default=config.repl_timeout,
+        )
+        parser.add_argument(
+            "--repl-ping-replica-period",
+            help="Seconds between the pings a master sends to its replicas",
+            default=config.repl_ping_replica_period,
+        )
+        parser.add_argument(
+            "--cluster-enabled",
+            help="Run as a cluster node serving the slots of the cluster config (yes/no)",
+            default="yes" if config.cluster_enabled else "no",
+        )
+        parser.add_argument(
+            "--cluster-config-file",
+            help="File listing the cluster nodes and the slots each one serves",
+            default=config.cluster_config_file,
+        )
+        parser.add_argument(
+            "--workers",
+            help="Processes to pre-fork, each serving a hash partition of the keys",
+            default=config.workers,
+        )
+        parser.add_argument(
+            "--threads",
+            help="Event loop threads sharing the keyspace (free-threaded Python)",
+            default=config.threads,
+        )
+        parser.add_argument(
+            "--io-mode",
+            help="Serve clients through asyncio streams or an asyncio.Protocol",
+            choices=["streams", "protocol"],
+            default=config.io_mode,
+        )
+        parser.add_argument(
+            "--client-output-buffer-limit",
+            help="<class> <hard> <soft> <seconds> output limits for normal, replica "
+            "and pubsub clients",
+            default=config.client_output_buffer_limit,
+        )
+        parser.add_argument(
+            "--client-query-buffer-limit",
+            help="Most unparsed bytes a client may send (e.g. 1gb)",
+            default=config.client_query_buffer_limit,
+        )
+        parser.add_argument(
+            "--proto-max-bulk-len",
+            help="Longest bulk string accepted in a request (e.g. 512mb)",
+            default=config.proto_max_bulk_len,
+        )
+        parser.add_argument(
+            "--maxclients",
+            help="Most client connections served at once",
+            default=config.maxclients,
+        )
+        parser.add_argument(
+            "--timeout",
+            help="Seconds of inactivity after which a client is disconnected, 0 never",
+            default=config.timeout,
+        )
+        parser.add_argument(
+            "--unixsocket",
+            help="Path of a Unix socket to accept clients on, besides TCP",
+            default=config.unixsocket,
+        )
+        parser.add_argument(
+            "--unixsocketperm",
+            help="Octal permissions of the Unix socket (e.g. 700)",
+            default=oct(config.unixsocketperm)[2:],
+        )
+        parser.add_argument(
+            "--tcp-backlog",
+            help="Length of the queue of pending TCP connections",
+            default=config.tcp_backlog,
+        )
+        parser.add_argument(
+            "--tcp-keepalive",
+            help="Seconds between TCP keepalive probes to idle clients, 0 disables",
+            default=config.tcp_keepalive,
+        )
+        parser.add_argument(
+            "--tcp-nodelay",
+            help="Disable Nagle's algorithm on client connections (yes/no)",
+            default="yes" if config.tcp_nodelay else "no",
+        )
+        parser.add_argument(
+            "--offload-threads",
+            help="Threads running CPU-heavy commands off the event loop, 0 disables",
+            default=config.offload_threads,
+        )
         parsed_args = parser.parse_args(args)
 
         replicaof = None
@@ -56,4 +309,40 @@ class RedisServerConfig:
             dbfilename=parsed_args.dbfilename,
             port=int(parsed_args.port),
             replicaof=replicaof,
+            save=parsed_args.save,
+            rdbchecksum=parsed_args.rdbchecksum.lower() == "yes",
+            rdbcompression=parsed_args.rdbcompression.lower() == "yes",
+            rdbcompression_threshold=int(parsed_args.rdbcompression_threshold),
+            appendonly=parsed_args.appendonly.lower() == "yes",
+            appendfilename=parsed_args.appendfilename,
+            appendfsync=parsed_args.appendfsync,
+            aof_load_truncated=parsed_args.aof_load_truncated.lower() == "yes",
+            aof_use_rdb_preamble=parsed_args.aof_use_rdb_preamble.lower() == "yes",
+            auto_aof_rewrite_percentage=int(parsed_args.auto_aof_rewrite_percentage),
+            auto_aof_rewrite_min_size=int(parsed_args.auto_aof_rewrite_min_size),
+            repl_diskless_sync=parsed_args.repl_diskless_sync.lower() == "yes",
+            repl_backlog_size=int(parsed_args.repl_backlog_size),
+            replica_serve_stale_data=parsed_args.replica_serve_stale_data.lower()
+            == "yes",
+            replica_read_only=parsed_args.replica_read_only.lower() == "yes",
+            repl_timeout=int(parsed_args.repl_timeout),
+            repl_ping_replica_period=int(parsed_args.repl_ping_replica_period),
+            cluster_enabled=parsed_args.cluster_enabled.lower() == "yes",
+            cluster_config_file=parsed_args.cluster_config_file,
+            workers=int(parsed_args.workers),
+            threads=int(parsed_args.threads),
+            io_mode=parsed_args.io_mode,
+            client_output_buffer_limit=parsed_args.client_output_buffer_limit,
+            client_query_buffer_limit=parse_memory(
+                parsed_args.client_query_buffer_limit
+            ),
+            proto_max_bulk_len=parse_memory(parsed_args.proto_max_bulk_len),
+            maxclients=int(parsed_args.maxclients),
+            timeout=int(parsed_args.timeout),
+            unixsocket=parsed_args.unixsocket,
+            unixsocketperm=int(str(parsed_args.unixsocketperm), 8),
+            tcp_backlog=int(parsed_args.tcp_backlog),
+            tcp_keepalive=int(parsed_args.tcp_keepalive),
+            tcp_nodelay=parsed_args.tcp_nodelay.lower() == "yes",
+            offload_threads=int(parsed_args.offload_threads),
         )
@@ -0,0 +1,40 @@
+"""Thread pool for CPU-heavy commands (--offload-threads)"""
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Optional
+
+
+class Offloader:
+    """Runs functions on a bounded pool of threads, away from the event loop
+
+    The threads are started on first use, so a pre-forked worker gets its
+    own. Without a free-threaded build they still share the GIL, but the
+    loop gets it back every switch interval instead of waiting for the
+    whole computation.
+    """
+
+    def __init__(self, threads: int):
+        self.threads = threads
+        self.executor: Optional[ThreadPoolExecutor] = None
+        # Calls handed to the pool so far
+        self.offloaded = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.threads > 0
+
+    async def run(self, function: Callable, *args):
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(
+                self.threads, thread_name_prefix="offload"
+            )
+        self.offloaded += 1
+        return await asyncio.get_running_loop().run_in_executor(
+            self.executor, function, *args
+        )
+
+    def shutdown(self) -> None:
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
@@ -0,0 +1,78 @@
+"""Lock-striped dict for the keyspace when several threads run event loops"""
+
+import threading
+from contextlib import ExitStack
+from typing import Dict, Iterable, List, Tuple
+
+
+class ShardedMap:
+    """A dict split into shards, each guarded by its own re-entrant lock
+
+    Single operations lock their shard on their own. A command that reads
+    and then writes, or touches several keys, holds locked(keys) around the
+    whole thing; it takes the shard locks in shard order, so two commands
+    can never wait on each other's locks.
+    """
+
+    def __init__(self, shards: int = 64):
+        self.shards: List[Dict] = [{} for _ in range(shards)]
+        # Re-entrant: a command holding its keys' locks calls the methods below
+        self.locks = [threading.RLock() for _ in range(shards)]
+
+    def _index(self, key) -> int:
+        return hash(key) % len(self.shards)
+
+    def lock_for(self, key) -> threading.RLock:
+        return self.locks[self._index(key)]
+
+    def locked(self, keys: Iterable) -> ExitStack:
+        """Hold the locks of every shard the keys live in, in shard order"""
+        stack = ExitStack()
+        for index in sorted({self._index(key) for key in keys}):
+            stack.enter_context(self.locks[index])
+        return stack
+
+    def acquire_all(self) -> None:
+        for lock in self.locks:
+            lock.acquire()
+
+    def release_all(self) -> None:
+        for lock in reversed(self.locks):
+            lock.release()
+
+    def __contains__(self, key) -> bool:
+        return key in self.shards[self._index(key)]
+
+    def __getitem__(self, key):
+        return self.shards[self._index(key)][key]
+
+    def __setitem__(self, key, value) -> None:
+        index = self._index(key)
+        with self.locks[index]:
+            self.shards[index][key] = value
+
+    def __delitem__(self, key) -> None:
+        index = self._index(key)
+        with self.locks[index]:
+            del self.shards[index][key]
+
+    def __len__(self) -> int:
+        return sum(len(shard) for shard in self.shards)
+
+    def __iter__(self):
+        return iter([key for key, _ in self.items()])
+
+    def get(self, key, default=None):
+        return self.shards[self._index(key)].get(key, default)
+
+    def items(self) -> List[Tuple]:
+        """A snapshot, taken one shard at a time"""
+        items = []
+        for shard, lock in zip(self.shards, self.locks):
+            with lock:
+                items.extend(shard.items())
+        return items
+
+    def update(self, entries: Dict) -> None:
+        for key, value in entries.items():
+            self[key] = value
@@ -0,0 +1 @@
+# workers/__init__.py
@@ -0,0 +1,97 @@
+"""Forwarding commands to the worker that owns their keys
+
+With --workers N every worker process serves the keys of the hash slots
+s with s % N == its worker id, and listens on a Unix socket next to the
+data files. A worker that gets a command for another worker's keys sends
+it over that socket and relays the reply untouched.
+"""
+
+import asyncio
+import logging
+from pathlib import Path
+from typing import Dict, List, Optional
+from app.cluster.slots import key_hash_slot
+from app.protocol.resp_encoder import RESPEncoder
+
+logger = logging.getLogger(__name__)
+
+# Idle connections kept open to each peer worker
+MAX_IDLE_CHANNELS = 16
+
+CROSSWORKER = b"-CROSSSLOT Keys in request don't hash to the same worker\r\n"
+
+
+def channel_path(config, worker_id: int) -> Path:
+    return Path(config.dir) / f"worker-{worker_id}.sock"
+
+
+async def read_reply(reader: asyncio.StreamReader) -> bytes:
+    """The raw bytes of one complete RESP reply"""
+    line = await reader.readuntil(b"\r\n")
+    kind = line[:1]
+    if kind == b"$":
+        length = int(line[1:-2])
+        if length < 0:
+            return line
+        return line + await reader.readexactly(length + 2)
+    if kind == b"*":
+        parts = [line]
+        for _ in range(max(int(line[1:-2]), 0)):
+            parts.append(await read_reply(reader))
+        return b"".join(parts)
+    return line
+
+
+class WorkerChannels:
+    """Connections to the other workers, one per command in flight
+
+    A connection is only shared between commands one after the other, so
+    a blocking command forwarded by one client can't hold up the others.
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self.worker_id = config.worker_id
+        self.workers = config.workers
+        self.encoder = RESPEncoder()
+        self.idle: Dict[int, List[tuple]] = {}
+
+    def owner(self, keys: List[str]) -> Optional[int]:
+        """The worker serving every key, None if they are spread over several"""
+        owners = {key_hash_slot(key) % self.workers for key in keys}
+        if len(owners) > 1:
+            return None
+        return owners.pop() if owners else self.worker_id
+
+    async def forward(self, worker_id: int, args: List[str]) -> bytes:
+        idle = self.idle.setdefault(worker_id, [])
+        writer = None
+        try:
+            # Connections the peer closed, e.g. when it restarted, are dropped
+            while idle and idle[-1][0].at_eof():
+                idle.pop()[1].close()
+            if idle:
+                reader, writer = idle.pop()
+            else:
+                reader, writer = await asyncio.open_unix_connection(
+                    str(channel_path(self.config, worker_id))
+                )
+            writer.write(self.encoder.encode_array(args))
+            await writer.drain()
+            reply = await read_reply(reader)
+        except (OSError, asyncio.IncompleteReadError) as e:
+            if writer is not None:
+                writer.close()
+            logger.error(f"Lost the channel to worker {worker_id}: {e}")
+            return self.encoder.encode_error(f"Worker {worker_id} is unavailable")
+        except BaseException:
+            # e.g. cancelled mid-reply: the connection is out of step now
+            if writer is not None:
+                writer.close()
+            raise
+
+        if len(idle) < MAX_IDLE_CHANNELS:
+            idle.append((reader, writer))
+        else:
+            writer.close()
+        return reply
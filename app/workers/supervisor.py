@@ -0,0 +1,98 @@
+"""--workers N: pre-fork N servers that share one listening port
+
+Each worker is a complete server with its own event loop, DataStore and
+data files. The listening sockets are bound with SO_REUSEPORT, so the
+kernel spreads the incoming connections over the workers; a worker hands
+the commands for keys it doesn't own to their worker (see channels.py).
+"""
+
+import asyncio
+import dataclasses
+import logging
+import os
+import signal
+import time
+from pathlib import Path
+from typing import Dict
+from app.server import RedisServer
+from app.utils.config import RedisServerConfig
+
+logger = logging.getLogger(__name__)
+
+# Pause before replacing a worker that died, so a crash loop can't spin
+RESTART_DELAY = 1
+
+
+def worker_config(config: "RedisServerConfig", worker_id: int) -> "RedisServerConfig":
+    """The worker's configuration: its id, and data files of its own"""
+    rdb = Path(config.dbfilename)
+    aof = Path(config.appendfilename)
+    return dataclasses.replace(
+        config,
+        worker_id=worker_id,
+        dbfilename=f"{rdb.stem}-{worker_id}{rdb.suffix}",
+        appendfilename=f"{aof.stem}-{worker_id}{aof.suffix}",
+    )
+
+
+class WorkerSupervisor:
+    def __init__(self, config: "RedisServerConfig"):
+        self.config = config
+        # pid -> worker id
+        self.workers: Dict[int, int] = {}
+        self.stopping = False
+
+    def run(self) -> None:
+        """Start the workers and keep them running until we are signalled"""
+        if self.config.replicaof or self.config.cluster_enabled:
+            raise ValueError(
+                "--workers can't be combined with replication or cluster mode"
+            )
+
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(sig, self._stop)
+
+        for worker_id in range(self.config.workers):
+            self._spawn(worker_id)
+        logger.info(f"Started {self.config.workers} workers on port {self.config.port}")
+
+        while self.workers:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+            worker_id = self.workers.pop(pid, None)
+            if worker_id is None or self.stopping:
+                continue
+            logger.warning(
+                f"Worker {worker_id} exited with code "
+                f"{os.waitstatus_to_exitcode(status)}, restarting it"
+            )
+            time.sleep(RESTART_DELAY)
+            if not self.stopping:
+                self._spawn(worker_id)
+
+    def _spawn(self, worker_id: int) -> None:
+        pid = os.fork()
+        if pid == 0:
+            exit_code = 1
+            try:
+                for sig in (signal.SIGTERM, signal.SIGINT):
+                    signal.signal(sig, signal.SIG_DFL)
+                server = RedisServer(worker_config(self.config, worker_id))
+                asyncio.run(server.start())
+                exit_code = 0
+            except Exception as e:
+                logger.error(f"Worker {worker_id} failed: {e}")
+            finally:
+                os._exit(exit_code)
+        self.workers[pid] = worker_id
+
+    def _stop(self, signum, frame) -> None:
+        """Pass the signal on to every worker; they shut down on their own"""
+        self.stopping = True
+        for pid in self.workers:
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
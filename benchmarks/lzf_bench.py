@@ -0,0 +1,51 @@
+"""Benchmark: LZF compression and decompression throughput in MB/s
+
+Run from the repository root with: python -m benchmarks.lzf_bench
+"""
+
+import os
+import random
+import time
+from app.protocol import lzf
+
+SIZE = 4 * 1024 * 1024
+
+
+def _sample_payloads():
+    words = [b"user", b"session", b"redis", b"stream", b"value", b"0001", b":"]
+    rng = random.Random(42)
+    text = b" ".join(rng.choice(words) for _ in range(SIZE // 5))[:SIZE]
+    return {
+        "text": text,
+        "repetitive": b"abcdefgh" * (SIZE // 8),
+        "random": os.urandom(SIZE),
+    }
+
+
+def _throughput(func, size, rounds=3):
+    best = float("inf")
+    for _ in range(rounds):
+        start = time.perf_counter()
+        result = func()
+        best = min(best, time.perf_counter() - start)
+    return result, size / best / (1024 * 1024)
+
+
+def main():
+    print(f"{'payload':<12}{'ratio':>8}{'compress MB/s':>16}{'decompress MB/s':>18}")
+    for name, payload in _sample_payloads().items():
+        compressed, compress_speed = _throughput(lambda: lzf.compress(payload), SIZE)
+        if compressed is None:
+            print(f"{name:<12}{'n/a':>8}{compress_speed:>16.1f}{'-':>18}")
+            continue
+        _, decompress_speed = _throughput(
+            lambda: lzf.decompress(compressed, len(payload)), SIZE
+        )
+        ratio = len(payload) / len(compressed)
+        print(
+            f"{name:<12}{ratio:>8.2f}{compress_speed:>16.1f}{decompress_speed:>18.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
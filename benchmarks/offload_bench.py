@@ -0,0 +1,134 @@
+"""Benchmark: other clients' GET latency while KEYS runs, with and without
+the offload thread pool
+
+Starts a server with --offload-threads 0 and then 2, fills it with keys,
+and times GET round trips from one connection while another keeps
+sending KEYS *.
+
+Run from the repository root with: python -m benchmarks.offload_bench
+"""
+
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+PORT = 7482
+KEYS = 200000
+REQUESTS = 5000
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _encode(args):
+    parts = [f"*{len(args)}\r\n".encode()]
+    for arg in args:
+        arg = arg.encode()
+        parts.append(b"$%d\r\n%s\r\n" % (len(arg), arg))
+    return b"".join(parts)
+
+
+def _connect():
+    connection = socket.create_connection(("localhost", PORT))
+    connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    return connection
+
+
+def _start_server(data_dir, offload_threads):
+    server = subprocess.Popen(
+        [sys.executable, "-m", "app.main", "--port", str(PORT), "--dir", data_dir]
+        + ["--save", "", "--offload-threads", str(offload_threads)],
+        # The server logs to a file in its working directory
+        cwd=data_dir,
+        env={**os.environ, "PYTHONPATH": ROOT},
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    for _ in range(100):
+        try:
+            _connect().close()
+            return server
+        except OSError:
+            time.sleep(0.1)
+    server.kill()
+    raise RuntimeError("The server didn't start")
+
+
+def _fill():
+    connection = _connect()
+    for start in range(0, KEYS, 1000):
+        connection.sendall(
+            b"".join(
+                _encode(["SET", f"key:{i}", "value"])
+                for i in range(start, start + 1000)
+            )
+        )
+        received = 0
+        while received < 1000:
+            received += connection.recv(65536).count(b"\n")
+    connection.close()
+
+
+def _send_keys(stop, calls):
+    connection = _connect()
+    request = _encode(["KEYS", "*"])
+    while not stop.is_set():
+        connection.sendall(request)
+        # The array header, then a length line and a key line per key
+        received = 0
+        while received < 2 * KEYS + 1:
+            received += connection.recv(1 << 20).count(b"\n")
+        calls.append(1)
+    connection.close()
+
+
+def _get_latencies():
+    """Microseconds each GET took to be answered"""
+    connection = _connect()
+    request = _encode(["GET", "key:1"])
+    latencies = []
+    for _ in range(REQUESTS):
+        start = time.perf_counter()
+        connection.sendall(request)
+        reply = connection.recv(65536)
+        while reply.count(b"\r\n") < 2:
+            reply += connection.recv(65536)
+        latencies.append((time.perf_counter() - start) * 1e6)
+    connection.close()
+    return latencies
+
+
+def main():
+    results = {}
+    for offload_threads in (0, 2):
+        with tempfile.TemporaryDirectory() as data_dir:
+            server = _start_server(data_dir, offload_threads)
+            try:
+                _fill()
+                stop, calls = threading.Event(), []
+                keys = threading.Thread(target=_send_keys, args=(stop, calls))
+                keys.start()
+                start = time.perf_counter()
+                latencies = _get_latencies()
+                elapsed = time.perf_counter() - start
+                stop.set()
+                keys.join()
+                results[offload_threads] = latencies, len(calls) / elapsed
+            finally:
+                server.terminate()
+                server.wait()
+
+    print(f"{'offload threads':<16}{'GET p50 us':>12}{'GET p99 us':>12}{'KEYS/s':>8}")
+    for offload_threads, (latencies, keys_per_second) in results.items():
+        percentiles = statistics.quantiles(latencies, n=100)
+        print(
+            f"{offload_threads:<16}{percentiles[49]:>12.0f}{percentiles[98]:>12.0f}"
+            f"{keys_per_second:>8.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
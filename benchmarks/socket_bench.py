@@ -0,0 +1,112 @@
+"""Benchmark: request latency over TCP loopback vs the Unix socket
+
+Starts one server listening on both and times PING/GET/SET round trips,
+one request at a time from a single connection, on each of them.
+
+Run from the repository root with: python -m benchmarks.socket_bench
+"""
+
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+PORT = 7481
+REQUESTS = 20000
+COMMANDS = {
+    "PING": ["PING"],
+    "SET": ["SET", "key:{i}", "value"],
+    "GET": ["GET", "key:{i}"],
+}
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _encode(args):
+    parts = [f"*{len(args)}\r\n".encode()]
+    for arg in args:
+        arg = arg.encode()
+        parts.append(b"$%d\r\n%s\r\n" % (len(arg), arg))
+    return b"".join(parts)
+
+
+def _connect(address):
+    if isinstance(address, str):
+        connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        connection.connect(address)
+        return connection
+    connection = socket.create_connection(address)
+    connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    return connection
+
+
+def _start_server(data_dir, unixsocket):
+    server = subprocess.Popen(
+        [sys.executable, "-m", "app.main", "--port", str(PORT), "--dir", data_dir]
+        + ["--save", "", "--unixsocket", unixsocket],
+        # The server logs to a file in its working directory
+        cwd=data_dir,
+        env={**os.environ, "PYTHONPATH": ROOT},
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    for _ in range(100):
+        try:
+            _connect(unixsocket).close()
+            _connect(("localhost", PORT)).close()
+            return server
+        except OSError:
+            time.sleep(0.1)
+    server.kill()
+    raise RuntimeError("The server didn't start")
+
+
+def _latencies(address, command):
+    """Microseconds each request took to be answered"""
+    connection = _connect(address)
+    requests = [_encode([arg.format(i=i) for arg in command]) for i in range(REQUESTS)]
+    latencies = []
+    for request in requests:
+        start = time.perf_counter()
+        connection.sendall(request)
+        reply = connection.recv(65536)
+        # GET replies are a length line and the value
+        while reply.startswith(b"$") and reply.count(b"\r\n") < 2:
+            reply += connection.recv(65536)
+        latencies.append((time.perf_counter() - start) * 1e6)
+    connection.close()
+    return latencies
+
+
+def main():
+    results = {}
+    with tempfile.TemporaryDirectory() as data_dir:
+        unixsocket = os.path.join(data_dir, "redis.sock")
+        server = _start_server(data_dir, unixsocket)
+        try:
+            for name, command in COMMANDS.items():
+                for transport, address in (
+                    ("tcp", ("localhost", PORT)),
+                    ("unix", unixsocket),
+                ):
+                    results[name, transport] = _latencies(address, command)
+        finally:
+            server.terminate()
+            server.wait()
+
+    print(f"{'command':<10}{'socket':>8}{'p50 us':>10}{'p99 us':>10}{'ops/s':>10}")
+    for name in COMMANDS:
+        for transport in ("tcp", "unix"):
+            latencies = results[name, transport]
+            percentiles = statistics.quantiles(latencies, n=100)
+            ops = len(latencies) / sum(latencies) * 1e6
+            print(
+                f"{name:<10}{transport:>8}{percentiles[49]:>10.1f}"
+                f"{percentiles[98]:>10.1f}{ops:>10.0f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
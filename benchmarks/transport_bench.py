@@ -0,0 +1,115 @@
+"""Benchmark: PING/GET/SET ops per second, --io-mode streams vs protocol
+
+Starts a server for each mode and drives it from several client
+connections, one request at a time and pipelined.
+
+Run from the repository root with: python -m benchmarks.transport_bench
+"""
+
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+PORT = 7480
+CLIENTS = 4
+REQUESTS = 20000
+# Command, and the number of lines in each of its replies
+COMMANDS = {
+    "PING": (["PING"], 1),
+    "SET": (["SET", "key:{i}", "value"], 1),
+    "GET": (["GET", "key:{i}"], 2),
+}
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _encode(args):
+    parts = [f"*{len(args)}\r\n".encode()]
+    for arg in args:
+        arg = arg.encode()
+        parts.append(b"$%d\r\n%s\r\n" % (len(arg), arg))
+    return b"".join(parts)
+
+
+def _start_server(io_mode, data_dir):
+    server = subprocess.Popen(
+        [sys.executable, "-m", "app.main", "--port", str(PORT), "--dir", data_dir]
+        + ["--save", "", "--io-mode", io_mode],
+        # The server logs to a file in its working directory
+        cwd=data_dir,
+        env={**os.environ, "PYTHONPATH": ROOT},
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    for _ in range(100):
+        try:
+            socket.create_connection(("localhost", PORT)).close()
+            return server
+        except OSError:
+            time.sleep(0.1)
+    server.kill()
+    raise RuntimeError(f"The {io_mode} server didn't start")
+
+
+def _client(command, lines, requests, pipeline):
+    connection = socket.create_connection(("localhost", PORT))
+    connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    batch = b"".join(
+        _encode([arg.format(i=i) for arg in command]) for i in range(pipeline)
+    )
+    for _ in range(requests // pipeline):
+        connection.sendall(batch)
+        received = 0
+        while received < pipeline * lines:
+            data = connection.recv(65536)
+            if not data:
+                raise ConnectionError("The server closed the connection")
+            received += data.count(b"\n")
+    connection.close()
+
+
+def _ops_per_second(command, lines, pipeline):
+    requests = REQUESTS // CLIENTS
+    clients = [
+        threading.Thread(target=_client, args=(command, lines, requests, pipeline))
+        for _ in range(CLIENTS)
+    ]
+    start = time.perf_counter()
+    for client in clients:
+        client.start()
+    for client in clients:
+        client.join()
+    return requests * CLIENTS / (time.perf_counter() - start)
+
+
+def main():
+    results = {}
+    for io_mode in ("streams", "protocol"):
+        with tempfile.TemporaryDirectory() as data_dir:
+            server = _start_server(io_mode, data_dir)
+            try:
+                for name, (command, lines) in COMMANDS.items():
+                    for pipeline in (1, 16):
+                        results[io_mode, name, pipeline] = _ops_per_second(
+                            command, lines, pipeline
+                        )
+            finally:
+                server.terminate()
+                server.wait()
+
+    print(f"{'command':<10}{'pipeline':>10}{'streams':>12}{'protocol':>12}{'gain':>8}")
+    for name in COMMANDS:
+        for pipeline in (1, 16):
+            streams = results["streams", name, pipeline]
+            protocol = results["protocol", name, pipeline]
+            print(
+                f"{name:<10}{pipeline:>10}{streams:>12.0f}{protocol:>12.0f}"
+                f"{protocol / streams:>7.2f}x"
+            )
+
+
+if __name__ == "__main__":
+    main()
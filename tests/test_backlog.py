@@ -0,0 +1,70 @@
+"""Replication backlog offsets and wrap-around
+
+Run from the repository root with: python -m unittest discover tests
+"""
+
+import unittest
+from app.replication.backlog import ReplicationBacklog
+
+
+class ReplicationBacklogTest(unittest.TestCase):
+    def fill(self, backlog, chunks):
+        stream = b""
+        for chunk in chunks:
+            backlog.append(chunk)
+            stream += chunk
+        return stream
+
+    def test_empty(self):
+        backlog = ReplicationBacklog(16)
+        self.assertTrue(backlog.contains(1))
+        self.assertEqual(backlog.read_from(1), b"")
+        self.assertFalse(backlog.contains(0))
+        self.assertFalse(backlog.contains(2))
+
+    def test_read_from_every_offset(self):
+        backlog = ReplicationBacklog(16)
+        stream = self.fill(backlog, [b"abcde", b"fgh"])
+        for offset in range(1, len(stream) + 2):
+            with self.subTest(offset=offset):
+                self.assertEqual(backlog.read_from(offset), stream[offset - 1 :])
+
+    def test_wrap_around(self):
+        backlog = ReplicationBacklog(16)
+        chunks = [bytes([65 + i % 26]) * (i % 7 + 1) for i in range(20)]
+        stream = self.fill(backlog, chunks)
+        self.assertEqual(backlog.master_offset, len(stream))
+        self.assertEqual(backlog.histlen, 16)
+        self.assertEqual(backlog.first_byte_offset, len(stream) - 15)
+        for offset in range(len(stream) - 15, len(stream) + 2):
+            with self.subTest(offset=offset):
+                self.assertEqual(backlog.read_from(offset), stream[offset - 1 :])
+
+    def test_append_larger_than_backlog(self):
+        backlog = ReplicationBacklog(8)
+        stream = self.fill(backlog, [b"abc", bytes(range(20))])
+        self.assertEqual(backlog.first_byte_offset, len(stream) - 7)
+        self.assertEqual(backlog.read_from(backlog.first_byte_offset), stream[-8:])
+
+    def test_offsets_out_of_range(self):
+        backlog = ReplicationBacklog(8)
+        stream = self.fill(backlog, [b"0123456789"])
+        for offset in (1, len(stream) - 8, len(stream) + 2):
+            with self.subTest(offset=offset):
+                self.assertFalse(backlog.contains(offset))
+                with self.assertRaises(ValueError):
+                    backlog.read_from(offset)
+
+    def test_reset(self):
+        backlog = ReplicationBacklog(8)
+        self.fill(backlog, [b"abcdef"])
+        backlog.reset(100)
+        self.assertFalse(backlog.contains(6))
+        self.assertEqual(backlog.read_from(101), b"")
+        backlog.append(b"xyz")
+        self.assertEqual(backlog.first_byte_offset, 101)
+        self.assertEqual(backlog.read_from(102), b"yz")
+
+
+if __name__ == "__main__":
+    unittest.main()
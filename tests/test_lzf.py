@@ -0,0 +1,66 @@
+"""LZF compression round trips and malformed input
+
+Run from the repository root with: python -m unittest discover tests
+"""
+
+import os
+import unittest
+from app.protocol import lzf
+
+
+class LZFTest(unittest.TestCase):
+    def round_trip(self, data):
+        compressed = lzf.compress(data)
+        self.assertIsNotNone(compressed)
+        self.assertEqual(lzf.decompress(compressed, len(data)), data)
+        return compressed
+
+    def test_round_trip(self):
+        for data in (
+            b"abc",
+            b"a" * 10000,
+            b"abcabcabcabcabcabcabcabcabcabc",
+            b"hello world, " * 500 + os.urandom(100),
+            bytes(range(256)) * 40,
+        ):
+            with self.subTest(length=len(data)):
+                self.round_trip(data)
+
+    def test_repetitive_data_shrinks(self):
+        self.assertLess(len(self.round_trip(b"x" * 1000)), 100)
+
+    def test_incompressible_data(self):
+        data = os.urandom(1000)
+        self.assertIsNone(lzf.compress(data, max_length=len(data) - 1))
+
+    def test_truncated_input(self):
+        data = b"hello world, " * 200
+        compressed = lzf.compress(data)
+        for cut in range(len(compressed)):
+            with self.subTest(cut=cut), self.assertRaises(ValueError):
+                lzf.decompress(compressed[:cut], len(data))
+
+    def test_back_reference_cut_after_control_byte(self):
+        # A literal "ab", then a long back-reference missing its length and
+        # offset bytes
+        with self.assertRaises(ValueError):
+            lzf.decompress(b"\x01ab\xe0", 20)
+        with self.assertRaises(ValueError):
+            lzf.decompress(b"\x01ab\xe0\x05", 20)
+        with self.assertRaises(ValueError):
+            lzf.decompress(b"\x01ab\x20", 5)
+
+    def test_back_reference_before_start(self):
+        with self.assertRaises(ValueError):
+            lzf.decompress(b"\x00a\x20\x05", 4)
+
+    def test_output_longer_than_expected(self):
+        compressed = lzf.compress(b"a" * 1000)
+        with self.assertRaises(ValueError):
+            lzf.decompress(compressed, 10)
+        with self.assertRaises(ValueError):
+            lzf.decompress(b"\x04abcde", 3)
+
+
+if __name__ == "__main__":
+    unittest.main()
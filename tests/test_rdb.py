@@ -0,0 +1,69 @@
+"""RDB serialization round trips
+
+Run from the repository root with: python -m unittest discover tests
+"""
+
+import os
+import unittest
+from app.database import DataStore
+from app.protocol import crc64
+from app.protocol.RDBLoader import RDBLoader, RDBParser, RDBStreamParser
+from app.protocol.RDBWriter import RDBWriter
+from app.streams.streamData import StreamData
+from app.utils.config import RedisServerConfig
+
+# Non-UTF-8 bytes as the RESP decoder hands them over
+BINARY = b"\xff\xfe\x00bin".decode("utf-8", "surrogateescape")
+
+
+class BinaryRoundTripTest(unittest.TestCase):
+    def setUp(self):
+        self.config = RedisServerConfig(save="", rdbcompression=True)
+        self.store = DataStore(self.config)
+        self.store.set(BINARY, BINARY * 20)
+        stream = StreamData()
+        stream.add_entry("1-1", {BINARY: BINARY})
+        # Enough entries for several listpack nodes
+        for sequence in range(2, 350):
+            stream.add_entry(f"1-{sequence}", {"field": str(sequence)})
+        self.store.set("stream", stream)
+
+    def test_dump_restore(self):
+        payload = RDBWriter.dump_value(BINARY, self.config)
+        self.assertEqual(RDBLoader.restore_value(payload), BINARY)
+
+    def test_rdb_file(self):
+        parser = RDBParser(memoryview(RDBWriter.dumps(self.store)))
+        parser.parse()
+        self._check(parser.data)
+
+    def test_streamed_rdb(self):
+        parser = RDBStreamParser()
+        payload = RDBWriter.dumps(self.store)
+        for start in range(0, len(payload), 7):
+            parser.feed(payload[start : start + 7])
+        self.assertTrue(parser.done)
+        self._check(parser.data)
+
+    def _check(self, data):
+        self.assertEqual(data[BINARY][0], BINARY * 20)
+        entries = data["stream"][0].entries
+        self.assertEqual(len(entries), 349)
+        self.assertEqual((entries[0].id, entries[0].fields), ("1-1", {BINARY: BINARY}))
+        self.assertEqual(entries[-1].fields, {"field": "349"})
+
+
+class Crc64Test(unittest.TestCase):
+    def test_check_value(self):
+        self.assertEqual(crc64.crc64(b"123456789"), 0xE9C6D914C4B8D9CA)
+        self.assertEqual(crc64._crc64(b"123456789"), 0xE9C6D914C4B8D9CA)
+
+    def test_fallback_matches_in_pieces(self):
+        data = os.urandom(1021)
+        expected = crc64.crc64(data)
+        self.assertEqual(crc64._crc64(data), expected)
+        self.assertEqual(crc64._crc64(data[13:], crc64._crc64(data[:13])), expected)
+
+
+if __name__ == "__main__":
+    unittest.main()